@@ -0,0 +1,201 @@
+"""Reproducible end-to-end benchmarks for the upload, question and chat actions.
+
+Synthetic CSVs of several shapes are uploaded and queried through the Django
+test client, so every request goes through the real views, jobs and
+``RequestMetricsMiddleware``. Completions come from the local LLM backend
+(``analysis.llm.LocalBackend``) with a configurable latency; its replies
+fit the synthetic schema. Per-stage timings come from
+``response.metrics``; ``compare_to_baseline`` flags the ones that regressed
+against a baseline recorded on the same machine (see ``machine_info``).
+``seed_history`` and ``run_history_scenario`` measure the sidebar and chat
+history actions for a user with a very long history. Run with
+``manage.py run_benchmarks``.
+"""
+import os
+import platform
+import statistics
+
+import numpy as np
+import pandas as pd
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import Client
+
+from .charts import chart_memo
+from .dataframes import dataframe_cache
+from .llm_cache import llm_cache
+from .models import Chat, ChatMessage
+
+# Metrics reported per action; the middleware omits stages that did not run
+STAGES = ('wall_ms', 'parse_ms', 'openai_ms', 'pandas_ms', 'render_ms', 'sql_ms', 'queries', 'prompt_tokens')
+STAGE_LABELS = {
+    'wall_ms': 'wall', 'parse_ms': 'parse', 'openai_ms': 'llm', 'pandas_ms': 'aggregate',
+    'render_ms': 'render', 'sql_ms': 'db', 'queries': 'queries', 'prompt_tokens': 'prompt tokens',
+}
+# Stages that swing with scheduler and process-pool noise get a wider allowance than --tolerance
+STAGE_TOLERANCE = {'render_ms': 1.0, 'openai_ms': 1.0}
+DEFAULT_SIZES = ((1_000, 5), (10_000, 20), (100_000, 5), (100_000, 100))
+REGIONS = ('North', 'South', 'East', 'West', 'Central', 'Online', 'Export', 'Other')
+QUESTION = 'Which region has the highest total amount?'
+
+
+def synthetic_csv(rows: int, columns: int, seed: int = 0) -> bytes:
+    """CSV bytes with ``rows`` rows and ``columns`` (at least 5) columns of mixed dtypes.
+
+    The first five columns are always ``id, region, day, amount, units``;
+    further columns cycle through float, integer, low-cardinality string
+    and boolean values. The output depends only on the arguments.
+    """
+    rng = np.random.default_rng(seed)
+    data = {
+        'id': np.arange(rows),
+        'region': rng.choice(REGIONS, rows),
+        'day': pd.date_range('2020-01-01', periods=rows, freq='h').strftime('%Y-%m-%d %H:%M'),
+        'amount': rng.gamma(2.0, 50.0, rows).round(2),
+        'units': rng.integers(1, 500, rows),
+    }
+    for i in range(max(columns, 5) - 5):
+        kind = i % 4
+        if kind == 0:
+            data[f'metric_{i}'] = rng.normal(100, 15, rows).round(3)
+        elif kind == 1:
+            data[f'count_{i}'] = rng.integers(0, 10_000, rows)
+        elif kind == 2:
+            data[f'label_{i}'] = rng.choice([f'L{j}' for j in range(20)], rows)
+        else:
+            data[f'flag_{i}'] = rng.random(rows) < 0.3
+    return pd.DataFrame(data).to_csv(index=False).encode()
+
+
+def clear_caches():
+    for cache in (dataframe_cache, llm_cache, chart_memo):
+        cache.clear()
+
+
+def _post(client, form_type, **data):
+    response = client.post('/home/', dict(data, form_type=form_type), HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+    body = response.json()
+    if not body.get('success'):
+        raise RuntimeError(f'{form_type} failed: {body.get("error")}')
+    return response, body
+
+
+def run_scenario(user, csv_bytes: bytes) -> dict:
+    """Drive every ``home`` action once for ``user`` on cold caches; returns ``{action: metrics}``."""
+    clear_caches()
+    client = Client()
+    client.force_login(user)
+    samples = {}
+    samples['get'] = client.get('/home/').metrics
+
+    response, body = _post(client, 'upload', file=SimpleUploadedFile('bench.csv', csv_bytes, content_type='text/csv'))
+    samples['upload'] = response.metrics
+    samples['question'] = _post(client, 'question', question=QUESTION)[0].metrics
+    samples['question_warm'] = _post(client, 'question', question=QUESTION)[0].metrics
+
+    first_chat = body['active_chat_id']
+    response, body = _post(client, 'new_chat')
+    samples['new_chat'] = response.metrics
+    new_chat = body['active_chat_id']
+    samples['upload_duplicate'] = _post(
+        client, 'upload', file=SimpleUploadedFile('bench.csv', csv_bytes, content_type='text/csv'),
+    )[0].metrics
+    samples['switch_chat'] = _post(client, 'switch_chat', chat_id=first_chat)[0].metrics
+    samples['save_chat'] = _post(client, 'save_chat', chat_id=first_chat)[0].metrics
+    samples['delete_chat'] = _post(client, 'delete_chat', chat_id=new_chat)[0].metrics
+    return {action: {k: v for k, v in sample.items() if k != 'action'} for action, sample in samples.items()}
+
+
+def seed_history(user, messages: int, chats: int, batch_size: int = 10_000):
+    """Bulk-insert ``messages`` question messages for ``user``, spread evenly over ``chats`` chats."""
+    per_chat, extra = divmod(messages, chats)
+    created = Chat.objects.bulk_create([
+        Chat(user=user, title=f'History {i}', message_count=per_chat + (i < extra))
+        for i in range(chats)
+    ], batch_size=batch_size)
+    pending = []
+    for chat in created:
+        for i in range(chat.message_count):
+            pending.append(ChatMessage(chat=chat, type='question', content=f'Question {i}', response='Answer'))
+            if len(pending) >= batch_size:
+                ChatMessage.objects.bulk_create(pending)
+                pending = []
+    ChatMessage.objects.bulk_create(pending)
+
+
+def run_history_scenario(user) -> dict:
+    """Drive the sidebar and history actions once for a ``user`` seeded by ``seed_history``."""
+    client = Client()
+    client.force_login(user)
+    samples = {}
+    samples['get'] = client.get('/home/').metrics
+    chat = Chat.objects.filter(user=user).order_by('created_at').first()
+    response, body = _post(client, 'switch_chat', chat_id=chat.id)
+    samples['switch_chat'] = response.metrics
+    samples['history_page'] = client.get(
+        f'/home/chats/{chat.id}/messages/', {'cursor': body['next_cursor']},
+    ).metrics
+    response, body = _post(client, 'new_chat')
+    samples['new_chat'] = response.metrics
+    samples['delete_chat'] = _post(client, 'delete_chat', chat_id=body['active_chat_id'])[0].metrics
+    return {action: {k: v for k, v in sample.items() if k != 'action'} for action, sample in samples.items()}
+
+
+def summarize(runs) -> dict:
+    """Median of each metric over repeated scenario runs."""
+    summary = {}
+    for action in runs[0]:
+        keys = sorted({key for run in runs for key in run[action]})
+        summary[action] = {
+            key: round(statistics.median(run[action].get(key, 0) for run in runs), 2) for key in keys
+        }
+    return summary
+
+
+def size_label(rows: int, columns: int) -> str:
+    return f'{rows}x{columns}'
+
+
+def machine_info() -> dict:
+    """What a baseline was recorded on; timings are only comparable on the same machine."""
+    return {
+        'node': platform.node(),
+        'machine': platform.machine(),
+        'processor': platform.processor(),
+        'cpus': os.cpu_count(),
+        'python': platform.python_version(),
+    }
+
+
+def compare_to_baseline(results: dict, baseline: dict, tolerance: float, min_delta_ms: float) -> list:
+    """Metrics slower than the baseline by more than ``tolerance`` (relative) and ``min_delta_ms``.
+
+    Stages in ``STAGE_TOLERANCE`` use the larger of the two allowances. Counts
+    (queries, prompt tokens) regress on any increase. Returns
+    ``(size, action, metric, baseline, current)`` tuples.
+    """
+    regressions = []
+    for size, actions in results.items():
+        for action, metrics in actions.items():
+            before = baseline.get(size, {}).get(action, {})
+            for metric, current in metrics.items():
+                if metric not in before:
+                    continue
+                previous = before[metric]
+                if not metric.endswith('_ms'):
+                    regressed = current > previous
+                else:
+                    allowed = max(tolerance, STAGE_TOLERANCE.get(metric, 0))
+                    regressed = current > previous * (1 + allowed) and current - previous > min_delta_ms
+                if regressed:
+                    regressions.append((size, action, metric, previous, current))
+    return regressions
+
+
+def format_table(results: dict) -> str:
+    header = ['size', 'action'] + [STAGE_LABELS[s] for s in STAGES]
+    rows = [header]
+    for size, actions in results.items():
+        for action, metrics in actions.items():
+            rows.append([size, action] + [f'{metrics[s]:g}' if s in metrics else '-' for s in STAGES])
+    widths = [max(len(row[i]) for row in rows) for i in range(len(header))]
+    return '\n'.join('  '.join(cell.ljust(w) for cell, w in zip(row, widths)) for row in rows)
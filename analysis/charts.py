@@ -0,0 +1,537 @@
+"""Chart rendering without pyplot's global state.
+
+Charts are drawn on an explicit ``Figure`` with an Agg canvas, so concurrent
+renders never share a current figure and nothing leaks when drawing fails.
+Data selection and aggregation happen in the caller's process; only the
+small plot payload is shipped to a pool of warm renderer processes.
+"""
+import base64
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import signal
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from io import BytesIO
+
+import numpy as np
+import pandas as pd
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+
+from .downsampling import OTHER_LABEL, downsample_line, sample_scatter, top_n_with_other
+from .dtypes import widened
+from .metrics import timed
+from .profiling import PREVIEW_ROWS, preview_frame, profile_column
+from .query import aggregate_chunks, execute_plan, validate_plan
+
+logger = logging.getLogger(__name__)
+
+FIGSIZE = (10, 6)
+
+
+def normalize_spec(spec):
+    """Reduce a chart spec to the fields that affect the rendered image, or None if it isn't a chart.
+
+    Normalizing is idempotent, and equal normalized specs on equal data
+    always render the same image.
+    """
+    if not spec or not isinstance(spec, dict):
+        return None
+    chart_type = str(spec.get('type') or '').strip().lower()
+    title = spec.get('title') or 'Chart'
+    if chart_type in ['hist', 'pie']:
+        normalized = {'type': chart_type, 'x': spec.get('x') or spec.get('y'), 'title': title}
+        if chart_type == 'hist':
+            try:
+                normalized['bins'] = int(spec.get('bins') or 20)
+            except (TypeError, ValueError):
+                normalized['bins'] = 20
+        return normalized
+    if chart_type == 'box':
+        return {'type': chart_type, 'y': spec.get('y'), 'title': title}
+    if chart_type in ['bar', 'line', 'scatter']:
+        normalized = {'type': chart_type, 'x': spec.get('x'), 'y': spec.get('y'), 'title': title}
+        if chart_type == 'bar' and spec.get('agg') in ['sum', 'mean', 'count']:
+            normalized['agg'] = spec['agg']
+        return normalized
+    return None
+
+
+def build_spec_payload(spec, df, profile=None):
+    """Turn a chart spec from ``infer_chart_spec`` into a plot payload, or None if it can't be drawn.
+
+    Columns fully described by the dataset ``profile`` are drawn from it instead of the rows.
+    ``df`` may be a ``PartitionedDataset``: histograms, pies, bars and lines are then
+    computed chunk by chunk, while box and scatter plots use its row sample.
+    """
+    spec = normalize_spec(spec)
+    partitioned = not isinstance(df, pd.DataFrame)
+    if spec is None:
+        return None
+    chart_type = spec['type']
+    title = spec['title']
+    if chart_type == 'hist':
+        col = spec['x']
+        if col and col in df.columns:
+            if partitioned:
+                centers, edges, counts = _chunked_histogram(df, col, spec['bins'])
+                return {'kind': 'hist', 'data': centers, 'title': title, 'options': {'bins': edges, 'weights': counts}}
+            return {'kind': 'hist', 'data': df[col], 'title': title, 'options': {'bins': spec['bins']}}
+    elif chart_type == 'pie':
+        col = spec['x']
+        if col and col in df.columns:
+            counts = _category_counts(df, col, profile)
+            return {'kind': 'pie', 'data': counts, 'title': title, 'options': {'autopct': '%1.1f%%'}}
+    elif chart_type == 'box':
+        col = spec['y']
+        if col and col in df.columns:
+            data = df.sample[[col]] if partitioned else df[[col]]
+            return {'kind': 'box', 'data': data, 'title': title, 'options': {}}
+    else:
+        x = spec['x']
+        y = spec['y']
+        if x and y and x in df.columns and y in df.columns:
+            agg = spec.get('agg')
+            max_points = settings.CHART_MAX_LINE_POINTS
+            if chart_type == 'bar':
+                data = _chunked_bar_data(df, x, y, agg) if partitioned else _bar_data(df, x, y, agg)
+            elif chart_type == 'line' and partitioned:
+                # LTTB per chunk, then once more over the concatenated reductions
+                data = pd.concat(
+                    [downsample_line(chunk, x, y, max_points) for chunk in df.iter_chunks([x, y])], ignore_index=True,
+                )
+                data = downsample_line(data, x, y, max_points)
+            else:
+                source = df.sample if partitioned else df
+                data = source[[x, y]] if x != y else source[[x]]
+                if chart_type == 'line':
+                    data = downsample_line(data, x, y, max_points)
+                else:
+                    data = sample_scatter(data, x, settings.CHART_MAX_SCATTER_POINTS)
+            return {'kind': chart_type, 'data': data, 'title': title, 'options': {'x': x, 'y': y}}
+    return None
+
+
+def _category_counts(df, col, profile=None):
+    """Value counts for a pie, capped at ``CHART_MAX_CATEGORIES`` plus "Other"."""
+    limit = settings.CHART_MAX_CATEGORIES
+    column = profile_column(profile, col) if profile else None
+    if column and (column['distinct'] <= len(column['top']) or limit <= len(column['top'])):
+        top = column['top'][:limit]
+        counts = pd.Series({value: count for value, count in top}, name='count')
+        rest = profile['rows'] - column['nulls'] - int(counts.sum())
+        if rest > 0:
+            counts[OTHER_LABEL] = rest
+        return counts
+    if not isinstance(df, pd.DataFrame):
+        counts, _ = aggregate_chunks(df.iter_chunks([col]), [col], [{'column': '*', 'func': 'count'}])
+        return top_n_with_other(counts.set_index(col)['count'], limit)
+    counts = df[col].value_counts()
+    return top_n_with_other(counts[counts > 0], limit)
+
+
+def _bar_data(df, x, y, agg):
+    limit = settings.CHART_MAX_CATEGORIES
+    if agg:
+        values = widened(df[y]).groupby(df[x], observed=True).agg(agg)
+        other = None
+        if len(values) > limit and agg == 'mean':
+            top_keys = values.sort_values(ascending=False, kind='stable').index[:limit]
+            other = df.loc[~df[x].isin(top_keys), y].mean()
+        return top_n_with_other(values, limit, other).rename_axis(x).reset_index()
+    if x == y:
+        return df[[x]]
+    if len(df) <= limit:
+        return df[[x, y]]
+    # One bar per row: keep the largest rows and sum the rest
+    return top_n_with_other(df.set_index(x)[y], limit).rename_axis(x).reset_index()
+
+
+def _chunked_histogram(source, col, bins):
+    """Bin centers, edges and counts of a column, accumulated chunk by chunk over fixed edges."""
+    lo = hi = None
+    for chunk in source.iter_chunks([col]):
+        values = chunk[col].dropna().to_numpy(dtype=float)
+        if len(values):
+            lo = values.min() if lo is None else min(lo, values.min())
+            hi = values.max() if hi is None else max(hi, values.max())
+    if lo is None:
+        raise ValueError(f'{col} has no values')
+    lo, hi = (lo - 0.5, hi + 0.5) if lo == hi else (lo, hi)
+    edges = np.linspace(lo, hi, bins + 1)
+    counts = np.zeros(bins, dtype=np.int64)
+    for chunk in source.iter_chunks([col]):
+        counts += np.histogram(chunk[col].dropna().to_numpy(dtype=float), bins=edges)[0]
+    return pd.Series((edges[:-1] + edges[1:]) / 2), edges, counts
+
+
+def _chunked_bar_data(source, x, y, agg):
+    limit = settings.CHART_MAX_CATEGORIES
+    if agg:
+        funcs = [agg] if agg != 'mean' else ['mean', 'sum', 'count']
+        grouped, _ = aggregate_chunks(source.iter_chunks([x, y]), [x], [{'column': y, 'func': f} for f in funcs])
+        grouped = grouped.set_index(x)
+        values = grouped[f'{y}_{agg}'].rename(y)
+        other = None
+        if len(values) > limit and agg == 'mean':
+            rest = grouped.loc[~grouped.index.isin(values.sort_values(ascending=False, kind='stable').index[:limit])]
+            other = rest[f'{y}_sum'].sum() / rest[f'{y}_count'].sum()
+        return top_n_with_other(values, limit, other).rename_axis(x).reset_index()
+    if x == y:
+        return source.sample[[x]]
+    # One bar per row: the largest rows across all chunks, with the rest summed
+    plan = validate_plan({'select': [x, y], 'sort': [{'column': y, 'desc': True}], 'limit': limit}, source)
+    top, _ = execute_plan(plan, source)
+    total, _ = aggregate_chunks(source.iter_chunks([y]), [], [{'column': y, 'func': 'sum'}])
+    data = top.set_index(x)[y]
+    rest = total[f'{y}_sum'].iloc[0] - data.sum()
+    if len(source) > limit:
+        data = pd.concat([data, pd.Series({OTHER_LABEL: rest})])
+    return data.rename(y).rename_axis(x).reset_index()
+
+
+def build_sample_payload(profile):
+    """Bar chart of the first rows of the first numeric column, shown with the initial analysis."""
+    numeric_cols = [column['name'] for column in profile['columns'] if 'mean' in column]
+    if len(numeric_cols) == 0:
+        return None
+    col = numeric_cols[0]
+    data = preview_frame(profile, PREVIEW_ROWS)[col]
+    return {'kind': 'bar', 'data': data, 'title': f"Sample of {col} Data", 'options': {}}
+
+
+def draw_png(payload) -> bytes:
+    """Draw a payload on a private Figure and return PNG bytes. Runs in renderer processes."""
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+
+    fig = Figure(figsize=FIGSIZE)
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot()
+    payload['data'].plot(kind=payload['kind'], ax=ax, **payload['options'])
+    ax.set_title(payload['title'])
+    buffer = BytesIO()
+    fig.savefig(buffer, format='png')
+    return buffer.getvalue()
+
+
+def _warm_renderer(pids=None):
+    # Report this renderer's PID so a hung one can be killed, then import matplotlib/pandas
+    # plotting and build the font cache once per process
+    if pids is not None:
+        pids.put(os.getpid())
+    import matplotlib
+    matplotlib.use('Agg')
+    import pandas as pd
+    from matplotlib import font_manager
+    font_manager.fontManager.findfont('DejaVu Sans')
+    draw_png({'kind': 'bar', 'data': pd.Series([1, 2]), 'title': 'warmup', 'options': {}})
+
+
+class _RendererPool:
+    """A process pool whose renderers report their PIDs, so hung ones can be killed without executor internals."""
+
+    def __init__(self, workers: int):
+        # spawn: the web process is multi-threaded, so forking it is not safe
+        context = multiprocessing.get_context('spawn')
+        self._reported = context.SimpleQueue()
+        self._pids = set()
+        self._lock = threading.Lock()
+        self.executor = ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=context,
+            initializer=_warm_renderer,
+            initargs=(self._reported,),
+        )
+
+    def submit(self, fn, *args):
+        return self.executor.submit(fn, *args)
+
+    def worker_pids(self) -> set:
+        """PIDs of the renderers started so far."""
+        with self._lock:
+            while not self._reported.empty():
+                self._pids.add(self._reported.get())
+            return set(self._pids)
+
+    def shutdown(self, terminate=False):
+        """Stop accepting work; ``terminate`` also kills the renderers, including one stuck in a render."""
+        pids = self.worker_pids() if terminate else ()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = _RendererPool(settings.CHART_RENDER_WORKERS)
+        return _pool
+
+
+def warm_pool():
+    """Start every renderer now, so the first renders don't pay for process spawn and imports."""
+    if settings.CHART_RENDER_WORKERS <= 0:
+        _warm_renderer()
+        return
+    pool = _get_pool()
+    # Submitted together, each task finds no idle worker and starts a new one
+    for future in [pool.submit(os.getpid) for _ in range(settings.CHART_RENDER_WORKERS)]:
+        future.result()
+
+
+def _reset_pool(broken, terminate=False):
+    """Drop ``broken`` so the next render starts a fresh pool; ``terminate`` also kills its workers."""
+    global _pool
+    with _pool_lock:
+        if _pool is broken:
+            _pool = None
+    broken.shutdown(terminate=terminate)
+
+
+def render_png(payload):
+    """Render a payload to PNG bytes in the renderer pool, or None on failure or timeout."""
+    if payload is None:
+        return None
+    if settings.CHART_RENDER_WORKERS <= 0:
+        try:
+            return draw_png(payload)
+        except Exception as e:
+            logger.warning(f"Chart render failed: {e!r}")
+            return None
+    pool = _get_pool()
+    try:
+        return pool.submit(draw_png, payload).result(timeout=settings.CHART_RENDER_TIMEOUT)
+    except FutureTimeoutError:
+        # A hung render keeps its worker busy; left alone, enough of them would take every slot
+        logger.warning(f"Chart render timed out after {settings.CHART_RENDER_TIMEOUT}s; restarting the renderer pool")
+        _reset_pool(pool, terminate=True)
+    except BrokenProcessPool:
+        logger.warning("Chart renderer pool died; restarting it")
+        _reset_pool(pool)
+    except Exception as e:
+        logger.warning(f"Chart render failed: {e!r}")
+    return None
+
+
+# Rendered charts are stored once under their content hash; messages keep only the key
+CHART_DIR = 'charts'
+
+
+def _chart_name(key: str) -> str:
+    return f'{CHART_DIR}/{key[:2]}/{key}.png'
+
+
+def store_chart_png(image_png: bytes, created: set = None) -> str:
+    """Store PNG bytes in content-addressed storage and return their key (sha256 hex).
+
+    Keys of files written by this call (not already stored) are added to ``created``.
+    """
+    key = hashlib.sha256(image_png).hexdigest()
+    name = _chart_name(key)
+    if not default_storage.exists(name):
+        default_storage.save(name, ContentFile(image_png))
+        if created is not None:
+            created.add(key)
+    return key
+
+
+def store_chart_base64(chart_b64, created: set = None):
+    """Store a legacy base64-encoded chart, returning its key or None."""
+    if not chart_b64:
+        return None
+    return store_chart_png(base64.b64decode(chart_b64), created)
+
+
+def open_chart(key: str):
+    return default_storage.open(_chart_name(key), 'rb')
+
+
+def delete_chart(key: str):
+    default_storage.delete(_chart_name(key))
+
+
+def render_and_store(payload):
+    image_png = render_png(payload)
+    return store_chart_png(image_png) if image_png else None
+
+
+class ChartMemo:
+    """Per-process LRU map from (dataset content hash, normalized spec) to a stored chart key."""
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            chart_key = self._entries.get(key)
+            if chart_key is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return chart_key
+
+    def put(self, key, chart_key):
+        with self._lock:
+            self._entries[key] = chart_key
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'entries': len(self._entries), 'hits': self.hits, 'misses': self.misses}
+
+
+chart_memo = ChartMemo(settings.CHART_MEMO_MAX_ENTRIES)
+
+
+def _memoized_render(memo_key, build_payload):
+    # On a hit the stored PNG is reused without touching pandas or matplotlib
+    if memo_key is not None:
+        chart_key = chart_memo.get(memo_key)
+        if chart_key and default_storage.exists(_chart_name(chart_key)):
+            return chart_key
+    try:
+        with timed('pandas'):
+            payload = build_payload()
+    except Exception as e:
+        logger.warning(f"Could not prepare chart data: {e!r}")
+        return None
+    with timed('render'):
+        chart_key = render_and_store(payload)
+    if memo_key is not None and chart_key:
+        chart_memo.put(memo_key, chart_key)
+    return chart_key
+
+
+def render_spec_chart(spec, df, content_hash=None, profile=None):
+    """Render a chart spec inferred from a question and return its stored chart key, or None.
+
+    Pass the dataset's ``content_hash`` to reuse an earlier render of the same spec.
+    """
+    spec = normalize_spec(spec)
+    if spec is None:
+        return None
+    memo_key = (content_hash, json.dumps(spec, sort_keys=True)) if content_hash else None
+    return _memoized_render(memo_key, lambda: build_spec_payload(spec, df, profile))
+
+
+def render_sample_chart(profile, content_hash=None):
+    memo_key = (content_hash, 'sample') if content_hash else None
+    return _memoized_render(memo_key, lambda: build_sample_payload(profile))
+
+
+# Chart data delivery: the browser draws the chart from a few hundred numbers
+def _number(value):
+    if value is None or pd.isna(value):
+        return None
+    if isinstance(value, (int, np.integer)):
+        return int(value)
+    return float(f'{float(value):.6g}')
+
+
+def _numbers(values):
+    return [_number(v) for v in values]
+
+
+def _labels(values):
+    if pd.api.types.is_datetime64_any_dtype(values):
+        return [None if pd.isna(v) else v.isoformat() for v in values]
+    if pd.api.types.is_numeric_dtype(values):
+        return _numbers(values)
+    return [None if pd.isna(v) else str(v) for v in values]
+
+
+def _box_stats(values):
+    values = values.dropna()
+    if values.empty:
+        return None
+    q1, med, q3 = values.quantile([0.25, 0.5, 0.75])
+    iqr = q3 - q1
+    inside = values[(values >= q1 - 1.5 * iqr) & (values <= q3 + 1.5 * iqr)]
+    return {
+        'whislo': _number(inside.min()), 'q1': _number(q1), 'med': _number(med),
+        'q3': _number(q3), 'whishi': _number(inside.max()),
+    }
+
+
+def chart_data(payload):
+    """Compact JSON form of a plot payload for client-side drawing, or None if there is nothing to draw."""
+    if payload is None:
+        return None
+    kind = payload['kind']
+    data = payload['data']
+    options = payload['options']
+    chart = {'kind': kind, 'title': payload['title']}
+    max_points = settings.CHART_DATA_MAX_POINTS
+    if kind == 'hist':
+        if 'weights' in options:
+            edges, counts = np.asarray(options['bins']), np.asarray(options['weights'])
+        else:
+            values = data.dropna().to_numpy(dtype=float)
+            counts, edges = np.histogram(values[np.isfinite(values)], bins=options.get('bins', 20))
+        chart.update({'edges': _numbers(edges), 'counts': counts.tolist()})
+    elif kind == 'box':
+        column = data.columns[0]
+        chart.update({'label': str(column), 'stats': _box_stats(data[column])})
+        if chart['stats'] is None:
+            return None
+    elif isinstance(data, pd.Series):
+        # pie counts and the sample bar: labels from the index
+        chart.update({'labels': _labels(data.index), 'values': _numbers(data.to_numpy())})
+    else:
+        x, y = options['x'], options['y']
+        if kind == 'line':
+            data = downsample_line(data, x, y, max_points)
+        elif kind == 'scatter':
+            data = sample_scatter(data, x, max_points)
+        chart.update({'x': _labels(data[x]), 'y': _numbers(data[y]), 'x_label': str(x), 'y_label': str(y)})
+    return chart
+
+
+def _spec_chart_data(spec, df, profile=None):
+    try:
+        with timed('pandas'):
+            return chart_data(build_spec_payload(spec, df, profile))
+    except Exception as e:
+        logger.warning(f"Could not prepare chart data: {e!r}")
+        return None
+
+
+def spec_chart_fields(spec, df, content_hash=None, profile=None) -> dict:
+    """``ChatMessage`` chart fields for a question's chart spec, per ``CHART_DELIVERY``."""
+    if settings.CHART_DELIVERY == 'data':
+        return {'chart_data': _spec_chart_data(spec, df, profile)}
+    return {'chart_key': render_spec_chart(spec, df, content_hash, profile)}
+
+
+def sample_chart_fields(profile, content_hash=None) -> dict:
+    """``ChatMessage`` chart fields for the sample chart shown with an upload's analysis."""
+    if settings.CHART_DELIVERY == 'data':
+        with timed('pandas'):
+            return {'chart_data': chart_data(build_sample_payload(profile))}
+    return {'chart_key': render_sample_chart(profile, content_hash)}
@@ -0,0 +1,429 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+from django.conf import settings
+
+from .dtypes import parse_schema_dates, read_csv_options
+from .ingest import CSVValidationError
+from .metrics import timed
+
+logger = logging.getLogger(__name__)
+
+
+class DataFrameCache:
+    """Per-process LRU cache of parsed dataset frames, bounded by memory size.
+
+    Entries are keyed by content hash (``DataSet.id`` for rows without one)
+    and validated against the file's (mtime, size) signature so a replaced
+    file is never served stale.
+    Cached frames are shared between requests and must not be mutated.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # key -> (signature, df, nbytes)
+        self._lock = threading.Lock()
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, signature):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != signature:
+                if entry is not None:
+                    self._remove(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, signature, df):
+        nbytes = int(df.memory_usage(deep=True).sum())
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            if nbytes > self.max_bytes:
+                # Too large to ever fit; caching it would just flush everything else
+                return
+            self._entries[key] = (signature, df, nbytes)
+            self.current_bytes += nbytes
+            while self.current_bytes > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self.current_bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+    def _remove(self, key):
+        _, _, nbytes = self._entries.pop(key)
+        self.current_bytes -= nbytes
+
+
+dataframe_cache = DataFrameCache(settings.DATAFRAME_CACHE_MAX_BYTES)
+
+
+def _file_signature(path):
+    st = os.stat(path)
+    return (st.st_mtime_ns, st.st_size)
+
+
+# Columnar sidecar: one .npy per column next to the CSV, loaded memory-mapped.
+# Numeric/bool/datetime columns map straight onto the page cache; string columns
+# are stored as int32 codes plus a fixed-width unicode table of unique values.
+SIDECAR_SUFFIX = '.cols'
+SIDECAR_VERSION = 1
+
+
+def sidecar_path(csv_path):
+    return csv_path + SIDECAR_SUFFIX
+
+
+def write_columns(directory, df):
+    """Write each column of ``df`` as ``.npy`` files in ``directory``.
+
+    Returns the manifest entries, or None if a column can't be stored.
+    """
+    columns = []
+    for i, name in enumerate(df.columns):
+        series = df[name]
+        entry = {'name': str(name), 'file': f'{i}.npy'}
+        if isinstance(series.dtype, pd.DatetimeTZDtype):
+            # Stored as naive UTC datetime64 (no pickled Timestamps) with the zone in the manifest
+            np.save(os.path.join(directory, entry['file']), series.dt.tz_convert('UTC').dt.tz_localize(None).to_numpy())
+            entry['kind'] = 'array'
+            entry['tz'] = str(series.dt.tz)
+        elif series.dtype.kind in 'biufcmM':
+            values = np.ascontiguousarray(series.to_numpy())
+            if values.dtype.hasobject:
+                return None
+            np.save(os.path.join(directory, entry['file']), values)
+            entry['kind'] = 'array'
+        elif isinstance(series.dtype, pd.CategoricalDtype):
+            if not all(isinstance(v, str) for v in series.cat.categories):
+                return None
+            np.save(os.path.join(directory, entry['file']), series.cat.codes.to_numpy().astype(np.int32))
+            entry['values'] = f'{i}.values.npy'
+            np.save(os.path.join(directory, entry['values']), np.asarray(series.cat.categories, dtype=str))
+            entry['kind'] = 'categories'
+        elif series.dtype == object:
+            codes, uniques = pd.factorize(series, use_na_sentinel=True)
+            if not all(isinstance(v, str) for v in uniques):
+                return None
+            np.save(os.path.join(directory, entry['file']), codes.astype(np.int32))
+            entry['values'] = f'{i}.values.npy'
+            np.save(os.path.join(directory, entry['values']), np.asarray(uniques, dtype=str))
+            entry['kind'] = 'strings'
+        else:
+            return None
+        columns.append(entry)
+    return columns
+
+
+def read_columns(directory, entries, names=None):
+    """Load columns written by ``write_columns`` memory-mapped, optionally only ``names``."""
+    data = {}
+    for entry in entries:
+        if names is not None and entry['name'] not in names:
+            continue
+        arr = np.load(os.path.join(directory, entry['file']), mmap_mode='r', allow_pickle=False)
+        if entry['kind'] == 'strings':
+            values = np.load(os.path.join(directory, entry['values']), allow_pickle=False).astype(object)
+            values = np.append(values, np.nan)  # code -1 (missing) indexes the trailing NaN
+            arr = values.take(arr)
+        elif entry['kind'] == 'categories':
+            categories = np.load(os.path.join(directory, entry['values']), allow_pickle=False).astype(object)
+            arr = pd.Categorical.from_codes(np.asarray(arr), categories=categories)
+        elif entry.get('tz'):
+            arr = pd.Series(arr).dt.tz_localize('UTC').dt.tz_convert(entry['tz'])
+        data[entry['name']] = arr
+    # copy=False keeps each mmapped column in its own block instead of consolidating
+    return pd.DataFrame(data, columns=list(data), copy=False)
+
+
+def write_columnar_sidecar(csv_path, df) -> bool:
+    """Write ``df`` as a columnar sidecar for ``csv_path``. Returns False if a column can't be stored."""
+    target = sidecar_path(csv_path)
+    tmp_dir = tempfile.mkdtemp(prefix='.cols-', dir=os.path.dirname(csv_path))
+    try:
+        columns = write_columns(tmp_dir, df)
+        if columns is None:
+            return False
+        manifest = {
+            'version': SIDECAR_VERSION,
+            'source': list(_file_signature(csv_path)),
+            'rows': len(df),
+            'columns': columns,
+        }
+        with open(os.path.join(tmp_dir, 'manifest.json'), 'w') as fh:
+            json.dump(manifest, fh)
+        if os.path.isdir(target):
+            shutil.rmtree(target, ignore_errors=True)
+        os.replace(tmp_dir, target)
+        tmp_dir = None
+        return True
+    finally:
+        if tmp_dir:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def read_columnar_sidecar(csv_path):
+    """Load the sidecar for ``csv_path`` memory-mapped, or return None if missing, stale or unreadable."""
+    target = sidecar_path(csv_path)
+    try:
+        with open(os.path.join(target, 'manifest.json')) as fh:
+            manifest = json.load(fh)
+    except (OSError, ValueError):
+        return None
+    if manifest.get('version') != SIDECAR_VERSION or tuple(manifest.get('source') or ()) != _file_signature(csv_path):
+        return None
+    try:
+        return read_columns(target, manifest['columns'])
+    except Exception as e:
+        # A damaged or unreadable sidecar only costs a re-parse of the CSV
+        logger.warning(f'Ignoring unreadable columnar sidecar {target}: {str(e)}')
+        return None
+
+
+# Partitioned store for datasets too large to parse into memory: the CSV is
+# ingested chunk by chunk into ``<csv>.parts/NNNNN/`` column files (same layout
+# as the sidecar) plus a bounded uniform row sample, and read back one
+# memory-mapped partition at a time.
+PARTS_SUFFIX = '.parts'
+PARTS_VERSION = 1
+SAMPLE_ROWS = 100000
+
+
+def parts_path(csv_path):
+    return csv_path + PARTS_SUFFIX
+
+
+# How read_csv spells booleans; a later chunk with any other value reads them back as strings
+_BOOL_STRINGS = {'True': True, 'TRUE': True, 'true': True, 'False': False, 'FALSE': False, 'false': False}
+
+
+def _schema_kind(series) -> str:
+    if series.dtype == bool:
+        return 'bool'
+    return 'text' if series.dtype == object else 'number'
+
+
+def _conform(chunk, schema, start=0):
+    """Coerce a chunk to the column kinds fixed by the first chunk, so partitions agree.
+
+    A value that a numeric or boolean column can't hold raises
+    ``CSVValidationError`` rather than becoming NaN; ``start`` is the chunk's
+    first row, for the message.
+    """
+    for name, kind in schema.items():
+        series = chunk[name]
+        if kind != 'text' and series.dtype == object:
+            if kind == 'bool':
+                coerced = series.map(lambda v: _BOOL_STRINGS.get(v, v) if isinstance(v, str) else v)
+                coerced = coerced.where(coerced.map(lambda v: isinstance(v, (bool, np.bool_))))
+            else:
+                coerced = pd.to_numeric(series, errors='coerce')
+            lost = coerced.isna() & series.notna()
+            if lost.any():
+                row = int(lost.to_numpy().argmax())
+                raise CSVValidationError(
+                    f"Column '{name}' is {'boolean' if kind == 'bool' else 'numeric'} in the first rows but has the "
+                    f"value {series.iloc[row]!r} on data row {start + row + 1:,}. "
+                    'Please make the column consistently numeric or text.'
+                )
+            if kind == 'bool':
+                coerced = coerced.astype(bool) if coerced.notna().all() else coerced.astype(float)
+            chunk[name] = coerced
+        elif kind == 'text' and series.dtype != object:
+            chunk[name] = series.astype(object).where(series.isna(), series.astype(str))
+        elif kind == 'text':
+            chunk[name] = series.where(series.isna(), series.astype(str))
+    return chunk
+
+
+def write_partitioned(csv_path, chunks, on_chunk=None):
+    """Ingest an iterable of DataFrame chunks into the partitioned store for ``csv_path``.
+
+    Memory stays bounded by one chunk plus the row sample. ``on_chunk`` sees
+    each chunk after coercion (e.g. to accumulate a profile). Returns the
+    opened ``PartitionedDataset``.
+    """
+    target = parts_path(csv_path)
+    tmp_dir = tempfile.mkdtemp(prefix='.parts-', dir=os.path.dirname(csv_path))
+    try:
+        schema = None
+        partitions = []
+        rows = 0
+        sample = None
+        rng = np.random.default_rng(0)
+        for chunk in chunks:
+            if schema is None:
+                schema = {name: _schema_kind(chunk[name]) for name in chunk.columns}
+            chunk = _conform(chunk.reset_index(drop=True), schema, rows)
+            if on_chunk is not None:
+                on_chunk(chunk)
+            name = f'{len(partitions):05d}'
+            os.mkdir(os.path.join(tmp_dir, name))
+            entries = write_columns(os.path.join(tmp_dir, name), chunk)
+            if entries is None:
+                raise ValueError('A column could not be stored.')
+            partitions.append({'dir': name, 'rows': len(chunk), 'columns': entries})
+            rows += len(chunk)
+            # Bottom-k on random keys keeps a uniform sample of everything seen so far
+            keyed = chunk.assign(_sample_key=rng.random(len(chunk)))
+            sample = keyed if sample is None else pd.concat([sample, keyed], ignore_index=True)
+            if len(sample) > SAMPLE_ROWS:
+                sample = sample.nsmallest(SAMPLE_ROWS, '_sample_key')
+        if schema is None:
+            raise ValueError('No rows to store.')
+        sample = sample.sort_index().drop(columns='_sample_key').reset_index(drop=True)
+        os.mkdir(os.path.join(tmp_dir, 'sample'))
+        manifest = {
+            'version': PARTS_VERSION,
+            'source': list(_file_signature(csv_path)),
+            'rows': rows,
+            'columns': list(schema),
+            'partitions': partitions,
+            'sample': write_columns(os.path.join(tmp_dir, 'sample'), sample),
+        }
+        with open(os.path.join(tmp_dir, 'manifest.json'), 'w') as fh:
+            json.dump(manifest, fh)
+        if os.path.isdir(target):
+            shutil.rmtree(target, ignore_errors=True)
+        os.replace(tmp_dir, target)
+        tmp_dir = None
+        return PartitionedDataset(target, manifest)
+    finally:
+        if tmp_dir:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+class PartitionedDataset:
+    """Read side of the partitioned store.
+
+    Exposes a frame's schema (``columns``, ``dtypes``, ``len()``) so code that
+    only inspects the schema works unchanged, but rows are only reachable
+    through ``iter_chunks`` (one partition at a time) or the bounded ``sample``.
+    """
+
+    def __init__(self, directory, manifest):
+        self.directory = directory
+        self.manifest = manifest
+        self.columns = pd.Index(manifest['columns'])
+        self._sample = None
+
+    @classmethod
+    def open(cls, csv_path):
+        """Open the store for ``csv_path``, or return None if missing or stale."""
+        target = parts_path(csv_path)
+        try:
+            with open(os.path.join(target, 'manifest.json')) as fh:
+                manifest = json.load(fh)
+        except (OSError, ValueError):
+            return None
+        if manifest.get('version') != PARTS_VERSION or tuple(manifest.get('source') or ()) != _file_signature(csv_path):
+            return None
+        return cls(target, manifest)
+
+    def __len__(self):
+        return self.manifest['rows']
+
+    @property
+    def sample(self):
+        if self._sample is None:
+            self._sample = read_columns(os.path.join(self.directory, 'sample'), self.manifest['sample'])
+        return self._sample
+
+    @property
+    def dtypes(self):
+        return self.sample.dtypes
+
+    def iter_chunks(self, columns=None):
+        names = None if columns is None else set(columns)
+        for part in self.manifest['partitions']:
+            yield read_columns(os.path.join(self.directory, part['dir']), part['columns'], names)
+
+
+def read_dataset_file(path, schema=None):
+    """Load a dataset CSV, preferring its sidecar; ``schema`` (from ``normalize_dtypes``) skips dtype inference."""
+    df = read_columnar_sidecar(path)
+    if df is None:
+        df = parse_schema_dates(pd.read_csv(path, **read_csv_options(schema)), schema) if schema else pd.read_csv(path)
+    return df
+
+
+def _cache_key(dataset):
+    # Datasets with identical content share one stored file, so they can share the parsed frame too
+    return dataset.content_hash or dataset.id
+
+
+def load_dataset_frame(dataset):
+    """Return the parsed frame for a DataSet, reusing the cached copy when the file is unchanged."""
+    path = dataset.file.path
+    signature = _file_signature(path)
+    df = dataframe_cache.get(_cache_key(dataset), signature)
+    if df is None:
+        with timed('parse'):
+            df = read_dataset_file(path, dataset.schema)
+        dataframe_cache.put(_cache_key(dataset), signature, df)
+    return df
+
+
+def remember_dataset_frame(dataset, df):
+    """Seed the cache with a frame that was already parsed for ``dataset`` (e.g. during upload)."""
+    dataframe_cache.put(_cache_key(dataset), _file_signature(dataset.file.path), df)
+
+
+def load_dataset_source(dataset):
+    """The frame for an in-memory dataset, or the ``PartitionedDataset`` for a large one."""
+    if dataset.layout == dataset.LAYOUT_PARTITIONED:
+        store = PartitionedDataset.open(dataset.file.path)
+        if store is None:
+            raise ValueError('The stored copy of this dataset is missing. Please upload the file again.')
+        return store
+    return load_dataset_frame(dataset)
+
+
+def file_sha256(fileobj, chunk_size: int = 1024 * 1024) -> str:
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: fileobj.read(chunk_size), b''):
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+def dataset_content_hash(dataset) -> str:
+    """Return the dataset's content hash, computing and saving it for rows that predate it."""
+    if not dataset.content_hash:
+        with dataset.file.open('rb') as fh:
+            dataset.content_hash = file_sha256(fh)
+        dataset.save(update_fields=['content_hash'])
+    return dataset.content_hash
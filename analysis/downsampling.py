@@ -0,0 +1,88 @@
+"""Reduce chart data to a bounded number of points before plotting.
+
+Render time and PNG size should not grow with the dataset, so every chart
+payload is cut down to what a 1000px-wide figure can show. All reductions are
+deterministic, so the same data and spec still render the same image (see
+``ChartMemo``).
+"""
+import numpy as np
+import pandas as pd
+
+OTHER_LABEL = 'Other'
+
+
+def lttb_indices(x, y, n_out: int):
+    """Largest-Triangle-Three-Buckets: positions of ``n_out`` points that preserve the line's shape.
+
+    ``x`` must be numeric and in plotting order; the first and last points are always kept.
+    """
+    n = len(y)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    # Bucket boundaries for the n - 2 interior points
+    edges = np.linspace(1, n - 1, n_out - 1).astype(int)
+    selected = np.empty(n_out, dtype=np.int64)
+    selected[0] = 0
+    selected[-1] = n - 1
+    a = 0
+    for i in range(n_out - 2):
+        start, end = edges[i], edges[i + 1]
+        # Average of the next bucket is the third vertex of the triangle
+        next_start, next_end = end, (edges[i + 2] if i + 2 < len(edges) else n)
+        avg_x = x[next_start:next_end].mean()
+        avg_y = y[next_start:next_end].mean()
+        area = np.abs(
+            (x[a] - avg_x) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (avg_y - y[a])
+        )
+        a = start + int(area.argmax())
+        selected[i + 1] = a
+    return selected
+
+
+def downsample_line(data, x, y, max_points: int):
+    """Keep at most ``max_points`` rows of a line plot's ``[x, y]`` frame."""
+    data = data.dropna(subset=[y])
+    if len(data) <= max_points:
+        return data
+    xs = data[x] if x != y else None
+    if xs is not None and pd.api.types.is_datetime64_any_dtype(xs):
+        positions = xs.astype('int64').to_numpy()
+    elif xs is not None and pd.api.types.is_numeric_dtype(xs):
+        positions = xs.to_numpy(dtype=float)
+    else:
+        positions = np.arange(len(data))
+    if not np.isfinite(positions).all():
+        positions = np.arange(len(data))
+    return data.iloc[lttb_indices(positions, data[y].to_numpy(dtype=float), max_points)]
+
+
+def sample_scatter(data, x, max_points: int, bins: int = 50):
+    """Stratified sample of a scatter's rows: an equal share per ``x`` bin, so sparse regions survive."""
+    if len(data) <= max_points:
+        return data
+    shuffled = data.sample(frac=1, random_state=0)
+    xs = shuffled[x]
+    if pd.api.types.is_numeric_dtype(xs) and xs.nunique() > bins:
+        strata = pd.cut(xs, bins=bins, labels=False)
+    else:
+        strata = xs
+    per_stratum = max(1, max_points // max(1, strata.nunique()))
+    sampled = shuffled.groupby(strata, sort=False, dropna=False, observed=True).head(per_stratum)
+    if len(sampled) > max_points:
+        sampled = sampled.head(max_points)
+    return sampled.sort_index()
+
+
+def top_n_with_other(counts, n: int, other=None):
+    """Largest ``n`` entries of a Series, with the rest folded into a single ``Other`` entry.
+
+    ``other`` is the value for the folded entry; by default the rest is summed.
+    """
+    if len(counts) <= n:
+        return counts
+    counts = counts.sort_values(ascending=False, kind='stable')
+    top = counts.iloc[:n]
+    rest = counts.iloc[n:].sum() if other is None else other
+    return pd.concat([top, pd.Series({OTHER_LABEL: rest}, name=counts.name)])
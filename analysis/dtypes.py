@@ -0,0 +1,87 @@
+"""Load-time dtype normalization for dataset frames.
+
+``pd.read_csv`` gives int64/float64 numerics and object strings. Normalizing
+downcasts numerics where no value changes, turns low-cardinality strings into
+``category`` and parses date-like columns once. The chosen schema is stored
+on the ``DataSet`` so later loads apply it directly instead of inferring again.
+"""
+import warnings
+
+import numpy as np
+import pandas as pd
+
+# Strings become categorical when distinct values are at most this share of rows
+CATEGORY_MAX_RATIO = 0.5
+# Object columns are tried as dates on a sample of this many values first
+DATE_SAMPLE_ROWS = 1000
+
+
+def _downcast_integer(series):
+    return pd.to_numeric(series, downcast='unsigned' if series.min() >= 0 else 'integer')
+
+
+def _downcast_float(series):
+    narrowed = series.astype(np.float32)
+    values = series.to_numpy()
+    # float32 only when every value survives the round trip
+    if np.array_equal(narrowed.to_numpy(dtype=np.float64), values, equal_nan=True):
+        return narrowed
+    return series
+
+
+def _to_datetime(series):
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        return pd.to_datetime(series, errors='coerce')
+
+
+def _parse_dates(series):
+    sample = series.dropna().head(DATE_SAMPLE_ROWS)
+    if sample.empty or not all(isinstance(v, str) for v in sample):
+        return None
+    if not _to_datetime(sample).notna().all():
+        return None
+    parsed = _to_datetime(series)
+    # Only when every value parses (to one dtype, not mixed offsets) is nothing lost,
+    # and only then does parse_schema_dates reproduce the column from the CSV
+    if not pd.api.types.is_datetime64_any_dtype(parsed) or parsed.notna().sum() != series.notna().sum():
+        return None
+    return parsed
+
+
+def normalize_dtypes(df):
+    """Return ``(normalized_df, schema)``; ``schema`` maps column names to dtype names for ``read_csv_options``."""
+    columns = {}
+    for name in df.columns:
+        series = df[name]
+        if pd.api.types.is_integer_dtype(series) and not pd.api.types.is_bool_dtype(series) and len(series):
+            series = _downcast_integer(series)
+        elif pd.api.types.is_float_dtype(series):
+            series = _downcast_float(series)
+        elif series.dtype == object:
+            parsed = _parse_dates(series)
+            if parsed is not None:
+                series = parsed
+            elif series.nunique(dropna=True) <= CATEGORY_MAX_RATIO * len(series):
+                series = series.astype('category')
+        columns[name] = series
+    normalized = pd.DataFrame(columns, index=df.index)
+    return normalized, {str(name): str(dtype) for name, dtype in normalized.dtypes.items()}
+
+
+def read_csv_options(schema) -> dict:
+    """``pd.read_csv`` keyword arguments that load a CSV straight into ``schema``; dates follow in ``parse_schema_dates``."""
+    return {'dtype': {name: dtype for name, dtype in schema.items() if not dtype.startswith('datetime64')}}
+
+
+def parse_schema_dates(df, schema):
+    """Convert the date columns of a frame read with ``read_csv_options`` the same way ``normalize_dtypes`` did."""
+    for name, dtype in schema.items():
+        if dtype.startswith('datetime64') and name in df.columns:
+            df[name] = _to_datetime(df[name])
+    return df
+
+
+def widened(series):
+    """``series`` with float32 upcast to float64, so aggregates over downcast columns keep full precision."""
+    return series.astype(np.float64) if series.dtype == np.float32 else series
@@ -0,0 +1,69 @@
+import pandas as pd
+
+MAX_ROWS = 100000
+MAX_COLUMNS = 100
+CHUNK_ROWS = 20000
+# Large (partitioned) datasets: wider files allowed, and bigger chunks so partitions stay few
+LARGE_MAX_COLUMNS = 500
+PARTITION_ROWS = 100000
+
+
+class CSVValidationError(Exception):
+    """Raised when an uploaded CSV is readable but fails the upload limits."""
+
+
+class CSVTooLarge(CSVValidationError):
+    """The CSV is valid but has more rows than fit the in-memory limit."""
+
+
+def iter_validated_chunks(fileobj, max_columns: int = MAX_COLUMNS, chunksize: int = CHUNK_ROWS):
+    """Yield an uploaded CSV in parsed chunks, enforcing the limits that don't depend on its length.
+
+    The header is checked before any rows are parsed and the numeric-column
+    requirement is decided on the first chunk (a column that is non-numeric
+    there stays non-numeric once the chunks are combined).
+    """
+    header = pd.read_csv(fileobj, nrows=0)
+    if len(header.columns) > max_columns:
+        raise CSVValidationError(
+            f'CSV file has too many columns ({len(header.columns):,}). Please upload a file with fewer than {max_columns:,} columns.'
+        )
+    fileobj.seek(0)
+
+    seen_rows = False
+    with pd.read_csv(fileobj, chunksize=chunksize) as reader:
+        for chunk in reader:
+            if not len(chunk):
+                continue
+            if not seen_rows and chunk.select_dtypes(include=['number']).empty:
+                raise CSVValidationError(
+                    'CSV file must contain at least some numeric data for analysis. Please upload a file with numeric columns.'
+                )
+            seen_rows = True
+            yield chunk
+    if not seen_rows:
+        raise CSVValidationError('CSV file appears to be empty or contains no data rows.')
+
+
+def read_validated_csv(fileobj, max_rows: int = MAX_ROWS, max_columns: int = MAX_COLUMNS, chunksize: int = CHUNK_ROWS):
+    """Parse an uploaded CSV exactly once, enforcing the upload limits as it streams.
+
+    Parsing stops as soon as the row limit is crossed (``CSVTooLarge``).
+    Returns the full validated DataFrame.
+    """
+    chunks = []
+    total_rows = 0
+    for chunk in iter_validated_chunks(fileobj, max_columns, chunksize):
+        total_rows += len(chunk)
+        if total_rows > max_rows:
+            raise CSVTooLarge(
+                f'CSV file has too many rows (more than {max_rows:,}). Please upload a file with fewer than {max_rows:,} rows.'
+            )
+        chunks.append(chunk)
+
+    df = pd.concat(chunks, ignore_index=True) if len(chunks) > 1 else chunks[0]
+    if df.select_dtypes(include=['number']).empty:
+        raise CSVValidationError(
+            'CSV file must contain at least some numeric data for analysis. Please upload a file with numeric columns.'
+        )
+    return df
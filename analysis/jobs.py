@@ -0,0 +1,326 @@
+import logging
+import threading
+from datetime import timedelta
+
+import pandas as pd
+from django.conf import settings
+from django.db import connections
+from django.db.models import Q
+from django.utils import timezone
+
+from .charts import sample_chart_fields
+from .dataframes import file_sha256, remember_dataset_frame, write_columnar_sidecar, write_partitioned
+from .dtypes import normalize_dtypes
+from .ingest import (
+    LARGE_MAX_COLUMNS, PARTITION_ROWS, CSVTooLarge, CSVValidationError, iter_validated_chunks, read_validated_csv,
+)
+from .metrics import timed
+from .models import AnalysisJob, ChatMessage, DataSet
+from .profiling import ProfileAccumulator, build_profile
+from .utils import analyze_upload
+
+logger = logging.getLogger(__name__)
+
+
+class UploadRejected(Exception):
+    """The stored upload failed validation; the message is shown to the user as-is."""
+
+
+def enqueue_upload_analysis(user, chat, dataset, claim: bool = False) -> AnalysisJob:
+    """Queue an upload's analysis for the worker, or with ``claim`` create it already claimed by the caller.
+
+    A claimed job is never handed to ``claim_next_job``, so a worker cannot run
+    it a second time while the request runs it inline.
+    """
+    if not claim:
+        return AnalysisJob.objects.create(user=user, chat=chat, dataset=dataset)
+    now = timezone.now()
+    return AnalysisJob.objects.create(
+        user=user,
+        chat=chat,
+        dataset=dataset,
+        status=AnalysisJob.STATUS_RUNNING,
+        attempts=1,
+        started_at=now,
+        heartbeat_at=now,
+    )
+
+
+def find_reusable_upload(user, content_hash):
+    """The latest finished analysis of identical content that ``user`` may reuse, or None."""
+    scope = settings.UPLOAD_DEDUP_SCOPE
+    if scope == 'none' or not content_hash:
+        return None
+    jobs = AnalysisJob.objects.filter(
+        status=AnalysisJob.STATUS_DONE,
+        dataset__content_hash=content_hash,
+        dataset__profile__isnull=False,
+        message__isnull=False,
+    ).select_related('dataset', 'message', 'chat')
+    if scope == 'user':
+        jobs = jobs.filter(user=user)
+    source = jobs.order_by('-finished_at').first()
+    if source is None or not source.dataset.file.storage.exists(source.dataset.file.name):
+        return None
+    return source
+
+
+def reuse_upload_analysis(user, chat, name: str, content_hash: str):
+    """Finish an upload of already analysed content without storing, parsing or calling the LLM.
+
+    The new ``DataSet`` points at the existing file (and so its columnar copy
+    or partitions) and copies its profile and schema; the chat gets the
+    stored analysis and chart. Returns the finished job, or None when there
+    is nothing to reuse.
+    """
+    source = find_reusable_upload(user, content_hash)
+    if source is None:
+        return None
+    original = source.dataset
+    dataset = DataSet.objects.create(
+        user=user,
+        name=name,
+        file=original.file.name,
+        content_hash=content_hash,
+        profile=original.profile,
+        layout=original.layout,
+        schema=original.schema,
+    )
+    message = ChatMessage.objects.create(
+        chat=chat,
+        type='analysis',
+        content=source.message.content,
+        response=None,
+        **_reused_chart_fields(source.message, original.profile, content_hash),
+    )
+    chat.last_dataset = dataset
+    # The generated title can carry the original file name; only reuse it for the same user
+    chat.title = source.chat.title if source.user_id == user.id else name or chat.title
+    chat.record_messages([message], update_fields=['last_dataset', 'title'])
+    now = timezone.now()
+    return AnalysisJob.objects.create(
+        user=user,
+        chat=chat,
+        dataset=dataset,
+        status=AnalysisJob.STATUS_DONE,
+        message=message,
+        started_at=now,
+        finished_at=now,
+    )
+
+
+def _reused_chart_fields(message, profile, content_hash):
+    # Reuse the stored chart when it matches the current delivery mode; otherwise
+    # derive it from the profile (no LLM call either way)
+    if settings.CHART_DELIVERY == 'data':
+        if message.chart_data:
+            return {'chart_data': message.chart_data}
+    elif message.chart_key:
+        return {'chart_key': message.chart_key}
+    return sample_chart_fields(profile, content_hash)
+
+
+def claim_next_job():
+    """Atomically move the oldest pending job to running. Safe across worker processes."""
+    for job in AnalysisJob.objects.filter(status=AnalysisJob.STATUS_PENDING).order_by('created_at')[:10]:
+        now = timezone.now()
+        claimed = AnalysisJob.objects.filter(id=job.id, status=AnalysisJob.STATUS_PENDING).update(
+            status=AnalysisJob.STATUS_RUNNING,
+            started_at=now,
+            heartbeat_at=now,
+            attempts=job.attempts + 1,
+        )
+        if claimed:
+            job.refresh_from_db()
+            return job
+    return None
+
+
+def requeue_stale_jobs(stale_after: timedelta) -> int:
+    """Put running jobs whose worker stopped renewing the heartbeat back in the queue.
+
+    Jobs already claimed ``ANALYSIS_JOB_MAX_ATTEMPTS`` times (e.g. because they
+    crash their worker) are marked failed instead. Returns the number requeued.
+    """
+    now = timezone.now()
+    cutoff = now - stale_after
+    stale = AnalysisJob.objects.filter(status=AnalysisJob.STATUS_RUNNING).filter(
+        Q(heartbeat_at__lt=cutoff) | Q(heartbeat_at__isnull=True, started_at__lt=cutoff)
+    )
+    stale.filter(attempts__gte=settings.ANALYSIS_JOB_MAX_ATTEMPTS).update(
+        status=AnalysisJob.STATUS_FAILED,
+        error='Analysis did not finish. Please upload the file again.',
+        finished_at=now,
+    )
+    return stale.update(status=AnalysisJob.STATUS_PENDING)
+
+
+def _held(job):
+    # The job's row as long as this claim (attempt) still owns it and it hasn't finished
+    return AnalysisJob.objects.filter(
+        id=job.id,
+        attempts=job.attempts,
+        status__in=[AnalysisJob.STATUS_PENDING, AnalysisJob.STATUS_RUNNING],
+    )
+
+
+class _Heartbeat:
+    """Renews ``job.heartbeat_at`` from a background thread while the job runs.
+
+    ``lost`` turns True if the job was requeued and claimed again (or finished)
+    elsewhere, so this run must not record its outcome.
+    """
+
+    def __init__(self, job: AnalysisJob):
+        self.job = job
+        self.lost = False
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=f'job-{job.id}-heartbeat', daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        return False
+
+    def beat(self):
+        renewed = _held(self.job).update(heartbeat_at=timezone.now())
+        if not renewed:
+            self.lost = True
+
+    def _run(self):
+        try:
+            while not self._stop.wait(settings.ANALYSIS_JOB_HEARTBEAT):
+                try:
+                    self.beat()
+                except Exception as e:
+                    logger.warning(f"Could not renew heartbeat of job {self.job.id}: {str(e)}")
+        finally:
+            connections.close_all()
+
+
+def run_job(job: AnalysisJob):
+    """Execute a claimed job and record its outcome on the row."""
+    with _Heartbeat(job) as heartbeat:
+        try:
+            job.message = _run_upload_analysis(job, heartbeat)
+            job.status = AnalysisJob.STATUS_DONE
+            job.error = None
+        except UploadRejected as e:
+            job.status = AnalysisJob.STATUS_FAILED
+            job.error = str(e)
+        except _ClaimLost:
+            pass
+        except Exception as e:
+            logger.error(f"Error processing upload job {job.id}: {str(e)}")
+            job.status = AnalysisJob.STATUS_FAILED
+            job.error = str(e)
+    job.finished_at = timezone.now()
+    # Record the outcome only while this run still holds the job
+    recorded = not heartbeat.lost and _held(job).update(
+        status=job.status, error=job.error, message=job.message, finished_at=job.finished_at,
+    )
+    if not recorded:
+        logger.warning(f"Job {job.id} was taken over by another worker; discarding this run's outcome")
+    return job
+
+
+def _read_upload(dataset):
+    """Parse a stored upload into a DataFrame, or into the partitioned store if it is too large for memory."""
+    large_enabled = settings.LARGE_DATASET_MAX_BYTES > 0
+    try:
+        if large_enabled and dataset.file.size > settings.DATASET_MAX_BYTES:
+            return _ingest_partitioned(dataset)
+        try:
+            with dataset.file.open('rb') as fh, timed('parse'):
+                return read_validated_csv(fh)
+        except CSVTooLarge:
+            if not large_enabled:
+                raise
+            return _ingest_partitioned(dataset)
+    except CSVValidationError as e:
+        raise UploadRejected(str(e))
+    except UnicodeDecodeError:
+        raise UploadRejected('CSV file encoding error. Please ensure the file is saved with UTF-8 encoding.')
+    except Exception as e:
+        raise UploadRejected(f'Error reading CSV file: {str(e)}. Please ensure the file is a valid CSV format.')
+
+
+def _ingest_partitioned(dataset):
+    # One streaming pass writes the partitions and accumulates the profile; a second
+    # pass over the memory-mapped partitions fills in exact histograms
+    accumulator = ProfileAccumulator()
+    with dataset.file.open('rb') as fh, timed('parse'):
+        chunks = iter_validated_chunks(fh, LARGE_MAX_COLUMNS, PARTITION_ROWS)
+        store = write_partitioned(dataset.file.path, chunks, on_chunk=accumulator.update)
+        dataset.profile = accumulator.finish(store.sample, store.iter_chunks())
+    dataset.layout = DataSet.LAYOUT_PARTITIONED
+    return store
+
+
+class _ClaimLost(Exception):
+    """Another worker took the job over; stop before writing results twice."""
+
+
+def _run_upload_analysis(job: AnalysisJob, heartbeat=None) -> ChatMessage:
+    dataset = job.dataset
+    chat = job.chat
+    if dataset is None:
+        raise UploadRejected('The uploaded dataset no longer exists.')
+
+    try:
+        source = _read_upload(dataset)
+    except UploadRejected:
+        # Rejected uploads leave nothing behind
+        job.dataset = None
+        dataset.file.delete(save=False)
+        dataset.delete()
+        raise
+
+    # Hash and profile once; prompts, charts and previews read the profile instead of the rows
+    if not dataset.content_hash:
+        with dataset.file.open('rb') as fh:
+            dataset.content_hash = file_sha256(fh)
+    if isinstance(source, pd.DataFrame):
+        with timed('pandas'):
+            raw_bytes = int(source.memory_usage(deep=True).sum())
+            source, dataset.schema = normalize_dtypes(source)
+            dataset.profile = build_profile(source)
+            # memory_bytes is the normalized frame; keep the parser's footprint for comparison
+            dataset.profile['memory_bytes_raw'] = raw_bytes
+        # Store the validated frame once in columnar form for memory-mapped reloads
+        try:
+            write_columnar_sidecar(dataset.file.path, source)
+        except Exception as e:
+            logger.warning(f"Could not write columnar sidecar for dataset {dataset.id}: {str(e)}")
+        # Warm the cache for follow-up questions with the frame parsed during validation
+        remember_dataset_frame(dataset, source)
+    profile = dataset.profile
+    dataset.save(update_fields=['content_hash', 'profile', 'layout', 'schema'])
+
+    chat.last_dataset = dataset
+    chat.save(update_fields=['last_dataset', 'updated_at'])
+    # Initial analysis and chat title are independent; fetch them concurrently
+    gpt_response, ai_title = analyze_upload(profile, dataset.file.name or dataset.name)
+
+    # Confirm the claim before writing results, in case the job was requeued and taken over
+    if heartbeat is not None:
+        heartbeat.beat()
+        if heartbeat.lost:
+            raise _ClaimLost()
+    message = ChatMessage.objects.create(
+        chat=chat,
+        type='analysis',
+        content=gpt_response,
+        response=None,
+        **sample_chart_fields(profile, dataset.content_hash),
+    )
+
+    # Apply the AI title generated alongside the analysis
+    chat.title = ai_title or dataset.name or chat.title
+    chat.record_messages([message], update_fields=['title'])
+    return message
+
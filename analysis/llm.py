@@ -0,0 +1,287 @@
+"""LLM backends and the per-process client that calls them.
+
+``llm_client`` is what the rest of the app talks to. It picks a backend from
+``LLM_BACKEND`` on first use and wraps every call with:
+
+- a per-process semaphore (``LLM_MAX_CONCURRENCY``), so a burst of requests
+  queues for a slot instead of piling onto the provider;
+- retries with full-jitter exponential backoff on rate limits, timeouts,
+  connection errors and 5xx responses, honouring ``Retry-After``;
+- a shared cool-down: after a 429 every caller in the process waits out the
+  provider's delay instead of retrying into it.
+
+All of it is bounded by ``LLM_CALL_TIMEOUT`` per call. Backends only know how
+to make a single attempt.
+"""
+import json
+import random
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+import httpx
+import openai
+from django.conf import settings
+
+RETRYABLE_ERRORS = (openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError)
+
+
+class LLMUnavailable(Exception):
+    """The provider stayed rate-limited or unreachable for the whole call deadline."""
+
+
+class OpenAIBackend:
+    """Chat completions through the OpenAI SDK over a pooled, keep-alive HTTP client."""
+
+    def __init__(self, client):
+        self.client = client
+
+    @classmethod
+    def from_settings(cls):
+        http_client = httpx.Client(
+            limits=httpx.Limits(
+                max_connections=settings.LLM_HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=settings.LLM_HTTP_MAX_CONNECTIONS,
+            ),
+            timeout=httpx.Timeout(settings.LLM_REQUEST_TIMEOUT, connect=5.0),
+        )
+        # Retries are handled by LLMClient so they share its deadline and cool-down
+        return cls(openai.OpenAI(
+            api_key=settings.OPENAI_API_KEY,
+            http_client=http_client,
+            max_retries=0,
+            timeout=settings.LLM_REQUEST_TIMEOUT,
+        ))
+
+    def complete(self, model, messages, max_tokens, temperature) -> str:
+        response = self.client.chat.completions.create(
+            model=model, messages=messages, max_tokens=max_tokens, temperature=temperature,
+        )
+        return response.choices[0].message.content
+
+    def stream(self, model, messages, max_tokens, temperature):
+        # The request is sent here, so connection errors and 429s surface before the first delta
+        stream = self.client.chat.completions.create(
+            model=model, messages=messages, max_tokens=max_tokens, temperature=temperature, stream=True,
+        )
+        return (chunk.choices[0].delta.content for chunk in stream if chunk.choices and chunk.choices[0].delta.content)
+
+
+_PROFILE_COLUMN = re.compile(r'^- (?P<name>.+) \((?P<dtype>[^()]+)\): (?P<stats>.*)$', re.MULTILINE)
+_NUMERIC_DTYPE = re.compile(r'^(u?int|float)')
+
+
+class LocalBackend:
+    """Deterministic offline stand-in for tests and load runs; no network, no API key.
+
+    Replies are derived from the prompt alone: query plans and chart specs
+    group the first categorical column (or one named in the question) and sum
+    the first numeric one, titles come from the file name and answers restate
+    the computed result. ``latency`` seconds are slept per call.
+    """
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+
+    def complete(self, model, messages, max_tokens, temperature) -> str:
+        if self.latency:
+            time.sleep(self.latency)
+        system, prompt = messages[0]['content'], messages[-1]['content']
+        if 'query plans' in system:
+            return self._query_plan(prompt)
+        if 'JSON specs' in system:
+            return self._chart_spec(prompt)
+        if 'titles' in system:
+            return self._title(prompt)
+        return self._analysis(prompt)
+
+    def stream(self, model, messages, max_tokens, temperature):
+        text = self.complete(model, messages, max_tokens, temperature)
+        return iter(re.findall(r'\S+\s*', text))
+
+    @staticmethod
+    def _columns(prompt):
+        question = re.search(r'^Question: (.*)$', prompt, re.MULTILINE)
+        question = question.group(1).lower() if question else ''
+        numeric, categorical = [], []
+        for match in _PROFILE_COLUMN.finditer(prompt):
+            name, dtype = match.group('name'), match.group('dtype')
+            if dtype == 'bool':
+                continue
+            if _NUMERIC_DTYPE.match(dtype):
+                numeric.append(name)
+            elif not dtype.startswith('datetime'):
+                categorical.append(name)
+        # Prefer columns the question mentions
+        numeric.sort(key=lambda name: name.lower() not in question)
+        categorical.sort(key=lambda name: name.lower() not in question)
+        return numeric, categorical
+
+    def _query_plan(self, prompt):
+        numeric, categorical = self._columns(prompt)
+        if not numeric:
+            return json.dumps({'aggregate': [{'column': '*', 'func': 'count'}]})
+        value = numeric[0]
+        plan = {'aggregate': [{'column': value, 'func': 'sum'}]}
+        if categorical:
+            plan['groupby'] = [categorical[0]]
+            plan['sort'] = [{'column': f'{value}_sum', 'desc': True}]
+        return json.dumps(plan)
+
+    def _chart_spec(self, prompt):
+        numeric, categorical = self._columns(prompt)
+        if numeric and categorical:
+            return json.dumps({'type': 'bar', 'x': categorical[0], 'y': numeric[0], 'agg': 'sum', 'title': f'{numeric[0]} by {categorical[0]}'})
+        if numeric:
+            return json.dumps({'type': 'hist', 'x': numeric[0], 'title': f'Distribution of {numeric[0]}'})
+        return 'null'
+
+    @staticmethod
+    def _title(prompt):
+        match = re.search(r'^File name: (.*)$', prompt, re.MULTILINE)
+        stem = (match.group(1) if match else '').rsplit('/', 1)[-1].rsplit('.', 1)[0]
+        words = re.split(r'[\W_]+', stem)
+        return ' '.join(w.capitalize() for w in words if w)[:60] or 'Data Analysis'
+
+    @staticmethod
+    def _analysis(prompt):
+        result = re.search(r'^Result:\n(.*?)\n\n', prompt, re.MULTILINE | re.DOTALL)
+        if result:
+            return f'Computed over the full dataset:\n{result.group(1)}'
+        rows = re.search(r'^Rows: (\d+)', prompt, re.MULTILINE)
+        columns = [m.group('name') for m in _PROFILE_COLUMN.finditer(prompt)]
+        return f'The dataset has {rows.group(1) if rows else "an unknown number of"} rows and {len(columns)} columns: {", ".join(columns)}.'
+
+
+def build_llm_backend():
+    if settings.LLM_BACKEND == 'local':
+        return LocalBackend(settings.LLM_LOCAL_LATENCY)
+    return OpenAIBackend.from_settings()
+
+
+def _retry_after(error) -> float | None:
+    response = getattr(error, 'response', None)
+    value = response.headers.get('retry-after') if response is not None else None
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+class LLMClient:
+    """Per-process gateway to the configured backend: concurrency limit, retries and shared cool-down."""
+
+    def __init__(self, max_concurrency: int, max_retries: int, backoff_base: float, backoff_max: float):
+        self.backend = None  # built from settings on first use
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        self._lock = threading.Lock()
+        self._resume_at = 0.0
+        self.calls = 0
+        self.retries = 0
+        self.rate_limited = 0
+        self.failures = 0
+
+    def _backend(self):
+        with self._lock:
+            if self.backend is None:
+                self.backend = build_llm_backend()
+            return self.backend
+
+    @contextmanager
+    def use_backend(self, backend):
+        """Route calls made inside the block to ``backend``, then restore the previous one."""
+        with self._lock:
+            previous, self.backend = self.backend, backend
+        try:
+            yield backend
+        finally:
+            with self._lock:
+                self.backend = previous
+
+    def complete(self, model, messages, max_tokens, temperature) -> str:
+        return self._call('complete', model, messages, max_tokens, temperature)
+
+    def stream(self, model, messages, max_tokens, temperature):
+        """Yield text deltas; only opening the stream is retried, and the slot is held until it ends."""
+        deadline = time.monotonic() + settings.LLM_CALL_TIMEOUT
+        self._acquire(deadline)
+        try:
+            yield from self._attempts('stream', deadline, model, messages, max_tokens, temperature)
+        finally:
+            self._slots.release()
+
+    def _call(self, method, *args):
+        deadline = time.monotonic() + settings.LLM_CALL_TIMEOUT
+        self._acquire(deadline)
+        try:
+            return self._attempts(method, deadline, *args)
+        finally:
+            self._slots.release()
+
+    def _acquire(self, deadline):
+        if not self._slots.acquire(timeout=max(0.0, deadline - time.monotonic())):
+            with self._lock:
+                self.failures += 1
+            raise LLMUnavailable('The AI service is busy. Please try again in a moment.')
+
+    def _attempts(self, method, deadline, *args):
+        backend = self._backend()
+        attempt = 0
+        while True:
+            self._wait_for_cooldown(deadline)
+            with self._lock:
+                self.calls += 1
+            try:
+                return getattr(backend, method)(*args)
+            except RETRYABLE_ERRORS as e:
+                delay = self._backoff(attempt, e)
+                if attempt >= self.max_retries or time.monotonic() + delay >= deadline:
+                    with self._lock:
+                        self.failures += 1
+                    raise LLMUnavailable('The AI service is busy. Please try again in a moment.') from e
+                with self._lock:
+                    self.retries += 1
+                time.sleep(delay)
+                attempt += 1
+
+    def _backoff(self, attempt, error) -> float:
+        # Full jitter spreads retries from concurrent callers instead of synchronising them
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+        if isinstance(error, openai.RateLimitError):
+            retry_after = _retry_after(error)
+            if retry_after is not None:
+                delay = max(delay, retry_after)
+            with self._lock:
+                self.rate_limited += 1
+                self._resume_at = max(self._resume_at, time.monotonic() + delay)
+        return delay
+
+    def _wait_for_cooldown(self, deadline):
+        with self._lock:
+            wait = self._resume_at - time.monotonic()
+        if wait > 0:
+            if time.monotonic() + wait >= deadline:
+                raise LLMUnavailable('The AI service is busy. Please try again in a moment.')
+            time.sleep(wait)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'backend': type(self.backend).__name__ if self.backend is not None else None,
+                'calls': self.calls,
+                'retries': self.retries,
+                'rate_limited': self.rate_limited,
+                'failures': self.failures,
+            }
+
+
+llm_client = LLMClient(
+    max_concurrency=settings.LLM_MAX_CONCURRENCY,
+    max_retries=settings.LLM_MAX_RETRIES,
+    backoff_base=settings.LLM_BACKOFF_BASE,
+    backoff_max=settings.LLM_BACKOFF_MAX,
+)
@@ -0,0 +1,34 @@
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from analysis.jobs import claim_next_job, requeue_stale_jobs, run_job
+
+
+class Command(BaseCommand):
+    help = 'Process queued upload analysis jobs (DB-backed queue, no external broker).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--poll-interval', type=float, default=1.0, help='Seconds to sleep when the queue is empty.')
+        parser.add_argument(
+            '--stale-after', type=int, default=120,
+            help='Requeue running jobs whose heartbeat (every ANALYSIS_JOB_HEARTBEAT seconds) is older than this.',
+        )
+        parser.add_argument('--once', action='store_true', help='Drain the queue and exit instead of polling forever.')
+
+    def handle(self, *args, **options):
+        stale_after = timedelta(seconds=options['stale_after'])
+        self.stdout.write('Analysis worker started')
+        while True:
+            close_old_connections()
+            requeue_stale_jobs(stale_after)
+            job = claim_next_job()
+            if job is None:
+                if options['once']:
+                    return
+                time.sleep(options['poll_interval'])
+                continue
+            run_job(job)
+            self.stdout.write(f'Job {job.id}: {job.status}')
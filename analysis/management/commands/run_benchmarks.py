@@ -0,0 +1,132 @@
+import json
+import shutil
+import tempfile
+from pathlib import Path
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import override_settings, setup_test_environment, teardown_test_environment
+
+from analysis.benchmarks import (
+    DEFAULT_SIZES, compare_to_baseline, format_table, machine_info, run_history_scenario, run_scenario,
+    seed_history, size_label, summarize, synthetic_csv,
+)
+from analysis.charts import warm_pool
+from analysis.llm import LocalBackend, llm_client
+from users.models import CustomUser
+
+# Local to each checkout (git-ignored): timings from another machine say nothing about this one
+DEFAULT_BASELINE = Path(__file__).resolve().parents[2] / 'benchmark_baseline.json'
+
+
+def _parse_size(value):
+    try:
+        rows, columns = value.lower().split('x')
+        return int(rows), int(columns)
+    except ValueError:
+        raise CommandError(f'Invalid size {value!r}; expected ROWSxCOLUMNS, e.g. 10000x20.')
+
+
+class Command(BaseCommand):
+    help = (
+        'Benchmark the upload, question and chat actions on synthetic CSVs against a throwaway test '
+        'database, with the local LLM backend. Per-stage timings are checked against the baseline recorded on '
+        'this machine with --update-baseline, whenever one exists.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--sizes', nargs='+', default=[size_label(*s) for s in DEFAULT_SIZES],
+            help='Dataset shapes as ROWSxCOLUMNS (default: %(default)s).',
+        )
+        parser.add_argument('--repeat', type=int, default=3, help='Runs per size; the median is reported.')
+        parser.add_argument('--llm-latency', type=float, default=0.05, help='Seconds the local LLM backend sleeps per call.')
+        parser.add_argument('--render-workers', type=int, default=0, help='CHART_RENDER_WORKERS for the run.')
+        parser.add_argument('--baseline', default=str(DEFAULT_BASELINE), help='Baseline JSON file.')
+        parser.add_argument('--update-baseline', action='store_true', help='Write the results as the new baseline.')
+        parser.add_argument(
+            '--no-compare', dest='compare', action='store_false',
+            help='Only report timings; by default regressions against an existing baseline fail the command.',
+        )
+        parser.add_argument('--tolerance', type=float, default=0.3, help='Allowed relative slowdown per metric.')
+        parser.add_argument('--min-delta-ms', type=float, default=10.0, help='Ignore slowdowns smaller than this.')
+        parser.add_argument('--output', help='Also write the results as JSON to this file.')
+        parser.add_argument(
+            '--history-messages', type=int, default=0,
+            help='Also benchmark the sidebar and history actions for a user with this many messages (e.g. 1000000).',
+        )
+        parser.add_argument('--history-chats', type=int, default=1000, help='Chats the history messages are spread over.')
+
+    def handle(self, *args, **options):
+        sizes = [_parse_size(s) for s in options['sizes']]
+        calls_before = llm_client.calls
+        media_root = tempfile.mkdtemp(prefix='analysis-bench-')
+        setup_test_environment()
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            # Per-user dedup (the default, pinned here) keeps each repeat's first upload a real one; without kept
+            # single-flight results the repeated question measures the LLM cache
+            with override_settings(
+                MEDIA_ROOT=media_root,
+                SINGLE_FLIGHT_DIR=str(Path(media_root) / 'inflight'),
+                ANALYSIS_ASYNC_UPLOADS=False,
+                CHART_RENDER_WORKERS=options['render_workers'],
+                UPLOAD_DEDUP_SCOPE='user',
+                SINGLE_FLIGHT_RESULT_TTL=0,
+                # The widest default size is ~55MB, past DATASET_MAX_BYTES
+                LARGE_DATASET_MAX_BYTES=max(settings.LARGE_DATASET_MAX_BYTES, 1024 * 1024 * 1024),
+            ), llm_client.use_backend(LocalBackend(options['llm_latency'])):
+                # Start the renderers, then a warm-up run (imports, first renders) that is not reported
+                warm_pool()
+                run_scenario(CustomUser.objects.create_user(username='bench-warmup'), synthetic_csv(100, 5, seed=1))
+                results = {}
+                for rows, columns in sizes:
+                    label = size_label(rows, columns)
+                    self.stdout.write(f'Running {label} ({options["repeat"]} runs)')
+                    csv_bytes = synthetic_csv(rows, columns)
+                    runs = []
+                    for i in range(options['repeat']):
+                        user = CustomUser.objects.create_user(username=f'bench-{label}-{i}', password='bench-pw-12345')
+                        runs.append(run_scenario(user, csv_bytes))
+                    results[label] = summarize(runs)
+                if options['history_messages']:
+                    label = f'history-{options["history_messages"]}'
+                    self.stdout.write(f'Seeding {label} over {options["history_chats"]} chats')
+                    user = CustomUser.objects.create_user(username='bench-history', password='bench-pw-12345')
+                    seed_history(user, options['history_messages'], options['history_chats'])
+                    self.stdout.write(f'Running {label} ({options["repeat"]} runs)')
+                    results[label] = summarize([run_history_scenario(user) for _ in range(options['repeat'])])
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+            shutil.rmtree(media_root, ignore_errors=True)
+
+        self.stdout.write(format_table(results))
+        self.stdout.write(f'LLM calls: {llm_client.calls - calls_before}')
+        if options['output']:
+            Path(options['output']).write_text(json.dumps(results, indent=2) + '\n')
+
+        baseline_path = Path(options['baseline'])
+        if options['update_baseline']:
+            baseline_path.write_text(json.dumps({'machine': machine_info(), 'results': results}, indent=2) + '\n')
+            self.stdout.write(self.style.SUCCESS(f'Baseline written to {baseline_path}'))
+            return
+        if not options['compare']:
+            return
+        if not baseline_path.exists():
+            self.stdout.write(self.style.WARNING(
+                f'No baseline at {baseline_path}, nothing compared; record one with --update-baseline.'
+            ))
+            return
+        baseline = json.loads(baseline_path.read_text())
+        if baseline.get('machine') != machine_info():
+            raise CommandError(
+                f'{baseline_path} was recorded on another machine or Python; re-record it here with --update-baseline.'
+            )
+        regressions = compare_to_baseline(results, baseline['results'], options['tolerance'], options['min_delta_ms'])
+        for size, action, metric, before, after in regressions:
+            self.stdout.write(self.style.ERROR(f'REGRESSION {size} {action} {metric}: {before:g} -> {after:g}'))
+        if regressions:
+            raise CommandError(f'{len(regressions)} metric(s) regressed against {baseline_path}.')
+        self.stdout.write(self.style.SUCCESS('No regressions against the baseline.'))
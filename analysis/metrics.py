@@ -0,0 +1,119 @@
+"""Per-request query and stage timing.
+
+``RequestMetricsMiddleware`` activates a ``RequestMetrics`` for each request;
+code on the request path reports time spent in named stages (``parse`` for
+reading CSVs, ``pandas`` for profiling and aggregation, ``openai``,
+``render``) with ``timed()``, which is a no-op outside a request.
+Work fanned out to thread pools keeps reporting to the request as long as it
+is submitted with ``contextvars.copy_context().run``.
+"""
+import contextvars
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+_current = contextvars.ContextVar('request_metrics', default=None)
+
+
+class RequestMetrics:
+    def __init__(self):
+        self.queries = 0
+        self.sql_time = 0.0
+        self.stages = defaultdict(float)
+        self.counts = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def add_stage(self, stage: str, seconds: float):
+        with self._lock:
+            self.stages[stage] += seconds
+
+    def add_count(self, name: str, value: int):
+        with self._lock:
+            self.counts[name] += value
+
+    def sql_wrapper(self, execute, sql, params, many, context):
+        """``connection.execute_wrapper`` hook counting and timing every query."""
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self.queries += 1
+                self.sql_time += elapsed
+
+    def as_dict(self) -> dict:
+        with self._lock:
+            data = {'queries': self.queries, 'sql_ms': round(self.sql_time * 1000, 2)}
+            for stage, seconds in self.stages.items():
+                data[f'{stage}_ms'] = round(seconds * 1000, 2)
+            data.update(self.counts)
+            return data
+
+
+def activate(metrics: RequestMetrics):
+    return _current.set(metrics)
+
+
+def deactivate(token):
+    _current.reset(token)
+
+
+def current_metrics():
+    return _current.get()
+
+
+def count(name: str, value: int):
+    """Add ``value`` to the active request's ``name`` counter (e.g. ``prompt_tokens``)."""
+    metrics = _current.get()
+    if metrics is not None:
+        metrics.add_count(name, value)
+
+
+@contextmanager
+def timed(stage: str):
+    """Add the time spent in the block to the active request's ``stage`` total."""
+    metrics = _current.get()
+    if metrics is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.add_stage(stage, time.perf_counter() - start)
+
+
+class MetricsRegistry:
+    """Per-process aggregates by action (e.g. ``analysis-home:question``)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._actions = {}
+
+    def record(self, action: str, sample: dict):
+        with self._lock:
+            agg = self._actions.setdefault(action, {'requests': 0, 'totals': defaultdict(float), 'max': defaultdict(float)})
+            agg['requests'] += 1
+            for key, value in sample.items():
+                agg['totals'][key] += value
+                agg['max'][key] = max(agg['max'][key], value)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                action: {
+                    'requests': agg['requests'],
+                    'avg': {k: round(v / agg['requests'], 2) for k, v in agg['totals'].items()},
+                    'max': {k: round(v, 2) for k, v in agg['max'].items()},
+                }
+                for action, agg in self._actions.items()
+            }
+
+    def reset(self):
+        with self._lock:
+            self._actions.clear()
+
+
+registry = MetricsRegistry()
@@ -0,0 +1,48 @@
+import base64
+import hashlib
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import migrations, models
+
+
+def _chart_name(key):
+    return f'charts/{key[:2]}/{key}.png'
+
+
+def move_charts_to_storage(apps, schema_editor):
+    ChatMessage = apps.get_model('analysis', 'ChatMessage')
+    pending = ChatMessage.objects.filter(chart__isnull=False).exclude(chart='').only('id', 'chart')
+    for message in pending.iterator(chunk_size=200):
+        image_png = base64.b64decode(message.chart)
+        key = hashlib.sha256(image_png).hexdigest()
+        if not default_storage.exists(_chart_name(key)):
+            default_storage.save(_chart_name(key), ContentFile(image_png))
+        ChatMessage.objects.filter(id=message.id).update(chart_key=key)
+
+
+def restore_inline_charts(apps, schema_editor):
+    ChatMessage = apps.get_model('analysis', 'ChatMessage')
+    for message in ChatMessage.objects.filter(chart_key__isnull=False).only('id', 'chart_key').iterator(chunk_size=200):
+        try:
+            with default_storage.open(_chart_name(message.chart_key), 'rb') as fh:
+                chart = base64.b64encode(fh.read()).decode('utf-8')
+        except FileNotFoundError:
+            continue
+        ChatMessage.objects.filter(id=message.id).update(chart=chart)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analysis', '0004_analysisjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatmessage',
+            name='chart_key',
+            field=models.CharField(blank=True, db_index=True, max_length=64, null=True),
+        ),
+        migrations.RunPython(move_charts_to_storage, restore_inline_charts),
+    ]
@@ -0,0 +1,15 @@
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analysis', '0005_chatmessage_chart_key'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='chatmessage',
+            name='chart',
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.7 on 2026-10-17 15:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analysis', '0008_dataset_profile'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatmessage',
+            name='chart_data',
+            field=models.JSONField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.7 on 2026-10-17 15:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analysis', '0009_chatmessage_chart_data'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dataset',
+            name='layout',
+            field=models.CharField(choices=[('frame', 'In-memory frame'), ('partitioned', 'Partitioned on disk')], default='frame', max_length=16),
+        ),
+    ]
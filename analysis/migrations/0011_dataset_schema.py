@@ -0,0 +1,18 @@
+# Generated by Django 4.2.7 on 2026-10-17 15:29
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analysis', '0010_dataset_layout'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dataset',
+            name='schema',
+            field=models.JSONField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,48 @@
+# Generated by Django 4.2.7 on 2026-10-17 15:52
+
+from django.db import migrations, models
+from django.db.models import Count, Max, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def backfill_message_counters(apps, schema_editor):
+    Chat = apps.get_model('analysis', 'Chat')
+    ChatMessage = apps.get_model('analysis', 'ChatMessage')
+    messages = ChatMessage.objects.filter(chat=OuterRef('pk')).order_by().values('chat')
+    Chat.objects.update(
+        message_count=Coalesce(Subquery(messages.annotate(n=Count('id')).values('n')), 0),
+        last_message_at=Subquery(messages.annotate(latest=Max('created_at')).values('latest')),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analysis', '0011_dataset_schema'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chat',
+            name='last_message_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='chat',
+            name='message_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='chat',
+            index=models.Index(fields=['user', 'updated_at'], name='chat_user_updated_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='chat',
+            index=models.Index(fields=['user', 'created_at'], name='chat_user_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='chatmessage',
+            index=models.Index(fields=['chat', 'created_at'], name='message_chat_created_idx'),
+        ),
+        migrations.RunPython(backfill_message_counters, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.2.7 on 2026-10-17 17:39
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analysis', '0013_analysisjob_heartbeat_at'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='chat',
+            name='last_message_at',
+        ),
+    ]
@@ -1,11 +1,28 @@
 from django.db import models
+from django.db.models import F
 from django.conf import settings
+from django.urls import reverse
+from django.utils import timezone
 
 class DataSet(models.Model):
+    LAYOUT_FRAME = 'frame'
+    LAYOUT_PARTITIONED = 'partitioned'
+    LAYOUTS = (
+        (LAYOUT_FRAME, 'In-memory frame'),
+        (LAYOUT_PARTITIONED, 'Partitioned on disk'),
+    )
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
     name = models.CharField(max_length=100)
     file = models.FileField(upload_to='datasets/')
     uploaded_at = models.DateTimeField(auto_now_add=True)
+    # sha256 of the file contents; identifies the data independently of the row
+    content_hash = models.CharField(max_length=64, blank=True, default='', db_index=True)
+    # Column profile computed once at upload (see analysis.profiling)
+    profile = models.JSONField(null=True, blank=True)
+    # Large uploads are stored partitioned and processed chunk-wise (see analysis.dataframes)
+    layout = models.CharField(max_length=16, choices=LAYOUTS, default=LAYOUT_FRAME)
+    # Column dtypes chosen at upload (see analysis.dtypes); reloads apply them instead of inferring
+    schema = models.JSONField(null=True, blank=True)
 
     def __str__(self):
         return self.name
@@ -18,10 +35,32 @@ class Chat(models.Model):
     last_dataset = models.ForeignKey(DataSet, null=True, blank=True, on_delete=models.SET_NULL, related_name='chats')
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
+    # Maintained by record_messages so emptiness checks don't touch the message table
+    message_count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'updated_at'], name='chat_user_updated_idx'),
+            models.Index(fields=['user', 'created_at'], name='chat_user_created_idx'),
+        ]
 
     def __str__(self) -> str:
         return f"{self.title} ({self.user})"
 
+    def record_messages(self, messages, update_fields=()):
+        """Count newly created ``messages`` and save ``update_fields`` and ``updated_at`` in one UPDATE.
+
+        The count is incremented in the database, so concurrent writers to the
+        same chat don't lose updates.
+        """
+        self.updated_at = timezone.now()
+        Chat.objects.filter(pk=self.pk).update(
+            message_count=F('message_count') + len(messages),
+            updated_at=self.updated_at,
+            **{name: getattr(self, name) for name in update_fields},
+        )
+        self.message_count += len(messages)
+
 
 class ChatMessage(models.Model):
     MESSAGE_TYPES = (
@@ -32,11 +71,51 @@ class ChatMessage(models.Model):
     type = models.CharField(max_length=16, choices=MESSAGE_TYPES)
     content = models.TextField()
     response = models.TextField(null=True, blank=True)
-    chart = models.TextField(null=True, blank=True)
+    # sha256 of the PNG in content-addressed chart storage (see analysis.charts)
+    chart_key = models.CharField(max_length=64, null=True, blank=True, db_index=True)
+    # Compact chart arrays drawn by the browser when CHART_DELIVERY is 'data'
+    chart_data = models.JSONField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['created_at']
+        indexes = [
+            models.Index(fields=['chat', 'created_at'], name='message_chat_created_idx'),
+        ]
+
+    def __str__(self) -> str:
+        return f"{self.chat.title} - {self.type} @ {self.created_at}"
+
+    @property
+    def chart_url(self):
+        return reverse('analysis-chart', args=[self.chart_key]) if self.chart_key else None
+
+class AnalysisJob(models.Model):
+    STATUS_PENDING = 'pending'
+    STATUS_RUNNING = 'running'
+    STATUS_DONE = 'done'
+    STATUS_FAILED = 'failed'
+    STATUSES = (
+        (STATUS_PENDING, 'Pending'),
+        (STATUS_RUNNING, 'Running'),
+        (STATUS_DONE, 'Done'),
+        (STATUS_FAILED, 'Failed'),
+    )
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='analysis_jobs')
+    chat = models.ForeignKey(Chat, on_delete=models.CASCADE, related_name='jobs')
+    dataset = models.ForeignKey(DataSet, null=True, blank=True, on_delete=models.SET_NULL, related_name='jobs')
+    status = models.CharField(max_length=16, choices=STATUSES, default=STATUS_PENDING, db_index=True)
+    error = models.TextField(null=True, blank=True)
+    message = models.ForeignKey(ChatMessage, null=True, blank=True, on_delete=models.SET_NULL, related_name='+')
+    attempts = models.PositiveSmallIntegerField(default=0)
     created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    # Renewed by the running worker; a job whose heartbeat stops is requeued (see analysis.jobs)
+    heartbeat_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
 
     class Meta:
         ordering = ['created_at']
 
     def __str__(self) -> str:
-        return f"{self.chat.title} - {self.type} @ {self.created_at}"
\ No newline at end of file
+        return f"Job {self.id} ({self.status}) for {self.chat}"
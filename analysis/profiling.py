@@ -0,0 +1,250 @@
+"""Column profiles computed once per dataset.
+
+A profile is a JSON-serializable summary of a frame (dtypes, null and
+distinct counts, numeric statistics, quantiles, top values, histograms and
+a few preview rows). It is stored on the ``DataSet`` when the upload is
+analyzed, and prompt builders and charts read it instead of the raw rows.
+"""
+import math
+
+import numpy as np
+import pandas as pd
+
+from .dataframes import PartitionedDataset, load_dataset_source
+from .metrics import timed
+
+PROFILE_VERSION = 1
+TOP_K = 10
+HIST_BINS = 20
+PREVIEW_ROWS = 10
+QUANTILES = [0.05, 0.25, 0.5, 0.75, 0.95]
+
+
+def _scalar(value):
+    """Make a pandas/numpy scalar JSON-safe (NaN becomes None)."""
+    if value is None or (isinstance(value, float) and math.isnan(value)):
+        return None
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float):
+        return None if math.isnan(value) else value
+    if isinstance(value, (int, bool, str)):
+        return value
+    if pd.isna(value):
+        return None
+    return str(value)
+
+
+def build_profile(df) -> dict:
+    """Summarize ``df`` column by column, vectorized across columns where pandas allows."""
+    numeric = df.select_dtypes(include=['number'])
+    numeric = numeric.astype({c: np.float64 for c in numeric.columns if numeric[c].dtype == np.float32})
+    nulls = df.isna().sum()
+    distinct = df.nunique(dropna=True)
+    if len(numeric.columns):
+        stats = pd.DataFrame({
+            'min': numeric.min(), 'max': numeric.max(), 'mean': numeric.mean(), 'std': numeric.std(),
+        })
+        quantiles = numeric.quantile(QUANTILES)
+    columns = []
+    for name in df.columns:
+        series = df[name]
+        column = {
+            'name': str(name),
+            'dtype': str(series.dtype),
+            'nulls': int(nulls[name]),
+            'distinct': int(distinct[name]),
+        }
+        if name in numeric.columns:
+            column.update({key: _scalar(stats.at[name, key]) for key in ['min', 'max', 'mean', 'std']})
+            column['quantiles'] = {str(q): _scalar(quantiles.at[q, name]) for q in QUANTILES}
+            values = series.dropna().to_numpy(dtype=np.float64)
+            if len(values) and np.isfinite(values).all():
+                counts, edges = np.histogram(values, bins=HIST_BINS)
+                column['histogram'] = {'edges': edges.tolist(), 'counts': counts.tolist()}
+        top = series.value_counts(dropna=True)
+        top = top[top > 0].head(TOP_K)
+        column['top'] = [[_scalar(value), int(count)] for value, count in top.items()]
+        columns.append(column)
+    return {
+        'version': PROFILE_VERSION,
+        'rows': len(df),
+        'memory_bytes': int(df.memory_usage(deep=True).sum()),
+        'columns': columns,
+        'preview': _preview(df),
+    }
+
+
+def _preview(df):
+    preview = df.head(PREVIEW_ROWS)
+    return {
+        'columns': [str(c) for c in preview.columns],
+        'rows': [[_scalar(v) for v in row] for row in preview.itertuples(index=False)],
+    }
+
+
+# Distinct values tracked per column while profiling chunks; beyond this only the most frequent are kept
+MAX_TRACKED_VALUES = 50000
+
+
+class ProfileAccumulator:
+    """Builds the ``build_profile`` structure from a stream of chunks in bounded memory.
+
+    Row, null and numeric statistics are exact (means and deviations are merged
+    per chunk). Top values and distinct counts are exact unless a column has
+    more than ``MAX_TRACKED_VALUES`` distinct values, in which case the column
+    is marked ``approximate``. Quantiles come from a uniform row sample.
+    """
+
+    def __init__(self):
+        self.rows = 0
+        self.memory_bytes = 0
+        self.head = None
+        self._nulls = {}
+        self._moments = {}  # column -> (count, mean, m2, min, max)
+        self._counts = {}
+        self._truncated = set()
+
+    def update(self, chunk):
+        if self.head is None:
+            self.head = chunk.head(PREVIEW_ROWS)
+        self.rows += len(chunk)
+        self.memory_bytes += int(chunk.memory_usage(deep=True).sum())
+        nulls = chunk.isna().sum()
+        numeric = set(chunk.select_dtypes(include=['number']).columns)
+        for name in chunk.columns:
+            self._nulls[name] = self._nulls.get(name, 0) + int(nulls[name])
+            if name in numeric:
+                self._merge_moments(name, chunk[name].dropna().to_numpy(dtype=float))
+            counts = chunk[name].value_counts(dropna=True)
+            if name in self._counts:
+                counts = self._counts[name].add(counts, fill_value=0)
+            if len(counts) > MAX_TRACKED_VALUES:
+                counts = counts.nlargest(MAX_TRACKED_VALUES)
+                self._truncated.add(name)
+            self._counts[name] = counts
+
+    def _merge_moments(self, name, values):
+        if not len(values):
+            return
+        n_b, mean_b = len(values), values.mean()
+        m2_b = ((values - mean_b) ** 2).sum()
+        if name not in self._moments:
+            self._moments[name] = (n_b, mean_b, m2_b, values.min(), values.max())
+            return
+        n_a, mean_a, m2_a, lo, hi = self._moments[name]
+        n = n_a + n_b
+        delta = mean_b - mean_a
+        self._moments[name] = (
+            n, mean_a + delta * n_b / n, m2_a + m2_b + delta ** 2 * n_a * n_b / n,
+            min(lo, values.min()), max(hi, values.max()),
+        )
+
+    def finish(self, sample, chunks=None) -> dict:
+        """The profile; ``chunks`` (a fresh iterable of the same data) enables exact histograms."""
+        profile = build_profile(sample)
+        profile['rows'] = self.rows
+        profile['memory_bytes'] = self.memory_bytes
+        profile['preview'] = _preview(self.head)
+        histograms = {}
+        for column in profile['columns']:
+            name = column['name']
+            column['nulls'] = self._nulls.get(name, 0)
+            counts = self._counts.get(name)
+            if counts is not None:
+                column['distinct'] = len(counts)
+                top = counts.sort_values(ascending=False, kind='stable').head(TOP_K)
+                column['top'] = [[_scalar(value), int(count)] for value, count in top.items()]
+            if name in self._truncated:
+                # Too many values to count exactly; estimate the distinct count from the sample
+                column['approximate'] = True
+                estimate = round(sample[name].nunique() * self.rows / max(len(sample), 1))
+                column['distinct'] = min(max(column['distinct'], estimate), self.rows - column['nulls'])
+            if name in self._moments and 'mean' in column:
+                n, mean, m2, lo, hi = self._moments[name]
+                column.update({
+                    'min': _scalar(lo), 'max': _scalar(hi), 'mean': _scalar(mean),
+                    'std': _scalar(float(np.sqrt(m2 / (n - 1))) if n > 1 else None),
+                })
+                if chunks is not None and np.isfinite([lo, hi]).all():
+                    # Same edges np.histogram picks for the full column
+                    lo, hi = (lo - 0.5, hi + 0.5) if lo == hi else (lo, hi)
+                    histograms[name] = (np.linspace(lo, hi, HIST_BINS + 1), np.zeros(HIST_BINS, dtype=np.int64))
+        if histograms:
+            for chunk in chunks:
+                for name, (edges, counts) in histograms.items():
+                    counts += np.histogram(chunk[name].dropna().to_numpy(dtype=float), bins=edges)[0]
+            for column in profile['columns']:
+                if column['name'] in histograms:
+                    edges, counts = histograms[column['name']]
+                    column['histogram'] = {'edges': edges.tolist(), 'counts': counts.tolist()}
+        profile['sampled_rows'] = len(sample)
+        return profile
+
+
+def preview_frame(profile, rows: int = 5):
+    """The first ``rows`` preview rows as a small DataFrame."""
+    preview = profile['preview']
+    return pd.DataFrame(preview['rows'][:rows], columns=preview['columns'])
+
+
+def _format_number(value):
+    if value is None:
+        return 'n/a'
+    return f'{value:.4g}' if isinstance(value, float) else str(value)
+
+
+def clip_text(value, width: int = 40) -> str:
+    """``str(value)`` cut to ``width`` characters for prompt text."""
+    text = str(value)
+    return text if len(text) <= width else text[:width - 3] + '...'
+
+
+def describe_column(column) -> str:
+    """One prompt line summarizing a profiled column."""
+    line = f"- {column['name']} ({column['dtype']}): {column['nulls']} nulls, {column['distinct']} distinct"
+    if 'mean' in column:
+        q = column['quantiles']
+        line += (
+            f"; min {_format_number(column['min'])}, max {_format_number(column['max'])}, "
+            f"mean {_format_number(column['mean'])}, std {_format_number(column['std'])}, "
+            f"median {_format_number(q['0.5'])}"
+        )
+    elif column['top']:
+        top = ', '.join(f'{clip_text(value)} ({count})' for value, count in column['top'][:5])
+        line += f'; top: {top}'
+    return line
+
+
+def describe_profile(profile, sample_rows: int = 5) -> str:
+    """Text form of a whole profile; prompts use the token-budgeted ``prompts.describe_dataset``."""
+    lines = [f"Rows: {profile['rows']}", 'Columns:']
+    lines += [describe_column(column) for column in profile['columns']]
+    if sample_rows:
+        lines.append(f'Sample rows (first {sample_rows}):')
+        lines.append(preview_frame(profile, sample_rows).to_string(index=False))
+    return '\n'.join(lines)
+
+
+def profile_column(profile, name):
+    for column in profile['columns']:
+        if column['name'] == name:
+            return column
+    return None
+
+
+def dataset_profile(dataset, df=None) -> dict:
+    """Return the dataset's stored profile, computing and saving it for rows that predate profiles."""
+    if not dataset.profile or dataset.profile.get('version') != PROFILE_VERSION:
+        if df is None:
+            df = load_dataset_source(dataset)
+        with timed('pandas'):
+            if isinstance(df, PartitionedDataset):
+                accumulator = ProfileAccumulator()
+                for chunk in df.iter_chunks():
+                    accumulator.update(chunk)
+                dataset.profile = accumulator.finish(df.sample, df.iter_chunks())
+            else:
+                dataset.profile = build_profile(df)
+        dataset.save(update_fields=['profile'])
+    return dataset.profile
@@ -0,0 +1,112 @@
+"""Token-budgeted dataset descriptions for prompts.
+
+Prompt size must not grow with the width of the dataset. ``describe_dataset``
+spends a token budget on per-column statistics in priority order (columns the
+question names, then informative ones), lists the remaining columns by name
+and type only, and adds sample rows for the described columns if room is
+left. ``describe_result`` does the same for a computed result table.
+
+Token counts use ``tiktoken`` when it is installed and a conservative
+character/word estimate otherwise.
+"""
+import math
+import re
+
+from .profiling import clip_text, describe_column, preview_frame
+
+try:
+    import tiktoken
+    _encoding = tiktoken.get_encoding('cl100k_base')
+except Exception:  # optional dependency, or its vocabulary could not be loaded
+    _encoding = None
+
+_PIECES = re.compile(r'\w+|[^\w\s]')
+
+
+def estimate_tokens(text: str) -> int:
+    if _encoding is not None:
+        return len(_encoding.encode(text))
+    # About four characters per token for prose; numbers and punctuation split finer
+    return max(math.ceil(len(text) / 4), len(_PIECES.findall(text)))
+
+
+def _priority(column, rows: int, question: str):
+    mentioned = column['name'].lower() in question
+    # Constant columns and unique strings (ids, free text) say little in summary form
+    uninformative = column['distinct'] <= 1 or ('mean' not in column and column['distinct'] >= rows - column['nulls'])
+    return (not mentioned, uninformative)
+
+
+def describe_dataset(profile, max_tokens: int, question: str = '', sample_rows: int = 0) -> str:
+    """Schema and statistics for ``profile`` in at most about ``max_tokens`` tokens."""
+    columns = profile['columns']
+    question = (question or '').lower()
+    lines = [f"Rows: {profile['rows']}, columns: {len(columns)}", 'Columns:']
+    used = estimate_tokens('\n'.join(lines))
+    # Keep room to at least name the columns that don't get statistics
+    reserve = min(max_tokens // 5, estimate_tokens(', '.join(f"{c['name']} ({c['dtype']})" for c in columns)))
+
+    order = sorted(range(len(columns)), key=lambda i: _priority(columns[i], profile['rows'], question))
+    described = set()
+    for i in order:
+        cost = estimate_tokens(describe_column(columns[i])) + 1
+        if used + cost <= max_tokens - reserve:
+            described.add(i)
+            used += cost
+    lines += [describe_column(columns[i]) for i in sorted(described)]
+
+    rest = [f"{columns[i]['name']} ({columns[i]['dtype']})" for i in order if i not in described]
+    if rest:
+        listed = []
+        for entry in rest:
+            if used + estimate_tokens(entry) + 12 > max_tokens:
+                break
+            listed.append(entry)
+            used += estimate_tokens(entry) + 1
+        text = 'Other columns (statistics omitted): ' + ', '.join(listed)
+        if len(listed) < len(rest):
+            text += f"{', ' if listed else ''}and {len(rest) - len(listed)} more"
+        lines.append(text)
+        used += 12
+
+    if sample_rows and described:
+        names = [columns[i]['name'] for i in sorted(described)]
+        preview = preview_frame(profile, sample_rows)[names].map(lambda v: clip_text(v, 20))
+        for n in range(len(preview), 0, -1):
+            sample = f'Sample rows (first {n}, described columns only):\n' + preview.head(n).to_string(index=False)
+            if used + estimate_tokens(sample) <= max_tokens:
+                lines.append(sample)
+                break
+    return '\n'.join(lines)
+
+
+def describe_result(result, max_tokens: int) -> str:
+    """A result table as text within ``max_tokens``: columns are kept while a few rows fit, then rows."""
+    text = result.to_string(index=False)
+    if estimate_tokens(text) <= max_tokens or result.empty:
+        return text
+    frame = result.map(lambda v: clip_text(v, 30))
+    budget = max_tokens - 20  # room for the truncation note
+    header = [estimate_tokens(str(name)) for name in frame.columns]
+    cells = [[estimate_tokens(value) for value in frame[name]] for name in frame.columns]
+    shown_rows = min(len(frame), 5)
+    width, used = 0, 0
+    while width < len(header) and used + header[width] + sum(cells[width][:shown_rows]) <= budget:
+        used += header[width] + sum(cells[width][:shown_rows])
+        width += 1
+    width = max(width, 1)
+    rows, used = 0, sum(header[:width])
+    while rows < len(frame) and used + sum(column[rows] for column in cells[:width]) <= budget:
+        used += sum(column[rows] for column in cells[:width])
+        rows += 1
+    rows = max(rows, 1)
+    while True:
+        text = frame.iloc[:rows, :width].to_string(index=False)
+        text += f'\n(showing {rows} of {len(result)} rows, {width} of {len(result.columns)} columns)'
+        # Padding can push the estimate over; shrink until the rendered table fits
+        if estimate_tokens(text) <= max_tokens or (rows == 1 and width == 1):
+            return text
+        if rows > 1:
+            rows = max(1, rows * 4 // 5)
+        else:
+            width = max(1, width * 4 // 5)
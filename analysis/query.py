@@ -0,0 +1,304 @@
+"""Restricted query plans executed locally over the full dataset.
+
+The model never sees more than the schema: it emits a small JSON plan
+(filter, groupby, aggregate, sort, limit), which is validated against the
+frame's columns and run with vectorized pandas over every row. Only the
+bounded result table goes back into the narration prompt.
+"""
+import numpy as np
+import pandas as pd
+
+from .dtypes import widened
+
+FILTER_OPS = ['==', '!=', '>', '>=', '<', '<=', 'in', 'not_in', 'contains', 'isnull', 'notnull']
+AGG_FUNCS = ['sum', 'mean', 'median', 'min', 'max', 'count', 'nunique', 'std']
+MAX_LIMIT = 50
+DEFAULT_LIMIT = 20
+
+
+class QueryPlanError(ValueError):
+    """The plan is malformed or references columns the dataset doesn't have."""
+
+
+def _columns(value, df, field):
+    if value is None:
+        return []
+    if isinstance(value, str):
+        value = [value]
+    if not isinstance(value, list) or not all(isinstance(c, str) for c in value):
+        raise QueryPlanError(f'{field} must be a list of column names')
+    missing = [c for c in value if c not in df.columns]
+    if missing:
+        raise QueryPlanError(f'Unknown column(s) in {field}: {", ".join(missing)}')
+    return value
+
+
+def _output_name(column, func):
+    return 'count' if column == '*' else f'{column}_{func}'
+
+
+def validate_plan(plan, df) -> dict:
+    """Check a model-produced plan against ``df`` and return it in normalized form.
+
+    Only the schema (``columns`` and ``dtypes``) is inspected, so ``df`` may
+    also be a ``PartitionedDataset``.
+    """
+    if not isinstance(plan, dict):
+        raise QueryPlanError('Plan must be a JSON object')
+
+    filters = []
+    for f in plan.get('filters') or []:
+        if not isinstance(f, dict) or f.get('op') not in FILTER_OPS:
+            raise QueryPlanError(f'Invalid filter: {f!r}')
+        column = _columns(f.get('column'), df, 'filters')
+        if len(column) != 1:
+            raise QueryPlanError(f'Invalid filter: {f!r}')
+        if f['op'] in ['in', 'not_in'] and not isinstance(f.get('value'), list):
+            raise QueryPlanError(f'{f["op"]} filters need a list value')
+        filters.append({'column': column[0], 'op': f['op'], 'value': f.get('value')})
+
+    groupby = _columns(plan.get('groupby'), df, 'groupby')
+
+    aggregate = []
+    for a in plan.get('aggregate') or []:
+        if not isinstance(a, dict) or a.get('func') not in AGG_FUNCS:
+            raise QueryPlanError(f'Invalid aggregate: {a!r}')
+        column = a.get('column') or '*'
+        if column == '*':
+            if a['func'] != 'count':
+                raise QueryPlanError('Only count can be applied to "*"')
+        else:
+            _columns(column, df, 'aggregate')
+            if a['func'] not in ['count', 'nunique', 'min', 'max'] and not pd.api.types.is_numeric_dtype(df.dtypes[column]):
+                raise QueryPlanError(f'{a["func"]} needs a numeric column, {column} is not')
+        aggregate.append({'column': column, 'func': a['func']})
+
+    select = [] if aggregate or groupby else _columns(plan.get('select'), df, 'select')
+
+    if aggregate or groupby:
+        outputs = list(groupby) + ([_output_name(a['column'], a['func']) for a in aggregate] or ['count'])
+    else:
+        outputs = select or list(df.columns)
+    sort = []
+    for s in plan.get('sort') or []:
+        if not isinstance(s, dict) or s.get('column') not in outputs:
+            raise QueryPlanError(f'Invalid sort: {s!r}')
+        sort.append({'column': s['column'], 'desc': bool(s.get('desc'))})
+
+    try:
+        limit = int(plan.get('limit') or DEFAULT_LIMIT)
+    except (TypeError, ValueError):
+        raise QueryPlanError('limit must be an integer')
+    limit = max(1, min(limit, MAX_LIMIT))
+
+    return {'filters': filters, 'groupby': groupby, 'aggregate': aggregate, 'select': select, 'sort': sort, 'limit': limit}
+
+
+def _coerce(series, value):
+    if pd.api.types.is_numeric_dtype(series) and isinstance(value, str):
+        try:
+            return float(value)
+        except ValueError:
+            return value
+    return value
+
+
+def _filter_mask(series, op, value):
+    if op == 'isnull':
+        return series.isna().to_numpy()
+    if op == 'notnull':
+        return series.notna().to_numpy()
+    if op == 'contains':
+        return series.astype(str).str.contains(str(value), case=False, regex=False, na=False).to_numpy()
+    if op in ['in', 'not_in']:
+        mask = series.isin([_coerce(series, v) for v in value]).to_numpy()
+        return mask if op == 'in' else ~mask
+    value = _coerce(series, value)
+    compare = {
+        '==': series.__eq__, '!=': series.__ne__, '>': series.__gt__,
+        '>=': series.__ge__, '<': series.__lt__, '<=': series.__le__,
+    }[op]
+    try:
+        return compare(value).fillna(False).to_numpy(dtype=bool)
+    except TypeError:
+        raise QueryPlanError(f'Cannot compare {series.name} with {value!r}')
+
+
+def execute_plan(plan, df):
+    """Run a validated plan over every row of ``df``.
+
+    Returns ``(result, matched_rows)`` where ``result`` has at most
+    ``plan['limit']`` rows and ``matched_rows`` counts rows passing the filters.
+    ``df`` may be a ``PartitionedDataset``, which is processed one chunk at a time.
+    """
+    if not isinstance(df, pd.DataFrame):
+        return _execute_chunked(plan, df)
+    mask = np.ones(len(df), dtype=bool)
+    for f in plan['filters']:
+        mask &= _filter_mask(df[f['column']], f['op'], f['value'])
+    data = df[mask] if plan['filters'] else df
+    matched_rows = int(mask.sum())
+
+    groupby = plan['groupby']
+    aggregate = plan['aggregate']
+    if aggregate or groupby:
+        named = {}
+        for a in aggregate or [{'column': '*', 'func': 'count'}]:
+            name = _output_name(a['column'], a['func'])
+            if groupby:
+                named[name] = (groupby[0], 'size') if a['column'] == '*' else (a['column'], a['func'])
+            else:
+                named[name] = len(data) if a['column'] == '*' else widened(data[a['column']]).agg(a['func'])
+        if groupby:
+            needed = dict.fromkeys(groupby + [a['column'] for a in aggregate if a['column'] != '*'])
+            work = pd.DataFrame({c: widened(data[c]) for c in needed})
+            result = work.groupby(groupby, dropna=False, observed=True).agg(**named).reset_index()
+        else:
+            result = pd.DataFrame({name: [value] for name, value in named.items()})
+    else:
+        result = data[plan['select']] if plan['select'] else data
+
+    return _sorted(result, plan).head(plan['limit']), matched_rows
+
+
+def _sorted(result, plan):
+    if not plan['sort']:
+        return result
+    return result.sort_values(
+        [s['column'] for s in plan['sort']],
+        ascending=[not s['desc'] for s in plan['sort']],
+        kind='stable',
+    )
+
+
+# Chunk-wise execution. Aggregates are computed as mergeable partials per chunk
+# (sums, counts, sums of squares, extrema) and combined at the end.
+_PARTIALS = {
+    'sum': ['sum'], 'count': ['count'], 'min': ['min'], 'max': ['max'],
+    'mean': ['sum', 'count'], 'std': ['sum', 'count', 'sumsq'],
+}
+_COMBINE = {'sum': 'sum', 'count': 'sum', 'sumsq': 'sum', 'size': 'sum', 'min': 'min', 'max': 'max'}
+# Partial rows held before they are folded together again
+_COMPACT_ROWS = 200000
+
+
+def _partial_spec(aggregate):
+    """Partial columns needed for ``aggregate``: name -> (source column, partial)."""
+    spec = {}
+    for a in aggregate:
+        if a['column'] == '*':
+            spec['*|size'] = ('*', 'size')
+            continue
+        if a['func'] not in _PARTIALS:
+            raise QueryPlanError(f'{a["func"]} is not available for large datasets')
+        for part in _PARTIALS[a['func']]:
+            spec[f'{a["column"]}|{part}'] = (a['column'], part)
+    return spec
+
+
+def _chunk_partials(data, groupby, spec):
+    work = {}
+    named = {}
+    for name, (column, part) in spec.items():
+        if part == 'size':
+            source = pd.Series(1, index=data.index)
+        elif part == 'sumsq':
+            source = data[column].astype(float) ** 2
+        else:
+            source = widened(data[column])
+        work[name] = source
+        named[name] = (name, 'sum' if part in ['size', 'sumsq'] else part)
+    work = pd.DataFrame(work, index=data.index)
+    if groupby:
+        keys = [data[c] for c in groupby]
+        return work.groupby(keys, dropna=False, observed=True).agg(**named)
+    return pd.DataFrame({name: [getattr(work[name], agg)()] for name, (_, agg) in named.items()})
+
+
+def _combine_partials(partials, groupby, spec):
+    frame = pd.concat(partials)
+    combine = {name: _COMBINE[part] for name, (_, part) in spec.items()}
+    if groupby:
+        return frame.groupby(level=list(range(len(groupby))), dropna=False, observed=True).agg(combine)
+    return frame.agg(combine).to_frame().T
+
+
+def aggregate_chunks(chunks, groupby, aggregate, filters=()):
+    """Grouped aggregates over an iterable of chunks; the chunk-wise counterpart of a groupby/agg.
+
+    Returns ``(result, matched_rows)`` with one row per group and aggregate
+    columns named as in ``execute_plan``.
+    """
+    spec = _partial_spec(aggregate)
+    partials = []
+    held = 0
+    matched_rows = 0
+    for chunk in chunks:
+        mask = np.ones(len(chunk), dtype=bool)
+        for f in filters:
+            mask &= _filter_mask(chunk[f['column']], f['op'], f['value'])
+        matched_rows += int(mask.sum())
+        data = chunk[mask] if filters else chunk
+        partial = _chunk_partials(data, groupby, spec)
+        partials.append(partial)
+        held += len(partial)
+        if held > _COMPACT_ROWS:
+            partials = [_combine_partials(partials, groupby, spec)]
+            held = len(partials[0])
+    if not partials:
+        raise QueryPlanError('The dataset has no rows')
+    combined = _combine_partials(partials, groupby, spec)
+
+    result = {}
+    for a in aggregate:
+        column, func = a['column'], a['func']
+        name = _output_name(column, func)
+        if column == '*':
+            result[name] = combined['*|size']
+        elif func in ['sum', 'count', 'min', 'max']:
+            result[name] = combined[f'{column}|{func}']
+        else:
+            total = combined[f'{column}|sum']
+            n = combined[f'{column}|count'].astype(float)
+            if func == 'mean':
+                result[name] = total / n.where(n > 0)
+            else:
+                variance = (combined[f'{column}|sumsq'] - total ** 2 / n.where(n > 0)) / (n - 1).where(n > 1)
+                result[name] = np.sqrt(variance.clip(lower=0))
+    result = pd.DataFrame(result)
+    if groupby:
+        result = result.reset_index()
+    return result, matched_rows
+
+
+def _referenced_columns(plan):
+    columns = {f['column'] for f in plan['filters']} | set(plan['groupby'])
+    columns |= {a['column'] for a in plan['aggregate'] if a['column'] != '*'}
+    return columns
+
+
+def _execute_chunked(plan, source):
+    if plan['aggregate'] or plan['groupby']:
+        aggregate = plan['aggregate'] or [{'column': '*', 'func': 'count'}]
+        chunks = source.iter_chunks(_referenced_columns(plan) or [source.columns[0]])
+        result, matched_rows = aggregate_chunks(chunks, plan['groupby'], aggregate, plan['filters'])
+        return _sorted(result, plan).head(plan['limit']), matched_rows
+
+    # Row selection: keep only the best ``limit`` candidates seen so far
+    columns = plan['select'] or list(source.columns)
+    limit = plan['limit']
+    candidates = None
+    matched_rows = 0
+    for chunk in source.iter_chunks(set(columns) | _referenced_columns(plan)):
+        mask = np.ones(len(chunk), dtype=bool)
+        for f in plan['filters']:
+            mask &= _filter_mask(chunk[f['column']], f['op'], f['value'])
+        matched_rows += int(mask.sum())
+        if candidates is not None and len(candidates) >= limit and not plan['sort']:
+            continue
+        data = chunk.loc[mask, columns]
+        candidates = data if candidates is None else pd.concat([candidates, data], ignore_index=True)
+        candidates = _sorted(candidates, plan).head(limit)
+    if candidates is None:
+        raise QueryPlanError('The dataset has no rows')
+    return candidates, matched_rows
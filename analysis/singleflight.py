@@ -0,0 +1,170 @@
+"""Coalesce duplicate in-flight work across requests and worker processes.
+
+Double-clicks, client retries and several open tabs can send the same upload
+or question twice. Work is keyed by user, chat, action and a payload hash
+(``work_key``); the payload must include everything the result depends on,
+such as the dataset a question is asked about. The first request for a key
+takes an exclusive ``flock`` on a lock file shared by every worker process on
+the host and does the work; the others wait for the lock to be released and
+then read the leader's result, which is kept for ``SINGLE_FLIGHT_RESULT_TTL``
+seconds so late retries share it too. A leader that crashes drops its lock
+with its process, so nothing is left held; followers that find no result
+take over.
+"""
+import hashlib
+import json
+import os
+import time
+
+from django.conf import settings
+
+try:
+    import fcntl
+except ImportError:  # no flock (e.g. Windows): every request does its own work
+    fcntl = None
+
+_POLL_INTERVAL = 0.05
+# Lock and result files older than this are removed when a leader publishes
+_PRUNE_AFTER = 300
+
+
+def work_key(user_id, chat_id, action: str, payload) -> str:
+    data = json.dumps([user_id, chat_id, action, payload], sort_keys=True, default=str)
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+def _directory():
+    return settings.SINGLE_FLIGHT_DIR
+
+
+class Flight:
+    """One request's claim on a key; use as a context manager.
+
+    On entry either ``leader`` is True and the caller does the work and calls
+    ``publish(result)`` if it succeeded, or ``result`` holds the result another
+    request published for the same key. A leader that exits without publishing
+    lets the next duplicate lead. If waiting exceeds ``timeout`` the caller
+    leads uncoordinated rather than fail.
+    """
+
+    def __init__(self, key: str, timeout: float = None):
+        self.key = key
+        self.timeout = settings.SINGLE_FLIGHT_TIMEOUT if timeout is None else timeout
+        self.leader = False
+        self.result = None
+        self._file = None
+        self._locked = False
+
+    def _path(self, suffix):
+        return os.path.join(_directory(), self.key + suffix)
+
+    def __enter__(self):
+        if fcntl is None:
+            self.leader = True
+            return self
+        os.makedirs(_directory(), exist_ok=True)
+        self._file = open(self._path('.lock'), 'a+')
+        deadline = time.monotonic() + self.timeout
+        while True:
+            if self._try_lock(fcntl.LOCK_EX):
+                self._locked = True
+                found, self.result = self._read_result()
+                if found:
+                    self._unlock()
+                else:
+                    self.leader = True
+                return self
+            if not self._wait_for_leader(deadline):
+                self.leader = True
+                return self
+            found, self.result = self._read_result()
+            if found:
+                return self
+            # The leader failed without publishing; contend for the lock again
+
+    def __exit__(self, *exc):
+        self._unlock()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        return False
+
+    def publish(self, result):
+        """Store the leader's (JSON-serializable) result for followers and late duplicates."""
+        if fcntl is None:
+            return
+        path = self._path('.json')
+        tmp = f'{path}.{os.getpid()}.tmp'
+        with open(tmp, 'w') as fh:
+            json.dump(result, fh)
+        os.replace(tmp, path)
+        _prune()
+
+    def _try_lock(self, mode):
+        try:
+            fcntl.flock(self._file, mode | fcntl.LOCK_NB)
+            return True
+        except BlockingIOError:
+            return False
+
+    def _unlock(self):
+        if self._locked:
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+            self._locked = False
+
+    def _wait_for_leader(self, deadline) -> bool:
+        while time.monotonic() < deadline:
+            if self._try_lock(fcntl.LOCK_SH):
+                fcntl.flock(self._file, fcntl.LOCK_UN)
+                return True
+            time.sleep(_POLL_INTERVAL)
+        return False
+
+    def _read_result(self):
+        path = self._path('.json')
+        try:
+            if time.time() - os.path.getmtime(path) > settings.SINGLE_FLIGHT_RESULT_TTL:
+                return False, None
+            with open(path) as fh:
+                return True, json.load(fh)
+        except (OSError, ValueError):
+            return False, None
+
+
+def _prune():
+    cutoff = time.time() - _PRUNE_AFTER
+    try:
+        entries = list(os.scandir(_directory()))
+    except OSError:
+        return
+    for entry in entries:
+        try:
+            if entry.stat().st_mtime >= cutoff:
+                continue
+            if not entry.name.endswith('.lock'):
+                os.unlink(entry.path)
+                continue
+            # Leave lock files of work that is still running
+            with open(entry.path, 'a+') as fh:
+                try:
+                    fcntl.flock(fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue
+                os.unlink(entry.path)
+        except OSError:
+            pass
+
+
+def single_flight(key: str, work, timeout: float = None, succeeded=None):
+    """``work()``'s result, computed at most once at a time per ``key`` across processes on this host.
+
+    Only results for which ``succeeded(result)`` holds (all, by default) are
+    shared; after a failure, waiting duplicates and retries do the work again.
+    """
+    with Flight(key, timeout) as flight:
+        if not flight.leader:
+            return flight.result
+        result = work()
+        if succeeded is None or succeeded(result):
+            flight.publish(result)
+        return result
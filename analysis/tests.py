@@ -1,3 +1,1101 @@
-from django.test import TestCase
+import base64
+import hashlib
+import json
+import mmap
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from io import BytesIO
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+import httpx
+import numpy as np
+import openai
+import pandas as pd
+from django.conf import settings
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection
+from django.db.migrations.executor import MigrationExecutor
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from users.models import CustomUser
+
+from .benchmarks import compare_to_baseline, synthetic_csv
+from . import charts
+from .charts import build_spec_payload, chart_memo, render_spec_chart, store_chart_png
+from .dataframes import (
+    DataFrameCache, dataframe_cache, load_dataset_frame, load_dataset_source, read_columnar_sidecar, read_dataset_file,
+    sidecar_path, write_columnar_sidecar,
+)
+from .dtypes import normalize_dtypes
+from .ingest import CSVTooLarge, CSVValidationError, read_validated_csv
+from .downsampling import OTHER_LABEL, lttb_indices, sample_scatter, top_n_with_other
+from .llm import LLMClient, LLMUnavailable, LocalBackend, OpenAIBackend, llm_client
+from .llm_cache import LLMResponseCache, MemoryBackend, SQLiteBackend, llm_cache
+from .jobs import claim_next_job, requeue_stale_jobs, run_job
+from .models import AnalysisJob, Chat, ChatMessage, DataSet
+from .profiling import build_profile, describe_profile
+from .prompts import describe_dataset, describe_result, estimate_tokens
+from .query import QueryPlanError, execute_plan, validate_plan
+from .singleflight import single_flight
+from .utils import analyze_upload, answer_with_chart, run_concurrently
+
+# Maximum queries per action, as labelled by RequestMetricsMiddleware.
+# Raise a budget only together with the change that needs it. The GET budget
+# covers a first visit, which also creates the user's first chat; the stream
+# budget covers the request itself, not the save after the stream completes;
+# the export budget likewise excludes its two streamed queries, and the
+# import budget covers a file that fits in one batch.
+QUERY_BUDGETS = {
+    'analysis-home:GET': 7,
+    'analysis-home:new_chat': 6,
+    'analysis-home:switch_chat': 4,
+    'analysis-home:save_chat': 5,
+    'analysis-home:delete_chat': 10,
+    'analysis-home:upload': 13,
+    'analysis-home:question': 6,
+    'analysis-stream-question:POST': 4,
+    'analysis-chat-messages:GET': 4,
+    'analysis-message-chart-data:GET': 3,
+    'analysis-job-status:GET': 4,
+    'analysis-export-chats:GET': 2,
+    'analysis-import-chats:POST': 8,
+}
+
+
+class FakeCompletions:
+    """Stand-in for ``client.chat.completions`` returning canned, prompt-appropriate replies."""
+
+    def create(self, model, messages, stream=False, **kwargs):
+        system = messages[0]['content']
+        if 'query plans' in system:
+            text = '{"groupby": ["region"], "aggregate": [{"column": "revenue", "func": "sum"}], "sort": [{"column": "revenue_sum", "desc": true}]}'
+        elif 'JSON specs' in system:
+            text = '{"type": "bar", "x": "region", "y": "revenue", "agg": "sum", "title": "Revenue"}'
+        elif 'titles' in system:
+            text = 'Regional Sales'
+        else:
+            text = 'Revenue is highest in the North.'
+        if stream:
+            return iter([
+                SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=word))])
+                for word in re.findall(r'\S+\s*', text)
+            ])
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=text))])
+
+
+def sales_csv(rows=200):
+    lines = ['region,revenue,units']
+    lines += [f'{"NSEW"[i % 4]},{i * 1.5},{i}' for i in range(rows)]
+    return ('\n'.join(lines) + '\n').encode()
+
+
+class ActionBudgetTestCase(TestCase):
+    """Drives ``analysis.views`` through the test client with a fake LLM client."""
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root, ignore_errors=True)
+        overrides = override_settings(
+            MEDIA_ROOT=self.media_root,
+            ANALYSIS_ASYNC_UPLOADS=False,
+            CHART_RENDER_WORKERS=0,
+            SINGLE_FLIGHT_DIR=os.path.join(self.media_root, 'inflight'),
+        )
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        patcher = mock.patch.object(llm_client, 'backend', OpenAIBackend(SimpleNamespace(chat=SimpleNamespace(completions=FakeCompletions()))))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        for cache in (dataframe_cache, llm_cache, chart_memo):
+            cache.clear()
+
+        self.user = CustomUser.objects.create_user(username='analyst', password='pw-12345-x')
+        self.client.force_login(self.user)
+
+    def post_action(self, form_type, **data):
+        return self.client.post('/home/', dict(data, form_type=form_type), HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+
+    def upload(self, rows=200):
+        return self.post_action('upload', file=SimpleUploadedFile('sales.csv', sales_csv(rows), content_type='text/csv'))
+
+    def assertWithinBudget(self, response):
+        action = response.metrics['action']
+        self.assertIn(action, QUERY_BUDGETS, f'No query budget for {action}')
+        self.assertLessEqual(
+            response.metrics['queries'], QUERY_BUDGETS[action],
+            f'{action} issued {response.metrics["queries"]} queries (budget {QUERY_BUDGETS[action]})',
+        )
+
+
+class QueryBudgetTests(ActionBudgetTestCase):
+    def test_every_action_stays_within_budget(self):
+        self.assertWithinBudget(self.client.get('/home/'))
+
+        response = self.upload()
+        self.assertTrue(response.json()['success'])
+        self.assertWithinBudget(response)
+        job_id = response.json()['job_id']
+        self.assertWithinBudget(self.client.get(f'/home/jobs/{job_id}/'))
+
+        response = self.post_action('question', question='Which region sells most?')
+        self.assertTrue(response.json()['success'])
+        self.assertWithinBudget(response)
+
+        response = self.client.post('/home/stream/', {'question': 'And the least?'})
+        b''.join(response.streaming_content)
+        self.assertWithinBudget(response)
+
+        chat = Chat.objects.get(user=self.user)
+        self.assertWithinBudget(self.client.get(f'/home/chats/{chat.id}/messages/'))
+        self.assertWithinBudget(self.post_action('save_chat', chat_id=chat.id))
+        self.assertWithinBudget(self.post_action('new_chat'))
+        self.assertWithinBudget(self.post_action('switch_chat', chat_id=chat.id))
+        other = Chat.objects.filter(user=self.user).exclude(id=chat.id).get()
+        self.assertWithinBudget(self.post_action('delete_chat', chat_id=other.id))
+
+    def test_history_queries_do_not_grow_with_chat_length(self):
+        self.client.get('/home/')  # first visit initializes the session's active chat
+        chat = Chat.objects.create(user=self.user, title='Long chat')
+        ChatMessage.objects.create(chat=chat, type='question', content='q', response='r')
+        short = self.post_action('switch_chat', chat_id=chat.id)
+        ChatMessage.objects.bulk_create([
+            ChatMessage(chat=chat, type='question', content=f'q{i}', response='r') for i in range(200)
+        ])
+        long = self.post_action('switch_chat', chat_id=chat.id)
+        self.assertEqual(short.metrics['queries'], long.metrics['queries'])
+        self.assertIsNotNone(long.json()['next_cursor'])
+
+    def test_chat_counters_track_new_messages(self):
+        self.client.get('/home/')
+        chat = Chat.objects.get(user=self.user)
+        self.assertFalse(self.post_action('new_chat').json()['success'])
+        self.upload()
+        self.post_action('question', question='Which region sells most?')
+        chat.refresh_from_db()
+        self.assertEqual(chat.message_count, 2)
+        self.assertTrue(self.post_action('new_chat').json()['success'])
+
+    def test_sidebar_keeps_creation_order(self):
+        first = Chat.objects.create(user=self.user, title='First', message_count=1)
+        empty = Chat.objects.create(user=self.user, title='Empty')
+        last = Chat.objects.create(user=self.user, title='Last', message_count=1)
+        response = self.client.get('/home/')
+        self.assertWithinBudget(response)
+        self.assertEqual([c['id'] for c in response.context['chats']], [first.id, empty.id, last.id])
+
+    def test_stage_timings_are_recorded(self):
+        self.upload()
+        response = self.post_action('question', question='Which region sells most?')
+        for key in ('queries', 'sql_ms', 'wall_ms'):
+            self.assertIn(key, response.metrics)
+        self.assertIn('render_ms', response.metrics)
+        self.assertGreater(response.metrics['prompt_tokens'], 0)
+
+
+class QueryPlanTests(SimpleTestCase):
+    def setUp(self):
+        self.df = pd.read_csv(BytesIO(sales_csv(1000)))
+
+    def test_grouped_aggregate_covers_every_row(self):
+        plan = validate_plan({
+            'filters': [{'column': 'units', 'op': '>=', 'value': '100'}],
+            'groupby': ['region'],
+            'aggregate': [{'column': 'revenue', 'func': 'sum'}, {'column': '*', 'func': 'count'}],
+            'sort': [{'column': 'revenue_sum', 'desc': True}],
+            'limit': 2,
+        }, self.df)
+        result, matched = execute_plan(plan, self.df)
+        self.assertEqual(matched, 900)
+        self.assertEqual(list(result.columns), ['region', 'revenue_sum', 'count'])
+        self.assertEqual(len(result), 2)
+        expected = self.df[self.df.units >= 100].groupby('region').revenue.sum().max()
+        self.assertEqual(result.iloc[0]['revenue_sum'], expected)
+
+    def test_plans_are_checked_against_the_schema(self):
+        for plan in [
+            {'groupby': ['country']},
+            {'aggregate': [{'column': 'region', 'func': 'mean'}]},
+            {'filters': [{'column': 'units', 'op': 'like', 'value': 1}]},
+            {'aggregate': [{'column': 'units', 'func': 'sum'}], 'sort': [{'column': 'units'}]},
+        ]:
+            with self.assertRaises(QueryPlanError):
+                validate_plan(plan, self.df)
+
+    def test_limit_is_capped(self):
+        plan = validate_plan({'select': ['units'], 'limit': 10_000}, self.df)
+        result, _ = execute_plan(plan, self.df)
+        self.assertEqual(len(result), 50)
+
+
+class ProfileTests(ActionBudgetTestCase):
+    def test_upload_stores_profile(self):
+        self.upload()
+        profile = DataSet.objects.get(user=self.user).profile
+        self.assertEqual(profile['rows'], 200)
+        columns = {c['name']: c for c in profile['columns']}
+        self.assertEqual(columns['region']['distinct'], 4)
+        self.assertEqual(columns['units']['max'], 199)
+        self.assertEqual(sum(columns['units']['histogram']['counts']), 200)
+        self.assertIn('Sample rows', describe_profile(profile))
+
+    def test_profile_is_backfilled_for_older_datasets(self):
+        self.upload()
+        DataSet.objects.update(profile=None)
+        dataframe_cache.clear()
+        self.assertTrue(self.post_action('question', question='Which region sells most?').json()['success'])
+        self.assertEqual(DataSet.objects.get(user=self.user).profile['rows'], 200)
+
+    def test_profile_is_json_safe_with_missing_values(self):
+        df = pd.DataFrame({'a': [1.0, None, 3.0], 'b': ['x', None, 'x']})
+        profile = build_profile(df)
+        a, b = profile['columns']
+        self.assertEqual(a['nulls'], 1)
+        self.assertEqual(b['top'], [['x', 2]])
+        self.assertIsNone(profile['preview']['rows'][1][0])
+
+
+class PromptBudgetTests(SimpleTestCase):
+    def test_wide_dataset_description_stays_within_budget(self):
+        df = pd.DataFrame({f'col_{i}': np.arange(50) * i for i in range(300)})
+        profile = build_profile(df)
+        text = describe_dataset(profile, 800, question='What is the total of col_250?', sample_rows=3)
+        self.assertLessEqual(estimate_tokens(text), 800)
+        self.assertIn('- col_250 (int64): 0 nulls', text)
+        self.assertIn('Other columns (statistics omitted)', text)
+        self.assertGreater(estimate_tokens(describe_profile(profile)), 8000)
+
+    def test_result_table_is_truncated_to_budget(self):
+        result = pd.DataFrame({f'c{i}': np.arange(50) for i in range(40)})
+        text = describe_result(result, 300)
+        self.assertLessEqual(estimate_tokens(text), 300)
+        self.assertRegex(text, r'showing \d+ of 50 rows, \d+ of 40 columns')
+
+
+class CSVValidationTests(SimpleTestCase):
+    def test_row_limit_stops_parsing_early(self):
+        data = sales_csv(200_000)
+        fileobj = BytesIO(data)
+        with self.assertRaises(CSVTooLarge):
+            read_validated_csv(fileobj, max_rows=1000, chunksize=500)
+        # Only the parser's first buffer was consumed, not the whole file
+        self.assertLess(fileobj.tell(), len(data) // 4)
+
+        df = read_validated_csv(BytesIO(data), max_rows=200_000, chunksize=50_000)
+        self.assertEqual(len(df), 200_000)
+        self.assertEqual(df['units'].iloc[-1], 199_999)
+
+    def test_header_and_content_checks(self):
+        wide = ','.join(f'c{i}' for i in range(6)) + '\n' + ','.join('1' * 6) + '\n'
+        for data, message in [
+            (wide, 'too many columns'),
+            ('name,city\na,b\n', 'numeric data'),
+            ('units,region\n', 'no data rows'),
+        ]:
+            with self.assertRaisesRegex(CSVValidationError, message):
+                read_validated_csv(BytesIO(data.encode()), max_columns=5)
+
+
+class DataFrameCacheTests(ActionBudgetTestCase):
+    def test_bytes_are_accounted_and_least_recent_frames_evicted(self):
+        frames = {key: pd.DataFrame({'v': np.arange(1000, dtype='int64')}) for key in 'abc'}
+        size = int(frames['a'].memory_usage(deep=True).sum())
+        cache = DataFrameCache(max_bytes=2 * size)
+        cache.put('a', 1, frames['a'])
+        cache.put('b', 1, frames['b'])
+        self.assertIs(cache.get('a', 1), frames['a'])  # 'b' is now the least recently used
+        cache.put('c', 1, frames['c'])
+        self.assertIsNone(cache.get('b', 1))
+        self.assertEqual(cache.stats(), {
+            'entries': 2, 'bytes': 2 * size, 'max_bytes': 2 * size, 'hits': 1, 'misses': 1, 'evictions': 1,
+        })
+
+        # A changed file signature drops the entry; a frame larger than the budget is never kept
+        self.assertIsNone(cache.get('a', 2))
+        cache.put('big', 1, pd.concat([frames['a']] * 3))
+        self.assertEqual((cache.stats()['entries'], cache.stats()['bytes']), (1, size))
+
+    def test_questions_reuse_the_parsed_frame(self):
+        self.upload()
+        dataframe_cache.clear()
+        dataset = DataSet.objects.get(user=self.user)
+        first = load_dataset_frame(dataset)
+        hits = dataframe_cache.hits
+        response = self.post_action('question', question='Which region sells most?')
+        self.assertGreater(dataframe_cache.hits, hits)
+        self.assertNotIn('parse_ms', response.metrics)
+        self.assertIs(load_dataset_frame(dataset), first)
+        # Replacing the file invalidates the cached copy
+        os.utime(dataset.file.path, ns=(0, 0))
+        self.assertIsNot(load_dataset_frame(dataset), first)
+
+
+class ColumnarSidecarTests(ActionBudgetTestCase):
+    def test_sidecar_round_trips_memory_mapped_and_is_ignored_once_stale(self):
+        path = os.path.join(self.media_root, 'mixed.csv')
+        pd.DataFrame({
+            'id': range(50), 'amount': np.arange(50) * 1.5, 'region': ['N', 'S'] * 25,
+            'note': ['x', None] * 25, 'flag': [True, False] * 25,
+        }).to_csv(path, index=False)
+        df, schema = normalize_dtypes(pd.read_csv(path))
+        self.assertTrue(write_columnar_sidecar(path, df))
+        loaded = read_columnar_sidecar(path)
+        self.assertTrue(loaded.equals(df))
+        self.assertEqual(dict(loaded.dtypes), dict(df.dtypes))
+        base = loaded['amount'].to_numpy()
+        while isinstance(base, np.ndarray):
+            base = base.base
+        self.assertIsInstance(base, mmap.mmap)
+
+        # Rewriting the CSV changes its (mtime, size) signature, so the old columns are not served
+        pd.DataFrame({'id': [1, 2], 'amount': [3.0, 4.0], 'region': ['E', 'W'], 'note': ['y', 'z'],
+                      'flag': [False, True]}).to_csv(path, index=False)
+        self.assertIsNone(read_columnar_sidecar(path))
+        self.assertEqual(read_dataset_file(path, schema)['region'].tolist(), ['E', 'W'])
+
+
+class DtypeTests(ActionBudgetTestCase):
+    def test_upload_normalizes_and_persists_schema(self):
+        self.upload()
+        dataset = DataSet.objects.get(user=self.user)
+        self.assertEqual(dataset.schema, {'region': 'category', 'revenue': 'float32', 'units': 'uint8'})
+        self.assertLess(dataset.profile['memory_bytes'], dataset.profile['memory_bytes_raw'])
+
+        # Without the sidecar the CSV is re-read straight into the stored schema
+        shutil.rmtree(sidecar_path(dataset.file.path))
+        dataframe_cache.clear()
+        df = load_dataset_frame(dataset)
+        self.assertEqual({name: str(dtype) for name, dtype in df.dtypes.items()}, dataset.schema)
+        self.assertEqual(df['revenue'].sum(), sum(i * 1.5 for i in range(200)))
+
+    def test_dates_convert_only_when_every_value_parses_and_round_trip(self):
+        path = os.path.join(self.media_root, 'events.csv')
+        pd.DataFrame({
+            'at': ['2024-01-01T08:00:00+02:00', '2024-01-02T09:30:00+02:00', None, '2024-01-03T10:00:00+02:00'],
+            'day': ['2024-01-01', '2024-01-02', '2024-01-03', 'not a date'],
+        }).to_csv(path, index=False)
+        df, schema = normalize_dtypes(pd.read_csv(path))
+        self.assertEqual(schema['at'], 'datetime64[ns, UTC+02:00]')
+        self.assertEqual(df['day'].tolist()[-1], 'not a date')
+
+        # Tz-aware columns are stored without pickling and load memory-mapped
+        self.assertTrue(write_columnar_sidecar(path, df))
+        pd.testing.assert_frame_equal(read_columnar_sidecar(path), df)
+        # Without a usable sidecar the CSV reloads into the same schema
+        with open(os.path.join(sidecar_path(path), '0.npy'), 'wb') as fh:
+            fh.write(b'damaged')
+        reloaded = read_dataset_file(path, schema)
+        self.assertEqual({name: str(dtype) for name, dtype in reloaded.dtypes.items()}, schema)
+        pd.testing.assert_frame_equal(reloaded, df)
+
+
+class UploadDedupTests(ActionBudgetTestCase):
+    def upload_as(self, user, name='sales.csv'):
+        self.client.force_login(user)
+        return self.post_action('upload', file=SimpleUploadedFile(name, sales_csv(), content_type='text/csv'))
+
+    @override_settings(UPLOAD_DEDUP_SCOPE='global')
+    def test_identical_upload_reuses_file_and_analysis(self):
+        first = self.upload().json()
+        other = CustomUser.objects.create_user(username='other', password='pw-12345-x')
+        self.client.force_login(other)
+        self.client.get('/home/')
+        with mock.patch.object(FakeCompletions, 'create', side_effect=AssertionError('LLM called')):
+            response = self.upload_as(other, 'copy.csv')
+        self.assertTrue(response.json()['success'])
+        self.assertWithinBudget(response)
+        self.assertEqual(response.json()['gpt_response'], first['gpt_response'])
+        self.assertEqual(response.json()['chart_url'], first['chart_url'])
+
+        original, copy = DataSet.objects.order_by('id')
+        self.assertEqual((copy.user, copy.name), (other, 'copy.csv'))
+        self.assertEqual(copy.file.name, original.file.name)
+        self.assertEqual(copy.profile, original.profile)
+        self.assertEqual(len(os.listdir(os.path.join(self.media_root, 'datasets'))), 2)  # CSV and its sidecar
+        self.assertEqual(Chat.objects.get(user=other).title, 'copy.csv')
+
+    def test_default_scope_does_not_share_across_users(self):
+        self.upload()
+        other = CustomUser.objects.create_user(username='other', password='pw-12345-x')
+        self.client.force_login(other)
+        self.client.get('/home/')
+        self.assertTrue(self.upload_as(other).json()['success'])
+        first, second = DataSet.objects.order_by('id')
+        self.assertEqual(first.content_hash, second.content_hash)
+        self.assertNotEqual(first.file.name, second.file.name)
+
+
+@override_settings(ANALYSIS_JOB_MAX_ATTEMPTS=2)
+class JobQueueTests(ActionBudgetTestCase):
+    def setUp(self):
+        super().setUp()
+        # Leave uploads queued for the worker functions under test
+        override = override_settings(ANALYSIS_ASYNC_UPLOADS=True)
+        override.enable()
+        self.addCleanup(override.disable)
+
+    def queued_job(self):
+        self.client.get('/home/')
+        job_id = self.upload().json()['job_id']
+        return AnalysisJob.objects.get(id=job_id)
+
+    def age(self, job, seconds):
+        past = timezone.now() - timedelta(seconds=seconds)
+        AnalysisJob.objects.filter(id=job.id).update(started_at=past, heartbeat_at=past)
+
+    def test_claim_runs_each_job_once(self):
+        job = self.queued_job()
+        self.assertEqual(job.status, AnalysisJob.STATUS_PENDING)
+        claimed = claim_next_job()
+        self.assertEqual((claimed.id, claimed.status, claimed.attempts), (job.id, AnalysisJob.STATUS_RUNNING, 1))
+        self.assertIsNone(claim_next_job())
+        run_job(claimed)
+        job.refresh_from_db()
+        self.assertEqual(job.status, AnalysisJob.STATUS_DONE)
+        self.assertEqual(job.chat.messages.count(), 1)
+
+    def test_inline_upload_is_not_claimable_by_a_worker(self):
+        claimed = []
+
+        def analyze(*args):
+            claimed.append(claim_next_job())
+            return 'Analysis', 'Title'
+
+        self.client.get('/home/')
+        with override_settings(ANALYSIS_ASYNC_UPLOADS=False), mock.patch('analysis.jobs.analyze_upload', analyze):
+            body = self.upload().json()
+        self.assertEqual(claimed, [None])
+        job = AnalysisJob.objects.get(id=body['job_id'])
+        self.assertEqual((job.status, job.attempts), (AnalysisJob.STATUS_DONE, 1))
+        self.assertEqual(job.chat.messages.count(), 1)
+
+    def test_only_jobs_with_a_stale_heartbeat_are_requeued_up_to_the_attempt_limit(self):
+        job = self.queued_job()
+        claim_next_job()
+        self.assertEqual(requeue_stale_jobs(timedelta(seconds=60)), 0)
+        self.age(job, 120)
+        self.assertEqual(requeue_stale_jobs(timedelta(seconds=60)), 1)
+        self.assertEqual(claim_next_job().attempts, 2)
+
+        self.age(job, 120)
+        self.assertEqual(requeue_stale_jobs(timedelta(seconds=60)), 0)
+        job.refresh_from_db()
+        self.assertEqual(job.status, AnalysisJob.STATUS_FAILED)
+
+    def test_run_that_lost_its_claim_does_not_record_an_outcome(self):
+        job = self.queued_job()
+        first = claim_next_job()
+        self.age(job, 120)
+        requeue_stale_jobs(timedelta(seconds=60))
+        second = claim_next_job()
+        run_job(first)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), (AnalysisJob.STATUS_RUNNING, 2))
+        self.assertEqual(job.chat.messages.count(), 0)
+        run_job(second)
+        job.refresh_from_db()
+        self.assertEqual(job.status, AnalysisJob.STATUS_DONE)
+        self.assertEqual(job.chat.messages.count(), 1)
+
+
+class SingleFlightTests(ActionBudgetTestCase):
+    def test_concurrent_duplicates_share_one_computation(self):
+        calls = []
+
+        def work():
+            calls.append(1)
+            time.sleep(0.3)
+            return {'answer': 42}
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(single_flight('k', work))) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [{'answer': 42}] * 4)
+
+    def test_repeated_question_and_upload_are_coalesced(self):
+        self.client.get('/home/')
+        first_upload, second_upload = self.upload().json(), self.upload().json()
+        self.assertEqual(first_upload['job_id'], second_upload['job_id'])
+        self.assertEqual(DataSet.objects.count(), 1)
+
+        first = self.post_action('question', question='Which region sells most?').json()
+        with mock.patch.object(FakeCompletions, 'create', side_effect=AssertionError('LLM called')):
+            second = self.post_action('question', question='Which region sells most?').json()
+        self.assertEqual(first, second)
+        self.assertEqual(ChatMessage.objects.filter(type='question').count(), 1)
+
+        # A new dataset in the chat makes the same question new work
+        self.post_action('upload', file=SimpleUploadedFile('more.csv', sales_csv(300), content_type='text/csv'))
+        third = self.post_action('question', question='Which region sells most?').json()
+        self.assertTrue(third['success'])
+        self.assertEqual(ChatMessage.objects.filter(type='question').count(), 2)
+
+
+    def test_failures_are_not_shared_with_retries(self):
+        self.client.get('/home/')
+        self.upload()
+        busy = LLMUnavailable('The AI service is busy. Please try again in a moment.')
+        with mock.patch('analysis.views.answer_with_chart', side_effect=busy):
+            first = self.post_action('question', question='Which region sells most?').json()
+        self.assertFalse(first['success'])
+        second = self.post_action('question', question='Which region sells most?').json()
+        self.assertTrue(second['success'])
+
+        broken = mock.Mock(side_effect=busy)
+        with mock.patch('analysis.views.stream_answer_with_chart', broken):
+            self.client.post('/home/stream/', {'question': 'Which region sells least?'}).getvalue()
+        events = self.client.post('/home/stream/', {'question': 'Which region sells least?'}).getvalue().decode()
+        self.assertIn('event: done', events)
+        self.assertEqual(ChatMessage.objects.filter(type='question').count(), 2)
+
+
+class StreamedAnswerTests(ActionBudgetTestCase):
+    def stream(self, question='Which region sells most?'):
+        response = self.client.post('/home/stream/', {'question': question})
+        events = []
+        for block in b''.join(response.streaming_content).decode().split('\n\n')[:-1]:
+            fields = dict(line.split(': ', 1) for line in block.split('\n'))
+            events.append((fields.get('event', 'message'), json.loads(fields['data'])))
+        return response, events
+
+    def test_answer_arrives_as_deltas_then_done(self):
+        self.upload()
+        response, events = self.stream()
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        self.assertEqual(response['Cache-Control'], 'no-cache')
+        deltas = [data['delta'] for event, data in events if event == 'message']
+        self.assertGreater(len(deltas), 1)
+        self.assertEqual(''.join(deltas), 'Revenue is highest in the North.')
+        event, done = events[-1]
+        self.assertEqual(event, 'done')
+        self.assertEqual(done['question_answer'], ''.join(deltas))
+        self.assertIsNotNone(done['chart_url'])
+        message = ChatMessage.objects.get(type='question')
+        self.assertEqual((message.response, message.chart_url), (done['question_answer'], done['chart_url']))
+
+    def test_status_event_arrives_before_any_completion_is_requested(self):
+        self.upload()
+        calls = llm_client.calls
+        response = self.client.post('/home/stream/', {'question': 'Which region sells most?'})
+        content = iter(response.streaming_content)
+        first = next(content).decode()
+        self.assertEqual(llm_client.calls, calls)
+        self.assertTrue(first.startswith('event: status\n'))
+        b''.join(content)
+        self.assertGreater(llm_client.calls, calls)
+
+    def test_failed_stream_ends_with_an_error_event_and_saves_nothing(self):
+        self.upload()
+
+        def broken(*args, **kwargs):
+            yield 'delta', 'Revenue'
+            raise LLMUnavailable('The model is unavailable.')
+
+        with mock.patch('analysis.views.stream_answer_with_chart', broken):
+            _, events = self.stream()
+        self.assertEqual(events[:2], [('status', {'status': 'thinking'}), ('message', {'delta': 'Revenue'})])
+        self.assertEqual(events[-1], ('error', {'success': False, 'error': 'The model is unavailable.'}))
+        self.assertFalse(ChatMessage.objects.filter(type='question').exists())
+
+    def test_question_without_a_dataset_is_refused(self):
+        response = self.client.post('/home/stream/', {'question': 'Anything?'})
+        self.assertFalse(response.json()['success'])
+
+
+class ChatHistoryPagingTests(ActionBudgetTestCase):
+    def test_cursor_walk_returns_every_message_once_in_order(self):
+        chat = Chat.objects.create(user=self.user, title='Long chat')
+        messages = ChatMessage.objects.bulk_create([
+            ChatMessage(chat=chat, type='question', content=f'q{i}', response='r') for i in range(45)
+        ])
+        # Ties on created_at are broken by id, so no message is skipped or repeated at a page boundary
+        same_time = timezone.now()
+        ChatMessage.objects.filter(id__in=[m.id for m in messages[15:25]]).update(created_at=same_time)
+        ChatMessage.objects.filter(id__in=[m.id for m in messages[25:]]).update(created_at=same_time + timedelta(seconds=1))
+
+        pages, params = [], {'limit': 10}
+        while True:
+            response = self.client.get(f'/home/chats/{chat.id}/messages/', params)
+            self.assertWithinBudget(response)
+            body = response.json()
+            pages.insert(0, [m['content'] for m in body['messages']])
+            if body['next_cursor'] is None:
+                break
+            params['cursor'] = body['next_cursor']
+        self.assertEqual([len(page) for page in pages], [5, 10, 10, 10, 10])
+        self.assertEqual(sum(pages, []), [m.content for m in messages])
+
+    def test_bad_cursor_other_users_chat_and_oversized_limit(self):
+        chat = Chat.objects.create(user=self.user, title='Chat')
+        ChatMessage.objects.bulk_create([ChatMessage(chat=chat, type='question', content=f'q{i}') for i in range(120)])
+        url = f'/home/chats/{chat.id}/messages/'
+        self.assertEqual(self.client.get(url, {'cursor': 'not-a-cursor'}).status_code, 400)
+        self.assertEqual(len(self.client.get(url, {'limit': 1000}).json()['messages']), settings.CHAT_PAGE_MAX_SIZE)
+        self.client.force_login(CustomUser.objects.create_user(username='other', password='pw-12345-x'))
+        self.assertEqual(self.client.get(url).status_code, 404)
+
+
+class ChatTransferTests(ActionBudgetTestCase):
+    def make_history(self, messages):
+        chat = Chat.objects.create(user=self.user, title='Sales', saved=True)
+        ChatMessage.objects.bulk_create([
+            ChatMessage(chat=chat, type='question', content=f'q{i}', response=f'r{i}') for i in range(messages)
+        ])
+        return chat
+
+    def export(self):
+        response = self.client.get('/home/chats/export/')
+        with CaptureQueriesContext(connection) as queries:
+            body = b''.join(response.streaming_content)
+        return response, body, len(queries)
+
+    def test_export_round_trips_into_another_account(self):
+        chat = self.make_history(3)
+        ChatMessage.objects.filter(chat=chat, content='q0').update(chart_key=store_chart_png(b'png-bytes'))
+        Chat.objects.create(user=self.user, title='Empty')
+        response, body, _ = self.export()
+        self.assertWithinBudget(response)
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+
+        other = CustomUser.objects.create_user(username='other', password='pw-12345-x')
+        self.client.force_login(other)
+        response = self.client.post('/home/chats/import/', body, content_type='application/x-ndjson')
+        self.assertWithinBudget(response)
+        self.assertEqual(response.json()['imported'], {'chats': 2, 'messages': 3})
+
+        copy = Chat.objects.get(user=other, title='Sales')
+        self.assertTrue(copy.saved)
+        self.assertEqual(copy.created_at, chat.created_at)
+        self.assertEqual(copy.message_count, 3)
+        original = list(chat.messages.values_list('content', 'response', 'chart_key', 'created_at'))
+        self.assertEqual(list(copy.messages.values_list('content', 'response', 'chart_key', 'created_at')), original)
+        self.assertTrue(Chat.objects.filter(user=other, title='Empty').exists())
+
+    def test_export_queries_do_not_grow_with_history(self):
+        self.make_history(3)
+        short = self.export()[2]
+        self.make_history(300)
+        long = self.export()[2]
+        self.assertEqual(short, long)
+
+    @override_settings(CHAT_TRANSFER_BATCH_SIZE=100)
+    def test_import_inserts_in_batches_and_rolls_back_bad_files(self):
+        self.make_history(450)
+        body = self.export()[1]
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post('/home/chats/import/', body, content_type='application/x-ndjson')
+        self.assertEqual(response.json()['imported'], {'chats': 1, 'messages': 450})
+        self.assertLess(len(queries), 20)
+
+        before = ChatMessage.objects.count()
+        response = self.client.post('/home/chats/import/', body + b'{"kind": "message", "chat": 999}\n', content_type='application/x-ndjson')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('Line 452', response.json()['error'])
+        self.assertEqual(ChatMessage.objects.count(), before)
+
+    def test_failed_import_removes_the_charts_it_stored(self):
+        kept = store_chart_png(b'already-stored')
+        lines = [
+            {'kind': 'chat', 'id': 1, 'title': 'Charts'},
+            {'kind': 'message', 'chat': 1, 'type': 'question', 'content': 'q', 'chart': base64.b64encode(b'new-chart').decode()},
+            {'kind': 'message', 'chat': 1, 'type': 'question', 'content': 'q', 'chart': base64.b64encode(b'already-stored').decode()},
+            {'kind': 'message', 'chat': 2},
+        ]
+        body = ''.join(json.dumps(line) + '\n' for line in lines).encode()
+        response = self.client.post('/home/chats/import/', body, content_type='application/x-ndjson')
+        self.assertEqual(response.status_code, 400)
+        new = hashlib.sha256(b'new-chart').hexdigest()
+        self.assertFalse(os.path.exists(os.path.join(self.media_root, 'charts', new[:2], f'{new}.png')))
+        self.assertTrue(os.path.exists(os.path.join(self.media_root, 'charts', kept[:2], f'{kept}.png')))
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+class RenderPoolTests(SimpleTestCase):
+    @override_settings(CHART_RENDER_WORKERS=1, CHART_RENDER_TIMEOUT=1)
+    def test_timed_out_render_restarts_the_pool(self):
+        payload = {'kind': 'bar', 'data': pd.Series([1, 2]), 'title': 'ok', 'options': {}}
+        charts.warm_pool()
+        pool = charts._get_pool()
+        self.addCleanup(lambda: charts._pool and charts._reset_pool(charts._pool, terminate=True))
+        [pid] = pool.worker_pids()
+        # Occupy the only renderer, as a hung render would
+        pool.submit(time.sleep, 60)
+        self.assertIsNone(charts.render_png(payload))
+        self.assertIsNot(charts._get_pool(), pool)
+        self.assertTrue(wait_for_exit(pid, timeout=5))
+        with override_settings(CHART_RENDER_TIMEOUT=30):
+            self.assertTrue(charts.render_png(payload).startswith(b'\x89PNG'))
+
+
+def wait_for_exit(pid, timeout):
+    """Whether process ``pid`` is gone (and reaped) within ``timeout`` seconds."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return True
+        time.sleep(0.05)
+    return False
+
+
+class DownsamplingTests(SimpleTestCase):
+    def test_lttb_keeps_endpoints_and_peaks(self):
+        y = np.zeros(100_000)
+        y[54_321] = 10.0
+        idx = lttb_indices(np.arange(len(y)), y, 500)
+        self.assertEqual(len(idx), 500)
+        self.assertEqual((idx[0], idx[-1]), (0, len(y) - 1))
+        self.assertIn(54_321, idx)
+
+    def test_top_n_folds_the_rest_into_other(self):
+        counts = pd.Series({f'c{i}': i for i in range(1, 21)})
+        reduced = top_n_with_other(counts, 5)
+        self.assertEqual(list(reduced.index[:5]), ['c20', 'c19', 'c18', 'c17', 'c16'])
+        self.assertEqual(reduced[OTHER_LABEL], sum(range(1, 16)))
+        self.assertEqual(reduced.sum(), counts.sum())
+
+    def test_scatter_sample_is_bounded_and_deterministic(self):
+        df = pd.DataFrame({'x': np.arange(50_000) % 997, 'y': np.arange(50_000)})
+        first = sample_scatter(df, 'x', 1000)
+        self.assertLessEqual(len(first), 1000)
+        self.assertTrue(first.equals(sample_scatter(df, 'x', 1000)))
+
+    def test_payload_size_does_not_grow_with_rows(self):
+        rng = np.random.default_rng(0)
+        df = pd.DataFrame({'t': np.arange(100_000), 'v': rng.normal(size=100_000), 'c': rng.integers(0, 300, 100_000)})
+        for spec, limit in [
+            ({'type': 'line', 'x': 't', 'y': 'v'}, settings.CHART_MAX_LINE_POINTS),
+            ({'type': 'scatter', 'x': 't', 'y': 'v'}, settings.CHART_MAX_SCATTER_POINTS),
+            ({'type': 'pie', 'x': 'c'}, settings.CHART_MAX_CATEGORIES + 1),
+            ({'type': 'bar', 'x': 'c', 'y': 'v', 'agg': 'mean'}, settings.CHART_MAX_CATEGORIES + 1),
+        ]:
+            self.assertLessEqual(len(build_spec_payload(spec, df, build_profile(df))['data']), limit, spec)
+
+
+class ChartMemoTests(ActionBudgetTestCase):
+    def test_equal_specs_on_equal_data_render_once(self):
+        df = pd.read_csv(BytesIO(sales_csv()))
+        spec = {'type': 'bar', 'x': 'region', 'y': 'revenue', 'agg': 'sum', 'title': 'Revenue'}
+        with mock.patch('analysis.charts.draw_png', wraps=charts.draw_png) as draw:
+            key = render_spec_chart(spec, df, content_hash='a' * 64)
+            # Same chart after normalization: case and fields that don't affect the image
+            same = dict(spec, type=' BAR ', color='red')
+            self.assertEqual(render_spec_chart(same, df, content_hash='a' * 64), key)
+            self.assertEqual(draw.call_count, 1)
+            self.assertEqual(chart_memo.stats(), {'entries': 1, 'hits': 1, 'misses': 1})
+
+            render_spec_chart(spec, df, content_hash='b' * 64)
+            self.assertEqual(draw.call_count, 2)
+            # A memoized key whose file is gone is rendered again
+            os.remove(os.path.join(self.media_root, 'charts', key[:2], f'{key}.png'))
+            self.assertEqual(render_spec_chart(spec, df, content_hash='a' * 64), key)
+            self.assertEqual(draw.call_count, 3)
+
+    @override_settings(SINGLE_FLIGHT_RESULT_TTL=0)  # otherwise the kept result answers the repeat
+    def test_repeated_question_skips_aggregation_and_render(self):
+        self.upload()
+        first = self.post_action('question', question='Which region sells most?')
+        self.assertIn('render_ms', first.metrics)
+        hits = chart_memo.hits
+        second = self.post_action('question', question='Which region sells most?')
+        self.assertEqual(chart_memo.hits, hits + 1)
+        self.assertEqual(second.json()['chart_url'], first.json()['chart_url'])
+        self.assertNotIn('render_ms', second.metrics)
+
+
+class ChartDataDeliveryTests(ActionBudgetTestCase):
+    @override_settings(CHART_DELIVERY='data')
+    def test_question_returns_chart_arrays_instead_of_png(self):
+        self.upload(rows=5000)
+        data = self.post_action('question', question='Which region sells most?').json()
+        self.assertIsNone(data['chart_url'])
+        chart = data['chart_data']
+        self.assertEqual(chart['kind'], 'bar')
+        self.assertEqual(sorted(chart['x']), ['E', 'N', 'S', 'W'])
+        self.assertEqual(sum(chart['y']), sum(i * 1.5 for i in range(5000)))
+        self.assertFalse(ChatMessage.objects.exclude(chart_key=None).exists())
+
+        chat = Chat.objects.get(user=self.user)
+        history = self.client.get(f'/home/chats/{chat.id}/messages/').json()['messages']
+        self.assertNotIn('chart_data', history[-1])
+        response = self.client.get(history[-1]['chart_data_url'])
+        self.assertWithinBudget(response)
+        self.assertEqual(response.json()['chart_data'], chart)
+        self.assertEqual(self.client.get(history[0]['chart_data_url']).json()['chart_data']['kind'], 'bar')
+        self.assertContains(self.client.get('/home/'), f'<div class="chart-data" data-url="{history[0]["chart_data_url"]}">')
+
+        self.client.force_login(CustomUser.objects.create_user(username='other', password='pw-12345-x'))
+        self.assertEqual(self.client.get(history[-1]['chart_data_url']).status_code, 404)
+
+    def test_history_pages_leave_chart_arrays_unloaded(self):
+        chat = Chat.objects.create(user=self.user, title='Charts')
+        ChatMessage.objects.create(chat=chat, type='question', content='q', chart_data={'kind': 'bar', 'x': [1], 'y': [2]})
+        ChatMessage.objects.create(chat=chat, type='question', content='plain')
+        with CaptureQueriesContext(connection) as queries:
+            history = self.client.get(f'/home/chats/{chat.id}/messages/').json()['messages']
+        # Only the IS NOT NULL flag is selected, never the arrays themselves
+        self.assertFalse(any(re.search(r'"chart_data"(?! IS NOT NULL)', q['sql']) for q in queries))
+        self.assertIsNotNone(history[0]['chart_data_url'])
+        self.assertIsNone(history[1]['chart_data_url'])
+
+
+class ChartAccessTests(ActionBudgetTestCase):
+    def test_only_the_owner_gets_a_chart_or_a_not_modified(self):
+        key = store_chart_png(b'\x89PNG chart')
+        chat = Chat.objects.create(user=self.user, title='Charts')
+        ChatMessage.objects.create(chat=chat, type='question', content='q', chart_key=key)
+        url = f'/home/charts/{key}.png'
+
+        response = self.client.get(url)
+        self.assertEqual(b''.join(response.streaming_content), b'\x89PNG chart')
+        self.assertEqual(response['ETag'], f'"{key}"')
+        self.assertEqual(response['Cache-Control'], 'private, max-age=31536000, immutable')
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=f'"{key}"').status_code, 304)
+
+        self.client.force_login(CustomUser.objects.create_user(username='other', password='pw-12345-x'))
+        self.assertEqual(self.client.get(url).status_code, 404)
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=f'"{key}"').status_code, 404)
+
+
+class ChartMigrationTests(TransactionTestCase):
+    def test_inline_charts_move_to_content_addressed_storage(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        executor = MigrationExecutor(connection)
+        before, after = [('analysis', '0004_analysisjob')], [('analysis', '0005_chatmessage_chart_key')]
+        executor.migrate(before)
+        self.addCleanup(lambda: MigrationExecutor(connection).migrate(executor.loader.graph.leaf_nodes()))
+        apps = executor.loader.project_state(before).apps
+        user = CustomUser.objects.create_user(username='legacy')  # users' tables stay at their latest state
+        chat = apps.get_model('analysis', 'Chat').objects.create(user_id=user.id, title='Old')
+        png = b'\x89PNG legacy'
+        message = apps.get_model('analysis', 'ChatMessage').objects.create(
+            chat_id=chat.id, type='analysis', content='a', chart=base64.b64encode(png).decode(),
+        )
+
+        with override_settings(MEDIA_ROOT=media_root):
+            executor = MigrationExecutor(connection)
+            executor.migrate(after)
+            apps = executor.loader.project_state(after).apps
+            key = apps.get_model('analysis', 'ChatMessage').objects.get(id=message.id).chart_key
+            self.assertEqual(key, hashlib.sha256(png).hexdigest())
+            with open(os.path.join(media_root, 'charts', key[:2], f'{key}.png'), 'rb') as fh:
+                self.assertEqual(fh.read(), png)
+
+
+@override_settings(DATASET_MAX_BYTES=1, LARGE_DATASET_MAX_BYTES=10 * 1024 * 1024)
+class PartitionedDatasetTests(ActionBudgetTestCase):
+    """Uploads over DATASET_MAX_BYTES are ingested chunk-wise; answers must match the in-memory path."""
+
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch('analysis.jobs.PARTITION_ROWS', 64)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_large_upload_is_partitioned_and_queryable(self):
+        self.client.get('/home/')  # first visit initializes the session's active chat
+        response = self.upload(rows=1000)
+        self.assertTrue(response.json()['success'])
+        self.assertWithinBudget(response)
+        dataset = DataSet.objects.get(user=self.user)
+        self.assertEqual(dataset.layout, DataSet.LAYOUT_PARTITIONED)
+        store = load_dataset_source(dataset)
+        self.assertEqual(len(store.manifest['partitions']), 16)
+
+        df = pd.read_csv(BytesIO(sales_csv(1000)))
+        exact = build_profile(df)
+        for streamed, full in zip(dataset.profile['columns'], exact['columns']):
+            for key in ['nulls', 'distinct', 'min', 'max', 'top', 'histogram']:
+                self.assertEqual(streamed.get(key), full.get(key), (streamed['name'], key))
+            if 'mean' in full:
+                self.assertAlmostEqual(streamed['mean'], full['mean'])
+                self.assertAlmostEqual(streamed['std'], full['std'])
+
+        plan = validate_plan({
+            'filters': [{'column': 'units', 'op': '>=', 'value': 100}],
+            'groupby': ['region'],
+            'aggregate': [{'column': 'revenue', 'func': 'mean'}, {'column': 'revenue', 'func': 'std'}, {'column': '*', 'func': 'count'}],
+            'sort': [{'column': 'region'}],
+        }, store)
+        chunked, chunked_matched = execute_plan(plan, store)
+        in_memory, matched = execute_plan(plan, df)
+        self.assertEqual(chunked_matched, matched)
+        pd.testing.assert_frame_equal(chunked.reset_index(drop=True), in_memory.reset_index(drop=True), check_dtype=False)
+
+        response = self.post_action('question', question='Which region sells most?')
+        self.assertTrue(response.json()['success'])
+        self.assertWithinBudget(response)
+        self.assertIsNotNone(response.json()['chart_url'])
+
+    def test_non_numeric_value_after_the_first_chunk_is_rejected(self):
+        self.client.get('/home/')
+        for column, first, late in [('units', '7', 'unknown'), ('active', 'True', 'yes')]:
+            rows = [f'N,1.5,{first}'] * 100 + [f'S,2.5,{late}']
+            csv = f'region,revenue,{column}\n' + '\n'.join(rows) + '\n'
+            response = self.post_action('upload', file=SimpleUploadedFile('late.csv', csv.encode(), content_type='text/csv'))
+            self.assertFalse(response.json()['success'], column)
+            self.assertIn(f"Column '{column}'", response.json()['error'])
+            self.assertIn(f"'{late}' on data row 101", response.json()['error'])
+        self.assertFalse(DataSet.objects.exists())
+
+    @override_settings(LARGE_DATASET_MAX_BYTES=0, DATASET_MAX_BYTES=10 * 1024 * 1024)
+    def test_row_limit_applies_when_large_datasets_are_disabled(self):
+        with mock.patch('analysis.jobs.read_validated_csv', lambda fh: read_validated_csv(fh, max_rows=500)):
+            response = self.upload(rows=1000)
+        self.assertFalse(response.json()['success'])
+        self.assertIn('too many rows', response.json()['error'])
+
+
+class BenchmarkTests(SimpleTestCase):
+    def test_synthetic_csv_is_deterministic_and_mixed(self):
+        data = synthetic_csv(500, 12)
+        self.assertEqual(data, synthetic_csv(500, 12))
+        df = pd.read_csv(BytesIO(data))
+        self.assertEqual(df.shape, (500, 12))
+        self.assertEqual(list(df.columns[:5]), ['id', 'region', 'day', 'amount', 'units'])
+        self.assertEqual({str(t) for t in df.dtypes}, {'int64', 'float64', 'object', 'bool'})
+
+    def test_regressions_need_relative_and_absolute_slowdown(self):
+        baseline = {'1000x5': {'upload': {'wall_ms': 100.0, 'render_ms': 4.0, 'queries': 12}}}
+        current = {'1000x5': {'upload': {'wall_ms': 150.0, 'render_ms': 8.0, 'queries': 13}}}
+        self.assertEqual(
+            compare_to_baseline(current, baseline, tolerance=0.3, min_delta_ms=10),
+            [('1000x5', 'upload', 'wall_ms', 100.0, 150.0), ('1000x5', 'upload', 'queries', 12, 13)],
+        )
+
+    def test_render_and_llm_stages_get_a_wider_allowance(self):
+        baseline = {'1000x5': {'question': {'render_ms': 70.0, 'openai_ms': 100.0, 'pandas_ms': 70.0}}}
+        current = {'1000x5': {'question': {'render_ms': 118.0, 'openai_ms': 210.0, 'pandas_ms': 118.0}}}
+        self.assertEqual(
+            compare_to_baseline(current, baseline, tolerance=0.3, min_delta_ms=10),
+            [('1000x5', 'question', 'openai_ms', 100.0, 210.0), ('1000x5', 'question', 'pandas_ms', 70.0, 118.0)],
+        )
+
+
+class LLMCacheTests(SimpleTestCase):
+    def backends(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        return [MemoryBackend(max_entries=2), SQLiteBackend(os.path.join(directory, 'llm.sqlite3'), max_entries=2)]
+
+    def test_entries_expire_and_least_recently_used_are_evicted(self):
+        for backend in self.backends():
+            with self.subTest(backend=type(backend).__name__), mock.patch('analysis.llm_cache.time.time') as now:
+                cache = LLMResponseCache(backend, ttl=60)
+                now.return_value = 1000.0
+                cache.set('a', 'A')
+                now.return_value = 1001.0
+                cache.set('b', 'B')
+                now.return_value = 1002.0
+                self.assertEqual(cache.get('a'), 'A')  # 'b' is now the least recently used
+                cache.set('c', 'C')
+                self.assertIsNone(cache.get('b'))
+                now.return_value = 1061.0
+                self.assertIsNone(cache.get('a'))
+                self.assertEqual(cache.get('c'), 'C')
+                self.assertEqual((cache.stats()['hits'], cache.stats()['misses']), (2, 2))
+
+    def test_sqlite_entries_are_shared_across_instances(self):
+        path = os.path.join(tempfile.mkdtemp(), 'llm.sqlite3')
+        self.addCleanup(shutil.rmtree, os.path.dirname(path), ignore_errors=True)
+        LLMResponseCache(SQLiteBackend(path, 10), ttl=60).set('k', 'answer')
+        self.assertEqual(LLMResponseCache(SQLiteBackend(path, 10), ttl=60).get('k'), 'answer')
+
+    def test_key_covers_model_parameters_and_prompt(self):
+        messages = [{'role': 'user', 'content': 'Which region sells most?'}]
+        key = LLMResponseCache.make_key('gpt-4o-mini', {'temperature': 0.7, 'max_tokens': 10}, messages)
+        self.assertEqual(key, LLMResponseCache.make_key('gpt-4o-mini', {'max_tokens': 10, 'temperature': 0.7}, messages))
+        self.assertNotEqual(key, LLMResponseCache.make_key('gpt-4o', {'temperature': 0.7, 'max_tokens': 10}, messages))
+        self.assertNotEqual(key, LLMResponseCache.make_key('gpt-4o-mini', {'temperature': 0, 'max_tokens': 10}, messages))
+
+
+class ConcurrentCallTests(SimpleTestCase):
+    def test_calls_run_in_parallel_and_report_in_order(self):
+        barrier = threading.Barrier(2, timeout=5)
+
+        def call(value):
+            barrier.wait()  # breaks unless both calls are running at once
+            return value
+
+        self.assertEqual(run_concurrently([(call, ('a',)), (call, ('b',))]), [('a', None), ('b', None)])
+
+    def test_failures_and_missed_deadlines_are_reported_per_call(self):
+        release = threading.Event()
+        self.addCleanup(release.set)
+
+        def fail():
+            raise ValueError('no answer')
+
+        (ok, ok_error), (_, fail_error), (_, slow_error) = run_concurrently(
+            [(str.upper, ('x',)), (fail, ()), (release.wait, ())], timeout=0.2,
+        )
+        self.assertEqual((ok, ok_error), ('X', None))
+        self.assertIsInstance(fail_error, ValueError)
+        self.assertIsInstance(slow_error, TimeoutError)
+
+    def test_secondary_call_degrades_and_primary_call_raises(self):
+        with mock.patch('analysis.utils.answer_question', return_value='42'), \
+                mock.patch('analysis.utils.infer_chart_spec', side_effect=RuntimeError):
+            self.assertEqual(answer_with_chart('q', None, {}), ('42', None))
+        with mock.patch('analysis.utils.generate_response', side_effect=LLMUnavailable('down')), \
+                mock.patch('analysis.utils.generate_chat_title', return_value='Title'):
+            with self.assertRaises(LLMUnavailable):
+                analyze_upload({}, 'sales.csv')
+        with mock.patch('analysis.utils.generate_response', return_value='Analysis'), \
+                mock.patch('analysis.utils.generate_chat_title', side_effect=RuntimeError):
+            self.assertEqual(analyze_upload({}, 'sales.csv'), ('Analysis', 'sales.csv'))
+
+
+class FlakyBackend:
+    """Backend that answers 429 for the first ``failures`` calls."""
+
+    def __init__(self, failures):
+        self.failures = failures
+
+    def complete(self, model, messages, max_tokens, temperature):
+        if self.failures:
+            self.failures -= 1
+            response = httpx.Response(429, headers={'retry-after': '0'}, request=httpx.Request('POST', 'https://llm.test'))
+            raise openai.RateLimitError('rate limited', response=response, body=None)
+        return 'ok'
+
+
+class LLMClientTests(ActionBudgetTestCase):
+    def make_client(self, backend, max_retries=3):
+        client = LLMClient(max_concurrency=2, max_retries=max_retries, backoff_base=0.001, backoff_max=0.01)
+        client.backend = backend
+        return client
+
+    def test_rate_limits_are_retried(self):
+        client = self.make_client(FlakyBackend(failures=2))
+        self.assertEqual(client.complete('m', [], 10, 0), 'ok')
+        self.assertEqual((client.calls, client.retries, client.rate_limited), (3, 2, 2))
+
+    def test_persistent_rate_limit_becomes_unavailable(self):
+        client = self.make_client(FlakyBackend(failures=10), max_retries=2)
+        with self.assertRaises(LLMUnavailable):
+            client.complete('m', [], 10, 0)
+        self.assertEqual(client.stats()['failures'], 1)
+
+    def test_local_backend_answers_from_the_dataset(self):
+        previous = llm_client.backend
+        with llm_client.use_backend(LocalBackend()):
+            self.upload()
+            body = self.post_action('question', question='Which region has the most units?').json()
+        self.assertIs(llm_client.backend, previous)
+        self.assertTrue(body['success'])
+        self.assertIn('units_sum', body['question_answer'])
+        self.assertIsNotNone(body['chart_url'])
@@ -0,0 +1,214 @@
+"""Chat history export and import as NDJSON.
+
+One JSON object per line: a ``chat`` record followed by that chat's
+``message`` records, oldest first::
+
+    {"kind": "chat", "id": 7, "title": "Sales", "saved": true, "created_at": "..."}
+    {"kind": "message", "chat": 7, "type": "question", "content": "...", "response": "...",
+     "chart": "<base64 PNG or null>", "chart_data": null, "created_at": "..."}
+
+Export streams both tables with ``iterator()``, so memory stays constant
+however long the history is. Import inserts with ``bulk_create`` in batches
+of ``CHAT_TRANSFER_BATCH_SIZE`` inside one transaction. Charts travel as
+PNG data and are stored again by content hash, so an import can only
+reference charts it carries; chart files an import wrote are deleted again
+when it fails. Datasets are not part of the export.
+"""
+import base64
+import binascii
+import json
+from datetime import datetime, timezone as dt_timezone
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .charts import delete_chart, open_chart, store_chart_base64
+from .models import Chat, ChatMessage
+
+MESSAGE_TYPES = {value for value, _ in ChatMessage.MESSAGE_TYPES}
+
+
+class ChatImportError(Exception):
+    """An import line is malformed; nothing from the import is kept."""
+
+
+def _line(record) -> str:
+    return json.dumps(record, ensure_ascii=False) + '\n'
+
+
+def _chart_base64(key):
+    if not key:
+        return None
+    try:
+        with open_chart(key) as fh:
+            return base64.b64encode(fh.read()).decode()
+    except FileNotFoundError:
+        return None
+
+
+def export_lines(user, batch_size: int = None):
+    """Yield ``user``'s chats and messages as NDJSON lines."""
+    batch_size = batch_size or settings.CHAT_TRANSFER_BATCH_SIZE
+    chats = Chat.objects.filter(user=user).only('id', 'title', 'saved', 'created_at').order_by('id')
+    messages = ChatMessage.objects.filter(chat__user=user).only(
+        'chat_id', 'type', 'content', 'response', 'chart_key', 'chart_data', 'created_at'
+    ).order_by('chat_id', 'created_at', 'id').iterator(chunk_size=batch_size)
+    # Both sides are ordered by chat id, so each chat's messages follow it without a query per chat
+    pending = next(messages, None)
+    for chat in chats.iterator(chunk_size=batch_size):
+        yield _line({
+            'kind': 'chat',
+            'id': chat.id,
+            'title': chat.title,
+            'saved': chat.saved,
+            'created_at': chat.created_at.isoformat(),
+        })
+        while pending is not None and pending.chat_id <= chat.id:
+            if pending.chat_id == chat.id:
+                yield _line({
+                    'kind': 'message',
+                    'chat': chat.id,
+                    'type': pending.type,
+                    'content': pending.content,
+                    'response': pending.response,
+                    'chart': _chart_base64(pending.chart_key),
+                    'chart_data': pending.chart_data,
+                    'created_at': pending.created_at.isoformat(),
+                })
+            pending = next(messages, None)
+
+
+def _timestamp(value, number):
+    if value is None:
+        return timezone.now()
+    try:
+        parsed = datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        raise ChatImportError(f'Line {number}: invalid created_at')
+    return parsed if timezone.is_aware(parsed) else timezone.make_aware(parsed, dt_timezone.utc)
+
+
+def _records(lines):
+    for number, line in enumerate(lines, start=1):
+        if isinstance(line, bytes):
+            line = line.decode('utf-8')
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            raise ChatImportError(f'Line {number}: invalid JSON')
+        if not isinstance(record, dict) or record.get('kind') not in ('chat', 'message'):
+            raise ChatImportError(f'Line {number}: expected a chat or message record')
+        yield number, record
+
+
+class _Batch:
+    """Chats and messages waiting for their ``bulk_create``; chats are written first so messages can reference them."""
+
+    def __init__(self, batch_size: int):
+        self.batch_size = batch_size
+        self.chats = []
+        self.messages = []
+        self.imported = []
+
+    def add_chat(self, chat):
+        # auto_now_add overwrites created_at on insert; keep the exported value to restore in finish()
+        chat.exported_created_at = chat.created_at
+        self.chats.append(chat)
+        self.imported.append(chat)
+
+    def add_message(self, message):
+        message.chat.message_count += 1
+        self.messages.append(message)
+
+    def flush(self):
+        if self.chats:
+            Chat.objects.bulk_create(self.chats, batch_size=self.batch_size)
+            self.chats = []
+        if self.messages:
+            created_at = [m.created_at for m in self.messages]
+            ChatMessage.objects.bulk_create(self.messages, batch_size=self.batch_size)
+            for message, value in zip(self.messages, created_at):
+                message.created_at = value
+            ChatMessage.objects.bulk_update(self.messages, ['created_at'], batch_size=self.batch_size)
+            self.messages = []
+
+    def finish(self):
+        self.flush()
+        # Creation times and message counters of every imported chat, in one pass
+        for chat in self.imported:
+            chat.created_at = chat.exported_created_at
+        Chat.objects.bulk_update(
+            self.imported, ['created_at', 'message_count'], batch_size=self.batch_size,
+        )
+
+
+def _discard_charts(keys):
+    """Delete chart files written by a rolled-back import, unless a committed message uses them meanwhile."""
+    used = set(ChatMessage.objects.filter(chart_key__in=keys).values_list('chart_key', flat=True))
+    for key in keys - used:
+        delete_chart(key)
+
+
+def import_lines(user, lines, batch_size: int = None) -> dict:
+    """Create chats and messages for ``user`` from NDJSON ``lines``; returns how many of each.
+
+    Chat ids in the input only link messages to their chat; new ids are assigned.
+    Raises ``ChatImportError`` on the first bad line, after rolling back.
+    """
+    written = set()
+    try:
+        counts = _import_records(user, lines, batch_size, written)
+    except BaseException:
+        if written:
+            _discard_charts(written)
+        raise
+    return counts
+
+
+def _import_records(user, lines, batch_size, written) -> dict:
+    batch = _Batch(batch_size or settings.CHAT_TRANSFER_BATCH_SIZE)
+    chats = {}
+    counts = {'chats': 0, 'messages': 0}
+    with transaction.atomic():
+        for number, record in _records(lines):
+            if record['kind'] == 'chat':
+                if not isinstance(record.get('id'), (int, str)):
+                    raise ChatImportError(f'Line {number}: chat id must be a number or string')
+                if record['id'] in chats:
+                    raise ChatImportError(f'Line {number}: duplicate chat id')
+                chat = Chat(
+                    user=user,
+                    title=str(record.get('title') or 'Chat')[:200],
+                    saved=bool(record.get('saved')),
+                    created_at=_timestamp(record.get('created_at'), number),
+                )
+                chats[record['id']] = chat
+                batch.add_chat(chat)
+                counts['chats'] += 1
+            else:
+                chat = chats.get(record.get('chat')) if isinstance(record.get('chat'), (int, str)) else None
+                if chat is None:
+                    raise ChatImportError(f'Line {number}: message for a chat not defined above it')
+                if record.get('type') not in MESSAGE_TYPES:
+                    raise ChatImportError(f'Line {number}: unknown message type')
+                try:
+                    chart_key = store_chart_base64(record.get('chart'), written)
+                except (binascii.Error, TypeError, ValueError):
+                    raise ChatImportError(f'Line {number}: invalid chart')
+                batch.add_message(ChatMessage(
+                    chat=chat,
+                    type=record['type'],
+                    content=str(record.get('content') or ''),
+                    response=None if record.get('response') is None else str(record['response']),
+                    chart_key=chart_key,
+                    chart_data=record.get('chart_data'),
+                    created_at=_timestamp(record.get('created_at'), number),
+                ))
+                counts['messages'] += 1
+            if len(batch.chats) + len(batch.messages) >= batch.batch_size:
+                batch.flush()
+        batch.finish()
+    return counts
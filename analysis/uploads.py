@@ -0,0 +1,37 @@
+import hashlib
+
+from django.core.files.uploadhandler import FileUploadHandler
+
+from .dataframes import file_sha256
+
+
+class ContentHashUploadHandler(FileUploadHandler):
+    """Hash each uploaded file as its chunks arrive, before any later handler stores them.
+
+    Listed first in ``FILE_UPLOAD_HANDLERS``; it passes every chunk through
+    unchanged and records ``request.upload_hashes[field_name]``.
+    """
+
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+        self.digest = hashlib.sha256()
+
+    def receive_data_chunk(self, raw_data, start):
+        self.digest.update(raw_data)
+        return raw_data
+
+    def file_complete(self, file_size):
+        if not hasattr(self.request, 'upload_hashes'):
+            self.request.upload_hashes = {}
+        self.request.upload_hashes[self.field_name] = self.digest.hexdigest()
+        return None
+
+
+def uploaded_content_hash(request, field_name: str) -> str:
+    """sha256 of an uploaded file, from the streaming hash when the handler ran."""
+    content_hash = getattr(request, 'upload_hashes', {}).get(field_name)
+    if content_hash is None:
+        uploaded_file = request.FILES[field_name]
+        content_hash = file_sha256(uploaded_file)
+        uploaded_file.seek(0)
+    return content_hash
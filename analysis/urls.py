@@ -3,4 +3,12 @@ from . import views
 
 urlpatterns = [
     path('home/', views.home, name='analysis-home'),
+    path('home/stream/', views.stream_question, name='analysis-stream-question'),
+    path('home/chats/export/', views.export_chats, name='analysis-export-chats'),
+    path('home/chats/import/', views.import_chats, name='analysis-import-chats'),
+    path('home/chats/<int:chat_id>/messages/', views.chat_messages, name='analysis-chat-messages'),
+    path('home/messages/<int:message_id>/chart-data/', views.message_chart_data, name='analysis-message-chart-data'),
+    path('home/charts/<str:key>.png', views.chart_image, name='analysis-chart'),
+    path('home/metrics/', views.metrics_summary, name='analysis-metrics'),
+    path('home/jobs/<int:job_id>/', views.job_status, name='analysis-job-status'),
 ]
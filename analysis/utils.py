@@ -1,82 +1,176 @@
-import openai
-import os
-from openai import OpenAI
+import json
+import time
+import logging
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
 
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+from .llm import llm_client
+from .llm_cache import llm_cache
+from .metrics import count, timed
+from .prompts import describe_dataset, describe_result, estimate_tokens
+from .query import AGG_FUNCS, FILTER_OPS, MAX_LIMIT, QueryPlanError, execute_plan, validate_plan
 
-def generate_response(df):
+logger = logging.getLogger(__name__)
+
+# Shared pool for fanning out independent, network-bound completions within a request
+_executor = ThreadPoolExecutor(max_workers=settings.LLM_MAX_WORKERS, thread_name_prefix='llm')
+
+MODEL = "gpt-3.5-turbo"
+TITLE_PROMPT_MAX_TOKENS = 300
+
+
+def _log_prompt_size(system: str, prompt: str, max_tokens: int):
+    tokens = estimate_tokens(system) + estimate_tokens(prompt)
+    count('prompt_tokens', tokens)
+    logger.info(f"LLM prompt: {tokens} tokens (max {max_tokens} completion) for {system!r}")
+
+
+def _chat_completion(system: str, prompt: str, max_tokens: int, temperature: float, bypass_cache: bool = False) -> str:
+    """Single completion call, served from the LLM response cache when the same request was seen before."""
+    messages = [
+        {"role": "system", "content": system},
+        {"role": "user", "content": prompt}
+    ]
+    key = llm_cache.make_key(MODEL, {"max_tokens": max_tokens, "temperature": temperature}, messages)
+    if not bypass_cache:
+        cached = llm_cache.get(key)
+        if cached is not None:
+            return cached
+    _log_prompt_size(system, prompt, max_tokens)
+    with timed('openai'):
+        content = llm_client.complete(MODEL, messages, max_tokens, temperature)
+    llm_cache.set(key, content)
+    return content
+
+
+def _stream_chat_completion(system: str, prompt: str, max_tokens: int, temperature: float, bypass_cache: bool = False):
+    """Streaming variant of _chat_completion: yields text deltas as they arrive.
+
+    A cached completion is yielded in one piece; a completed stream is stored
+    in the cache under the same key as the non-streaming call.
+    """
+    messages = [
+        {"role": "system", "content": system},
+        {"role": "user", "content": prompt}
+    ]
+    key = llm_cache.make_key(MODEL, {"max_tokens": max_tokens, "temperature": temperature}, messages)
+    if not bypass_cache:
+        cached = llm_cache.get(key)
+        if cached is not None:
+            yield cached
+            return
+    _log_prompt_size(system, prompt, max_tokens)
+    parts = []
+    for delta in llm_client.stream(MODEL, messages, max_tokens, temperature):
+        parts.append(delta)
+        yield delta
+    llm_cache.set(key, ''.join(parts))
+
+
+def generate_response(profile, bypass_cache: bool = False):
     prompt = f"""You're a data analyst. Analyze the following dataset and provide insights and and identify any patterns, trends, or anomalies. Suggest visualizations that would help understand the data.
 
-Data (first 5 rows):
-{df.head().to_string(index=False)}
+Dataset profile:
+{describe_dataset(profile, settings.LLM_PROMPT_MAX_TOKENS, sample_rows=settings.LLM_PROMPT_SAMPLE_ROWS)}
 Return your analysis in a structured format, Include a few bulleted insights, suggested some visualizations, and any anomalies detected. 
 Do not include any code or raw data in your response. DO NOT include any markdown formatting. Do not include too much text, be concise and to the point.
 User will ask questions based on this analysis later or ask for more visualizations. 
 """
-    response = client.chat.completions.create(
-        model="gpt-3.5-turbo",
-        messages=[
-            {"role": "system", "content": "You are an expert data analyst."},
-            {"role": "user", "content": prompt}
-        ],
-        max_tokens=1500,
-        temperature=0.7,
-    )
-    return response.choices[0].message.content
-
-def answer_question(question, df):
+    return _chat_completion("You are an expert data analyst.", prompt, max_tokens=1500, temperature=0.7, bypass_cache=bypass_cache)
+
+def infer_query_plan(question: str, df, profile, bypass_cache: bool = False) -> dict | None:
+    """Ask the model for a restricted JSON query plan answering ``question``, validated against ``df``.
+
+    Returns None if the model declines or produces a plan that doesn't fit the dataset.
+    """
     prompt = f"""
-You are a data analyst. Use the dataset below to answer the user's question.
+Translate the user's question into a JSON query plan over the table described below. Output a JSON object ONLY with any of:
+- filters: list of {{"column", "op", "value"}}; op is one of [{', '.join(FILTER_OPS)}]
+- groupby: list of column names
+- aggregate: list of {{"column", "func"}}; func is one of [{', '.join(AGG_FUNCS)}]; use column "*" with count to count rows
+- select: list of columns to return when nothing is aggregated
+- sort: list of {{"column", "desc"}}; aggregate outputs are named <column>_<func>, or count for "*"
+- limit: number of rows to return (at most {MAX_LIMIT})
+Return null if the question can't be answered from these columns.
 
-Dataset sample:
-{df.head().to_string(index=False)}
+Dataset profile:
+{describe_dataset(profile, settings.LLM_PROMPT_MAX_TOKENS, question)}
+
+Question: {question}
+
+Output JSON only, no markdown, no explanations.
+"""
+    try:
+        content = _chat_completion("You output minimal JSON query plans.", prompt, max_tokens=200, temperature=0, bypass_cache=bypass_cache).strip()
+        if not content.startswith('{'):
+            return None
+        return validate_plan(json.loads(content), df)
+    except (ValueError, QueryPlanError) as e:
+        logger.info(f"Discarding query plan: {e}")
+        return None
+
+
+def _answer_prompt(question, df, profile, bypass_cache: bool = False):
+    # Compute the answer locally over every row when the question maps to a query plan
+    plan = infer_query_plan(question, df, profile, bypass_cache)
+    if plan is not None:
+        try:
+            with timed('pandas'):
+                result, matched_rows = execute_plan(plan, df)
+        except (QueryPlanError, TypeError, ValueError) as e:
+            logger.info(f"Query plan failed, answering from a sample: {e}")
+        else:
+            return f"""
+You are a data analyst. The result below was computed exactly over all {len(df)} rows of the user's dataset ({matched_rows} rows matched the filters).
+
+Query plan:
+{json.dumps(plan)}
+
+Result:
+{describe_result(result, settings.LLM_PROMPT_MAX_TOKENS)}
+
+Question: {question}
+
+Provide a concise and clear answer using the result above. Suggest visualizations if relevant, but do not include raw code or markdown formatting.
+"""
+    return f"""
+You are a data analyst. Use the dataset profile below to answer the user's question.
+
+Dataset profile:
+{describe_dataset(profile, settings.LLM_PROMPT_MAX_TOKENS, question, settings.LLM_PROMPT_SAMPLE_ROWS)}
 
 Question: {question}
 
 Provide a concise and clear answer using the data above. Suggest visualizations if relevant, but do not include raw code or markdown formatting.
 """
-    response = client.chat.completions.create(
-        model="gpt-3.5-turbo",
-        messages=[
-            {"role": "system", "content": "You are an expert data analyst."},
-            {"role": "user", "content": prompt}
-        ],
-        max_tokens=1000,
-        temperature=0.7,
-    )
-    return response.choices[0].message.content
-
-def generate_chat_title(df, filename: str) -> str:
-    sample = df.head().to_string(index=False)
+
+def answer_question(question, df, profile, bypass_cache: bool = False):
+    prompt = _answer_prompt(question, df, profile, bypass_cache)
+    return _chat_completion("You are an expert data analyst.", prompt, max_tokens=1000, temperature=0.7, bypass_cache=bypass_cache)
+
+def generate_chat_title(profile, filename: str, bypass_cache: bool = False) -> str:
+    # A title needs the theme, not the statistics; a small slice of the budget is enough
+    summary = describe_dataset(profile, min(TITLE_PROMPT_MAX_TOKENS, settings.LLM_PROMPT_MAX_TOKENS), sample_rows=2)
     prompt = f"""
 You are to craft a very short, descriptive chat title (max 6 words) for a data analysis session.
-Use the provided file name and dataset preview to infer the theme.
+Use the provided file name and dataset summary to infer the theme.
 - Output ONLY the title text, no quotes, no punctuation at the end, no markdown.
 
 File name: {filename}
-Dataset preview (first 5 rows):
-{sample}
+Dataset summary:
+{summary}
 """
     try:
-        response = client.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=[
-                {"role": "system", "content": "You generate concise, meaningful titles."},
-                {"role": "user", "content": prompt}
-            ],
-            max_tokens=30,
-            temperature=0.4,
-        )
-        title = response.choices[0].message.content.strip()
+        title = _chat_completion("You generate concise, meaningful titles.", prompt, max_tokens=30, temperature=0.4, bypass_cache=bypass_cache).strip()
         title = title.strip('\"\' ').rstrip('.!?:;')
         return title if title else (filename or "Untitled Chat")
     except Exception:
         return filename or "Untitled Chat"
 
-def infer_chart_spec(question: str, df) -> dict | None:
-    sample = df.head().to_string(index=False)
+def infer_chart_spec(question: str, profile, bypass_cache: bool = False) -> dict | None:
     prompt = f"""
-Given the user's question and a sample of the dataset, decide if a chart should be created. If so, output a SMALL JSON object ONLY (no extra text) with:
+Given the user's question and a profile of the dataset, decide if a chart should be created. If so, output a SMALL JSON object ONLY (no extra text) with:
 - type: one of [bar, line, scatter, hist, box, pie]
 - x: column name for x-axis (optional for hist/pie)
 - y: column name for y-axis/values (optional for hist/pie)
@@ -87,22 +181,13 @@ Given the user's question and a sample of the dataset, decide if a chart should
 Return null if a chart is not appropriate.
 
 Question: {question}
-Dataset sample (first 5 rows):
-{sample}
+Dataset profile:
+{describe_dataset(profile, settings.LLM_PROMPT_MAX_TOKENS, question, settings.LLM_PROMPT_SAMPLE_ROWS)}
 
 Output JSON only, no markdown, no explanations.
 """
     try:
-        response = client.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=[
-                {"role": "system", "content": "You output minimal JSON specs for charts."},
-                {"role": "user", "content": prompt}
-            ],
-            max_tokens=120,
-            temperature=0.2,
-        )
-        content = response.choices[0].message.content.strip()
+        content = _chat_completion("You output minimal JSON specs for charts.", prompt, max_tokens=120, temperature=0.2, bypass_cache=bypass_cache).strip()
         # Basic safety: if response doesn't look like JSON, skip
         if not content or (not content.startswith('{') and not content.lower().startswith('null')):
             return None
@@ -114,4 +199,83 @@ Output JSON only, no markdown, no explanations.
             return spec
         return None
     except Exception:
-        return None
\ No newline at end of file
+        return None
+
+
+def run_concurrently(calls, timeout=None):
+    """Run independent ``(func, args)`` calls on the shared pool.
+
+    Returns one ``(result, error)`` pair per call, in order, so callers can
+    decide how to handle partial failures. All calls share a single deadline;
+    a call that misses it is reported with a ``TimeoutError``.
+    """
+    timeout = settings.LLM_CALL_TIMEOUT if timeout is None else timeout
+    # Each call runs in a copy of the caller's context so request metrics still apply
+    futures = [_executor.submit(contextvars.copy_context().run, func, *args) for func, args in calls]
+    deadline = time.monotonic() + timeout
+    outcomes = []
+    for future in futures:
+        try:
+            outcomes.append((future.result(timeout=max(0, deadline - time.monotonic())), None))
+        except Exception as e:
+            future.cancel()
+            outcomes.append((None, e))
+    return outcomes
+
+
+def analyze_upload(profile, filename: str, bypass_cache: bool = False):
+    """Run the initial analysis and the chat title generation concurrently.
+
+    The analysis is required and re-raises on failure; the title falls back
+    to the file name.
+    """
+    (analysis, analysis_error), (title, title_error) = run_concurrently([
+        (generate_response, (profile, bypass_cache)),
+        (generate_chat_title, (profile, filename, bypass_cache)),
+    ])
+    if analysis_error is not None:
+        raise analysis_error
+    if title_error is not None:
+        logger.warning(f"Chat title generation failed: {title_error!r}")
+        title = filename or "Untitled Chat"
+    return analysis, title
+
+
+def answer_with_chart(question: str, df, profile, bypass_cache: bool = False):
+    """Answer a question and infer its chart spec concurrently.
+
+    The answer is required and re-raises on failure; the chart spec is
+    optional and becomes None if it fails or times out.
+    """
+    (answer, answer_error), (spec, spec_error) = run_concurrently([
+        (answer_question, (question, df, profile, bypass_cache)),
+        (infer_chart_spec, (question, profile, bypass_cache)),
+    ])
+    if answer_error is not None:
+        raise answer_error
+    if spec_error is not None:
+        logger.warning(f"Chart spec inference failed: {spec_error!r}")
+        spec = None
+    return answer, spec
+
+
+def stream_answer_with_chart(question: str, df, profile, bypass_cache: bool = False):
+    """Stream the answer to a question while its chart spec is inferred in the background.
+
+    Yields ``('delta', text)`` pairs as the answer arrives, then a single
+    ``('spec', spec_or_None)`` pair once the answer is complete.
+    """
+    spec_future = _executor.submit(contextvars.copy_context().run, infer_chart_spec, question, profile, bypass_cache)
+    try:
+        prompt = _answer_prompt(question, df, profile, bypass_cache)
+        for delta in _stream_chat_completion("You are an expert data analyst.", prompt, max_tokens=1000, temperature=0.7, bypass_cache=bypass_cache):
+            yield 'delta', delta
+    except BaseException:
+        spec_future.cancel()
+        raise
+    try:
+        spec = spec_future.result(timeout=settings.LLM_CALL_TIMEOUT)
+    except Exception as e:
+        logger.warning(f"Chart spec inference failed: {e!r}")
+        spec = None
+    yield 'spec', spec
@@ -1,21 +1,33 @@
 from django.shortcuts import render, redirect
+from django.conf import settings
+from django.db.models import BooleanField, ExpressionWrapper, Q
 from django.contrib.auth.decorators import login_required
-from django.http import JsonResponse
+from django.contrib.admin.views.decorators import staff_member_required
+from django.http import FileResponse, Http404, HttpResponseNotModified, JsonResponse, StreamingHttpResponse
+from django.core.handlers.asgi import ASGIRequest
+from asgiref.sync import sync_to_async
 from django.views.decorators.csrf import csrf_exempt
 from django.utils.decorators import method_decorator
 from django.contrib import messages
+from django.urls import reverse
 
-from .models import DataSet, Chat, ChatMessage
+from .models import DataSet, Chat, ChatMessage, AnalysisJob
 from .forms import DataSetForm
-from .utils import generate_response, answer_question, generate_chat_title, infer_chart_spec
+from .utils import answer_with_chart, stream_answer_with_chart
+from .dataframes import dataframe_cache, dataset_content_hash, load_dataset_source
+from .profiling import dataset_profile
+from .jobs import enqueue_upload_analysis, reuse_upload_analysis, run_job
+from .charts import chart_memo, open_chart, spec_chart_fields, store_chart_base64
+from .llm import llm_client
+from .llm_cache import llm_cache
+from .metrics import registry as metrics_registry
+from .singleflight import Flight, single_flight, work_key
+from .transfer import ChatImportError, export_lines, import_lines
+from .uploads import uploaded_content_hash
 
-import matplotlib
-matplotlib.use('Agg')  # Use a non-interactive backend for matplotlib
-import pandas as pd
-import matplotlib.pyplot as plt
-from io import BytesIO
-import base64
 import json
+import re
+import base64
 from datetime import datetime
 from copy import deepcopy
 import logging
@@ -31,22 +43,27 @@ def _maybe_migrate_session_chats(request):
     chats = session.get('chats') or []
     active_id = session.get('active_chat_id')
     new_active_id = None
+    created, migrated = [], []
     for c in chats:
-        chat = Chat.objects.create(user=request.user, title=c.get('title') or 'Chat')
-        if c.get('saved'):
-            chat.saved = True
-            chat.save(update_fields=['saved'])
+        chat = Chat.objects.create(user=request.user, title=c.get('title') or 'Chat', saved=bool(c.get('saved')))
+        created.append(chat)
         # Messages
-        for m in c.get('messages', []):
-            ChatMessage.objects.create(
+        migrated += [
+            ChatMessage(
                 chat=chat,
                 type=m.get('type') or 'analysis',
                 content=m.get('content') or '',
                 response=m.get('response') or None,
-                chart=m.get('chart') or None,
+                chart_key=store_chart_base64(m.get('chart')),
             )
+            for m in c.get('messages', [])
+        ]
         if c.get('id') == active_id:
             new_active_id = chat.id
+    ChatMessage.objects.bulk_create(migrated, batch_size=settings.CHAT_TRANSFER_BATCH_SIZE)
+    for m in migrated:
+        m.chat.message_count += 1
+    Chat.objects.bulk_update(created, ['message_count'])
     # Cleanup session keys
     if 'chats' in session:
         del session['chats']
@@ -89,20 +106,248 @@ def _serialize_chats(user):
     ]
 
 
+def _format_size(nbytes: int) -> str:
+    if nbytes >= 1024 ** 3:
+        return f'{nbytes / 1024 ** 3:g}GB'
+    return f'{nbytes / 1024 ** 2:g}MB'
+
+
+def _serialize_message(m):
+    return {
+        'id': m.id,
+        'type': m.type,
+        'content': m.content,
+        'response': m.response,
+        'chart_url': m.chart_url,
+        # Chart arrays can be large, so history only says where to fetch them
+        'chart_data_url': reverse('analysis-message-chart-data', args=[m.id]) if m.has_chart_data else None,
+    }
+
+
+def _encode_cursor(m) -> str:
+    return base64.urlsafe_b64encode(f'{m.created_at.isoformat()}|{m.id}'.encode()).decode()
+
+
+def _decode_cursor(cursor: str):
+    created_at, message_id = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+    return datetime.fromisoformat(created_at), int(message_id)
+
+
+def _message_page(chat, cursor=None, limit=None):
+    """Newest-first keyset page of a chat's messages, returned oldest-first for display.
+
+    ``cursor`` is the opaque value from a previous page's ``next_cursor``;
+    the returned cursor is None once the oldest message has been sent.
+    """
+    if chat is None:
+        return [], None
+    limit = limit or settings.CHAT_PAGE_SIZE
+    qs = ChatMessage.objects.filter(chat=chat).only(
+        'id', 'type', 'content', 'response', 'chart_key', 'created_at'
+    ).annotate(
+        has_chart_data=ExpressionWrapper(Q(chart_data__isnull=False), output_field=BooleanField()),
+    ).order_by('-created_at', '-id')
+    if cursor:
+        created_at, message_id = _decode_cursor(cursor)
+        qs = qs.filter(Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=message_id))
+    page = list(qs[:limit + 1])
+    next_cursor = _encode_cursor(page[limit - 1]) if len(page) > limit else None
+    page = page[:limit]
+    page.reverse()
+    return [_serialize_message(m) for m in page], next_cursor
+
+
+@login_required
+def chat_messages(request, chat_id: int):
+    """Older pages of a chat's history for infinite scroll."""
+    try:
+        chat = Chat.objects.get(id=chat_id, user=request.user)
+    except Chat.DoesNotExist:
+        return JsonResponse({'success': False, 'error': 'Chat not found'}, status=404)
+    try:
+        limit = min(int(request.GET.get('limit') or settings.CHAT_PAGE_SIZE), settings.CHAT_PAGE_MAX_SIZE)
+        page, next_cursor = _message_page(chat, request.GET.get('cursor'), max(limit, 1))
+    except (TypeError, ValueError):
+        return JsonResponse({'success': False, 'error': 'Invalid cursor'}, status=400)
+    return JsonResponse({'success': True, 'chat_id': chat.id, 'messages': page, 'next_cursor': next_cursor})
+
+
+@login_required
+def message_chart_data(request, message_id: int):
+    """Chart arrays of one message, fetched when its chart scrolls into view."""
+    chart_data = ChatMessage.objects.filter(
+        id=message_id, chat__user=request.user, chart_data__isnull=False,
+    ).values_list('chart_data', flat=True).first()
+    if chart_data is None:
+        return JsonResponse({'success': False, 'error': 'Chart not found'}, status=404)
+    response = JsonResponse({'success': True, 'chart_data': chart_data})
+    # A message's chart never changes once written
+    response['Cache-Control'] = 'private, max-age=86400'
+    return response
+
+
+@login_required
+def export_chats(request):
+    """Stream all of the user's chats and messages as NDJSON (see analysis.transfer)."""
+    lines = export_lines(request.user)
+    if isinstance(request, ASGIRequest):
+        lines = _aiter_events(lines)
+    response = StreamingHttpResponse(lines, content_type='application/x-ndjson')
+    response['Content-Disposition'] = 'attachment; filename="chats.ndjson"'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+@login_required
+def import_chats(request):
+    """Add chats from an NDJSON export, sent as the request body or as a ``file`` upload."""
+    if request.method != 'POST':
+        return JsonResponse({'success': False, 'error': 'POST required'}, status=405)
+    if request.content_type == 'multipart/form-data':
+        if 'file' not in request.FILES:
+            return JsonResponse({'success': False, 'error': 'No file uploaded'}, status=400)
+        lines = request.FILES['file']
+    elif request.content_type in ('application/x-ndjson', 'application/jsonl'):
+        # Read line by line from the request stream rather than buffering the body
+        lines = request
+    else:
+        return JsonResponse({'success': False, 'error': 'Send NDJSON (application/x-ndjson)'}, status=415)
+    try:
+        counts = import_lines(request.user, lines)
+    except ChatImportError as e:
+        return JsonResponse({'success': False, 'error': str(e)}, status=400)
+    return JsonResponse({'success': True, 'imported': counts})
+
+
 def _delete_chat(request, chat_id: int):
     try:
         chat = Chat.objects.get(id=chat_id, user=request.user)
         chat.delete()
     except Chat.DoesNotExist:
         return
-    remaining = Chat.objects.filter(user=request.user).order_by('created_at')
-    if remaining.exists():
-        request.session['active_chat_id'] = remaining.last().id
+    latest = Chat.objects.filter(user=request.user).order_by('-created_at').first()
+    if latest:
+        request.session['active_chat_id'] = latest.id
     else:
         new_chat = Chat.objects.create(user=request.user, title='Chat 1')
         request.session['active_chat_id'] = new_chat.id
 
 
+def _job_payload(job, user):
+    payload = {
+        'success': job.status != AnalysisJob.STATUS_FAILED,
+        'job_id': job.id,
+        'status': job.status,
+        'active_chat_id': job.chat_id,
+    }
+    if job.status == AnalysisJob.STATUS_FAILED:
+        payload['error'] = job.error
+    elif job.status == AnalysisJob.STATUS_DONE:
+        payload['gpt_response'] = job.message.content if job.message else None
+        payload['chart_url'] = job.message.chart_url if job.message else None
+        payload['chart_data'] = job.message.chart_data if job.message else None
+        # Return updated chats for sidebar so title updates
+        payload['chats'] = _serialize_chats(user)
+    return payload
+
+
+@login_required
+def job_status(request, job_id: int):
+    try:
+        job = AnalysisJob.objects.select_related('message').get(id=job_id, user=request.user)
+    except AnalysisJob.DoesNotExist:
+        return JsonResponse({'success': False, 'error': 'Job not found'}, status=404)
+    return JsonResponse(_job_payload(job, request.user))
+
+
+@login_required
+def chart_image(request, key: str):
+    """Serve a stored chart. Keys are content hashes, so responses never change."""
+    if not re.fullmatch(r'[0-9a-f]{64}', key):
+        raise Http404
+    # Ownership first, so a 304 can't confirm that someone else's chart exists
+    if not ChatMessage.objects.filter(chart_key=key, chat__user=request.user).exists():
+        raise Http404
+    etag = f'"{key}"'
+    if request.headers.get('If-None-Match') == etag:
+        response = HttpResponseNotModified()
+    else:
+        try:
+            response = FileResponse(open_chart(key), content_type='image/png')
+        except FileNotFoundError:
+            raise Http404
+    response['ETag'] = etag
+    response['Cache-Control'] = 'private, max-age=31536000, immutable'
+    return response
+
+
+@staff_member_required
+def metrics_summary(request):
+    """Staff-only per-action request metrics and cache statistics for this worker process."""
+    return JsonResponse({
+        'success': True,
+        'actions': metrics_registry.snapshot(),
+        'caches': {
+            'dataframes': dataframe_cache.stats(),
+            'llm': llm_cache.stats(),
+            'charts': chart_memo.stats(),
+        },
+        'llm': llm_client.stats(),
+    })
+
+
+def _answer_payload(chat, question):
+    """Answer ``question`` on the chat's dataset and store the message; returns the JSON response payload."""
+    try:
+        dataset = chat.last_dataset
+        df = load_dataset_source(dataset)
+        profile = dataset_profile(dataset, df)
+        # Answer and chart spec are inferred concurrently
+        question_answer, spec = answer_with_chart(question, df, profile)
+        chart_fields = spec_chart_fields(spec, df, dataset_content_hash(dataset), profile)
+
+        message = ChatMessage.objects.create(
+            chat=chat,
+            type='question',
+            content=question,
+            response=question_answer,
+            **chart_fields,
+        )
+        chat.record_messages([message])
+    except Exception as e:
+        return {'success': False, 'error': str(e)}
+    return {
+        'success': True,
+        'question_answer': question_answer,
+        'chart_url': message.chart_url,
+        'chart_data': message.chart_data,
+        'active_chat_id': chat.id,
+    }
+
+
+def _start_upload(request, chat, form, content_hash):
+    """Attach an already analysed copy of the content, or store the upload and queue its analysis."""
+    job = reuse_upload_analysis(request.user, chat, request.FILES['file'].name, content_hash)
+    if job is not None:
+        return job
+    # Create dataset; parsing, validation and analysis run in a background job
+    dataset = form.save(commit=False)
+    dataset.user = request.user
+    dataset.content_hash = content_hash
+    # Set dataset name from filename (without path)
+    try:
+        dataset.name = dataset.file.name.split('/')[-1]
+    except Exception:
+        pass
+    dataset.save()
+
+    inline = not settings.ANALYSIS_ASYNC_UPLOADS
+    job = enqueue_upload_analysis(request.user, chat, dataset, claim=inline)
+    if inline:
+        run_job(job)
+    return job
+
+
 @login_required
 def home(request):
     _maybe_migrate_session_chats(request)
@@ -122,7 +367,7 @@ def home(request):
         # Handle new chat creation (only if current active chat has at least one message)
         if form_type == 'new_chat':
             active_chat = _get_active_chat(request)
-            if not active_chat or not active_chat.messages.exists():
+            if not active_chat or not active_chat.message_count:
                 if is_ajax:
                     return JsonResponse({'success': False, 'error': 'Finish your current chat (upload a dataset or ask a question) before starting a new one.'})
             count = Chat.objects.filter(user=request.user).count()
@@ -133,7 +378,8 @@ def home(request):
                     'success': True,
                     'active_chat_id': new_chat.id,
                     'chats': _serialize_chats(request.user),
-                    'messages': []
+                    'messages': [],
+                    'next_cursor': None,
                 })
 
         # Handle chat switching
@@ -146,18 +392,12 @@ def home(request):
                 active = Chat.objects.get(id=chat_id, user=request.user)
                 request.session['active_chat_id'] = active.id
                 if is_ajax:
+                    page, next_cursor = _message_page(active)
                     return JsonResponse({
                         'success': True,
                         'active_chat_id': active.id,
-                        'messages': [
-                            {
-                                'type': m.type,
-                                'content': m.content,
-                                'response': m.response,
-                                'chart': m.chart,
-                            }
-                            for m in active.messages.all()
-                        ]
+                        'messages': page,
+                        'next_cursor': next_cursor,
                     })
             except Chat.DoesNotExist:
                 if is_ajax:
@@ -195,19 +435,13 @@ def home(request):
             _delete_chat(request, chat_id)
             active = _get_active_chat(request)
             if is_ajax:
+                page, next_cursor = _message_page(active)
                 return JsonResponse({
                     'success': True,
                     'chats': _serialize_chats(request.user),
                     'active_chat_id': active.id if active else None,
-                    'messages': [
-                        {
-                            'type': m.type,
-                            'content': m.content,
-                            'response': m.response,
-                            'chart': m.chart,
-                        }
-                        for m in (active.messages.all() if active else [])
-                    ]
+                    'messages': page,
+                    'next_cursor': next_cursor,
                 })
 
         # Upload handler (operate on active chat)
@@ -228,14 +462,15 @@ def home(request):
                         messages.error(request, 'Please upload a valid CSV file. Only .csv files are allowed.')
                         return redirect('home')
                     
-                    # Check file size (limit to 10MB)
-                    if uploaded_file.size > 10 * 1024 * 1024:
+                    # Check file size (large files are stored partitioned when enabled)
+                    max_bytes = max(settings.DATASET_MAX_BYTES, settings.LARGE_DATASET_MAX_BYTES)
+                    if uploaded_file.size > max_bytes:
+                        error = 'File size must be less than {}. Your file is {:.1f}MB.'.format(
+                            _format_size(max_bytes), uploaded_file.size / (1024 * 1024)
+                        )
                         if is_ajax:
-                            return JsonResponse({
-                                'success': False,
-                                'error': 'File size must be less than 10MB. Your file is {:.1f}MB.'.format(uploaded_file.size / (1024 * 1024))
-                            })
-                        messages.error(request, f'File size must be less than 10MB. Your file is {uploaded_file.size / (1024 * 1024):.1f}MB.')
+                            return JsonResponse({'success': False, 'error': error})
+                        messages.error(request, error)
                         return redirect('home')
                     
                     # Check if file is empty
@@ -248,133 +483,27 @@ def home(request):
                         messages.error(request, 'The uploaded file is empty. Please upload a file with data.')
                         return redirect('home')
                     
-                    # Try to read CSV to validate content
-                    try:
-                        df = pd.read_csv(uploaded_file)
-                        if df.empty:
-                            if is_ajax:
-                                return JsonResponse({
-                                    'success': False,
-                                    'error': 'CSV file appears to be empty or contains no data rows.'
-                                })
-                            messages.error(request, 'CSV file appears to be empty or contains no data rows.')
-                            return redirect('home')
-                        
-                        # Check if dataframe has reasonable dimensions
-                        if df.shape[0] > 100000:
-                            if is_ajax:
-                                return JsonResponse({
-                                    'success': False,
-                                    'error': 'CSV file has too many rows ({:,}). Please upload a file with fewer than 100,000 rows.'.format(df.shape[0])
-                                })
-                            messages.error(request, f'CSV file has too many rows ({df.shape[0]:,}). Please upload a file with fewer than 100,000 rows.')
-                            return redirect('home')
-                            
-                        if df.shape[1] > 100:
-                            if is_ajax:
-                                return JsonResponse({
-                                    'success': False,
-                                    'error': 'CSV file has too many columns ({:,}). Please upload a file with fewer than 100 columns.'.format(df.shape[1])
-                                })
-                            messages.error(request, f'CSV file has too many columns ({df.shape[1]:,}). Please upload a file with fewer than 100 columns.')
-                            return redirect('home')
-                        
-                        # Check for required data types (at least some numeric columns)
-                        numeric_cols = df.select_dtypes(include=['number']).columns.tolist()
-                        if len(numeric_cols) == 0:
-                            if is_ajax:
-                                return JsonResponse({
-                                    'success': False,
-                                    'error': 'CSV file must contain at least some numeric data for analysis. Please upload a file with numeric columns.'
-                                })
-                            messages.error(request, 'CSV file must contain at least some numeric data for analysis. Please upload a file with numeric columns.')
-                            return redirect('home')
-                            
-                    except UnicodeDecodeError:
-                        if is_ajax:
-                            return JsonResponse({
-                                'success': False,
-                                'error': 'CSV file encoding error. Please ensure the file is saved with UTF-8 encoding.'
-                            })
-                        messages.error(request, 'CSV file encoding error. Please ensure the file is saved with UTF-8 encoding.')
-                        return redirect('home')
-                        
-                    except Exception as e:
-                        if is_ajax:
-                            return JsonResponse({
-                                'success': False,
-                                'error': f'Error reading CSV file: {str(e)}. Please ensure the file is a valid CSV format.'
-                            })
-                        messages.error(request, f'Error reading CSV file: {str(e)}. Please ensure the file is a valid CSV format.')
-                        return redirect('home')
-                    
-                    # Reset file pointer for processing
-                    uploaded_file.seek(0)
-                    
-                    # Create dataset
-                    dataset = form.save(commit=False)
-                    dataset.user = request.user
-                    # Set dataset name from filename (without path)
-                    try:
-                        dataset.name = dataset.file.name.split('/')[-1]
-                    except Exception:
-                        pass
-                    dataset.save()
-                    
-                    # Analyze data
-                    df = pd.read_csv(dataset.file.path)
-                    active_chat.last_dataset = dataset
-                    active_chat.save(update_fields=['last_dataset', 'updated_at'])
-                    gpt_response = generate_response(df)
-
-                    # Generate chart
-                    numeric_cols = df.select_dtypes(include=['number']).columns
-                    if len(numeric_cols) > 0:
-                        plt.figure(figsize=(10, 6))
-                        df[numeric_cols[0]].head(10).plot(kind='bar')
-                        plt.title(f"Sample of {numeric_cols[0]} Data")
-                        buffer = BytesIO()
-                        plt.savefig(buffer, format='png')
-                        buffer.seek(0)
-                        image_png = buffer.getvalue()
-                        buffer.close()
-                        chart = base64.b64encode(image_png).decode('utf-8')
-                        plt.close()
-                    else:
-                        chart = None
-                        
-                    # Save analysis message
-                    ChatMessage.objects.create(
-                        chat=active_chat,
-                        type='analysis',
-                        content=gpt_response,
-                        response=None,
-                        chart=chart if chart else None,
-                    )
-
-                    # Generate AI title for chat based on file and preview
-                    try:
-                        ai_title = generate_chat_title(df, dataset.file.name or dataset.name)
-                        if ai_title:
-                            active_chat.title = ai_title
-                    except Exception:
-                        # Fallback to dataset name if AI title fails
-                        try:
-                            active_chat.title = dataset.name or active_chat.title
-                        except Exception:
-                            pass
-                    active_chat.save(update_fields=['title', 'updated_at'])
+                    # Identical content reuses the stored file and its analysis; nothing is written or sent to the LLM
+                    content_hash = uploaded_content_hash(request, 'file')
+                    # A repeated submission of the same file joins the first one's job
+                    started = {}
+
+                    def start_upload():
+                        started['job'] = _start_upload(request, active_chat, form, content_hash)
+                        return started['job'].id
+
+                    job_id = single_flight(work_key(request.user.id, active_chat.id, 'upload', content_hash), start_upload)
+                    job = started.get('job') or AnalysisJob.objects.select_related('message').get(id=job_id, user=request.user)
 
                     if is_ajax:
-                        # Return updated chats for sidebar so title updates
-                        chats_min = _serialize_chats(request.user)
-                        return JsonResponse({
-                            'success': True,
-                            'gpt_response': gpt_response,
-                            'chart': chart,
-                            'active_chat_id': active_chat.id,
-                            'chats': chats_min,
-                        })
+                        # Pending jobs are polled via analysis-job-status; finished ones carry the result
+                        return JsonResponse(_job_payload(job, request.user))
+                    if job.status == AnalysisJob.STATUS_FAILED:
+                        messages.error(request, job.error)
+                        return redirect('home')
+                    if job.message is not None:
+                        gpt_response = job.message.content
+                        chart = job.message.chart_url
 
                 except Exception as e:
                     logger.error(f"Error processing upload: {str(e)}")
@@ -388,83 +517,15 @@ def home(request):
             active_chat = _get_active_chat(request)
             question = request.POST.get('question')
             if active_chat and active_chat.last_dataset and active_chat.last_dataset.file:
-                try:
-                    df = pd.read_csv(active_chat.last_dataset.file.path)
-                    question_answer = answer_question(question, df)
-                    # Try to infer a chart from the question
-                    chart_b64 = None
-                    try:
-                        spec = infer_chart_spec(question, df)
-                        if spec and isinstance(spec, dict):
-                            plt.figure(figsize=(10, 6))
-                            chart_type = spec.get('type')
-                            title = spec.get('title') or 'Chart'
-                            hue = spec.get('hue')
-                            if chart_type == 'hist':
-                                col = spec.get('x') or spec.get('y')
-                                bins = spec.get('bins') or 20
-                                if col and col in df.columns:
-                                    df[col].plot(kind='hist', bins=bins)
-                                    plt.title(title)
-                            elif chart_type == 'pie':
-                                col = spec.get('x') or spec.get('y')
-                                if col and col in df.columns:
-                                    df[col].value_counts().plot(kind='pie', autopct='%1.1f%%')
-                                    plt.title(title)
-                            elif chart_type == 'box':
-                                col = spec.get('y')
-                                if col and col in df.columns:
-                                    df[[col]].plot(kind='box')
-                                    plt.title(title)
-                            elif chart_type in ['bar', 'line', 'scatter']:
-                                x = spec.get('x')
-                                y = spec.get('y')
-                                if x and y and x in df.columns and y in df.columns:
-                                    data = df
-                                    agg = spec.get('agg')
-                                    if chart_type == 'bar' and agg in ['sum','mean','count']:
-                                        if agg == 'sum':
-                                            data = df.groupby(x)[y].sum().reset_index()
-                                        elif agg == 'mean':
-                                            data = df.groupby(x)[y].mean().reset_index()
-                                        elif agg == 'count':
-                                            data = df.groupby(x)[y].count().reset_index()
-                                    if chart_type == 'bar':
-                                        data.plot(kind='bar', x=x, y=y)
-                                    elif chart_type == 'line':
-                                        data.plot(kind='line', x=x, y=y)
-                                    elif chart_type == 'scatter':
-                                        data.plot(kind='scatter', x=x, y=y)
-                                    plt.title(title)
-                            buffer = BytesIO()
-                            plt.savefig(buffer, format='png')
-                            buffer.seek(0)
-                            image_png = buffer.getvalue()
-                            buffer.close()
-                            chart_b64 = base64.b64encode(image_png).decode('utf-8')
-                            plt.close()
-                    except Exception:
-                        chart_b64 = None
-
-                    ChatMessage.objects.create(
-                        chat=active_chat,
-                        type='question',
-                        content=question,
-                        response=question_answer,
-                        chart=chart_b64,
-                    )
-                    active_chat.save(update_fields=['updated_at'])
-
-                    if is_ajax:
-                        return JsonResponse({
-                            'success': True,
-                            'question_answer': question_answer,
-                            'chart': chart_b64,
-                            'active_chat_id': active_chat.id
-                        })
-                except Exception as e:
-                    if is_ajax:
-                        return JsonResponse({'success': False, 'error': str(e)})
+                # A repeated submission of the same question waits for and shares the first one's answer
+                payload = single_flight(
+                    work_key(request.user.id, active_chat.id, 'question', [active_chat.last_dataset_id, question]),
+                    lambda: _answer_payload(active_chat, question),
+                    succeeded=lambda payload: payload['success'],
+                )
+                if is_ajax:
+                    return JsonResponse(payload)
+                question_answer = payload.get('question_answer')
             else:
                 if is_ajax:
                     return JsonResponse({'success': False, 'error': 'No dataset uploaded to answer the question.'})
@@ -473,15 +534,7 @@ def home(request):
     # Render template for GET (or non-AJAX fallbacks)
     active_chat = _get_active_chat(request)
     chats_min = _serialize_chats(request.user)
-    chat_history = [
-        {
-            'type': m.type,
-            'content': m.content,
-            'response': m.response,
-            'chart': m.chart,
-        }
-        for m in (active_chat.messages.all() if active_chat else [])
-    ]
+    chat_history, next_cursor = _message_page(active_chat)
 
     return render(request, 'analysis/home.html', {
         'form': DataSetForm(),
@@ -489,6 +542,100 @@ def home(request):
         'chart': chart,
         'question_answer': question_answer,
         'chat_history': chat_history,
+        'next_cursor': next_cursor,
         'chats': chats_min,
         'active_chat_id': active_chat.id if active_chat else None,
     })
+
+
+def _sse(payload, event=None):
+    lines = f'event: {event}\n' if event else ''
+    return f'{lines}data: {json.dumps(payload)}\n\n'
+
+
+def _question_events(chat, question, df, profile):
+    """Server-sent events for a streamed answer; the message is persisted once the stream completes.
+
+    A ``status`` event goes out first, before the query plan is requested, so
+    the browser hears back without waiting for any LLM round trip. A duplicate
+    of a question that is already being answered waits for it and replays its
+    result as a single delta instead of asking again.
+    """
+    yield _sse({'status': 'thinking'}, event='status')
+    with Flight(work_key(chat.user_id, chat.id, 'question', [chat.last_dataset_id, question])) as flight:
+        if not flight.leader:
+            payload = flight.result
+            if payload.get('success'):
+                yield _sse({'delta': payload['question_answer']})
+                yield _sse(payload, event='done')
+            else:
+                yield _sse(payload, event='error')
+            return
+
+        parts = []
+        spec = None
+        try:
+            for kind, value in stream_answer_with_chart(question, df, profile):
+                if kind == 'delta':
+                    parts.append(value)
+                    yield _sse({'delta': value})
+                else:
+                    spec = value
+        except Exception as e:
+            logger.error(f"Error streaming answer: {str(e)}")
+            # Not published: a retry should ask again rather than replay the failure
+            yield _sse({'success': False, 'error': str(e)}, event='error')
+            return
+
+        question_answer = ''.join(parts)
+        chart_fields = spec_chart_fields(spec, df, dataset_content_hash(chat.last_dataset), profile)
+        message = ChatMessage.objects.create(
+            chat=chat,
+            type='question',
+            content=question,
+            response=question_answer,
+            **chart_fields,
+        )
+        chat.record_messages([message])
+        payload = {
+            'success': True,
+            'question_answer': question_answer,
+            'chart_url': message.chart_url,
+            'chart_data': message.chart_data,
+            'active_chat_id': chat.id,
+        }
+        flight.publish(payload)
+        yield _sse(payload, event='done')
+
+
+async def _aiter_events(events):
+    # Under ASGI a sync iterator would be buffered whole; step it from a worker thread instead
+    done = object()
+    while True:
+        item = await sync_to_async(next)(events, done)
+        if item is done:
+            return
+        yield item
+
+
+@login_required
+def stream_question(request):
+    if request.method != 'POST':
+        return JsonResponse({'success': False, 'error': 'POST required'}, status=405)
+    active_chat = _get_active_chat(request)
+    question = request.POST.get('question')
+    if not (active_chat and active_chat.last_dataset and active_chat.last_dataset.file):
+        return JsonResponse({'success': False, 'error': 'No dataset uploaded to answer the question.'})
+    try:
+        df = load_dataset_source(active_chat.last_dataset)
+        profile = dataset_profile(active_chat.last_dataset, df)
+    except Exception as e:
+        return JsonResponse({'success': False, 'error': str(e)})
+
+    events = _question_events(active_chat, question, df, profile)
+    if isinstance(request, ASGIRequest):
+        events = _aiter_events(events)
+    response = StreamingHttpResponse(events, content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
@@ -1,6 +1,14 @@
 # backend/middleware.py
+import logging
+import time
+
+from django.db import connection
 from django.utils.cache import patch_cache_control
 
+from analysis.metrics import RequestMetrics, activate, deactivate, registry
+
+metrics_logger = logging.getLogger('analysis.metrics')
+
 class NoStoreForAuthUsersMiddleware:
     def __init__(self, get_response):
         self.get_response = get_response
@@ -17,3 +25,39 @@ class NoStoreForAuthUsersMiddleware:
             response["Expires"] = "0"
 
         return response
+
+
+class RequestMetricsMiddleware:
+    """Record query count, SQL time and stage timings for every request, keyed by action."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        metrics = RequestMetrics()
+        token = activate(metrics)
+        start = time.perf_counter()
+        try:
+            with connection.execute_wrapper(metrics.sql_wrapper):
+                response = self.get_response(request)
+        finally:
+            deactivate(token)
+
+        sample = metrics.as_dict()
+        sample['wall_ms'] = round((time.perf_counter() - start) * 1000, 2)
+        action = self.action_name(request)
+        registry.record(action, sample)
+        metrics_logger.info(
+            'action=%s %s', action, ' '.join(f'{k}={v}' for k, v in sample.items())
+        )
+        # Exposed for tests (see analysis.tests) and debugging
+        response.metrics = dict(sample, action=action)
+        return response
+
+    @staticmethod
+    def action_name(request):
+        match = getattr(request, 'resolver_match', None)
+        name = (match.url_name if match else None) or 'unresolved'
+        # The home view multiplexes several actions over POST via form_type
+        form_type = request.POST.get('form_type') if request.method == 'POST' else None
+        return f'{name}:{form_type or request.method}'
@@ -57,6 +57,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'backend.middleware.RequestMetricsMiddleware',
 ]
 
 ROOT_URLCONF = 'backend.urls'
@@ -90,7 +91,9 @@ if os.getenv('DATABASE_URL'):
     DATABASES = {
         'default': dj_database_url.config(
             default=os.getenv('DATABASE_URL'),
-            conn_max_age=600,
+            # The web process is served over ASGI, where persistent connections are never reused
+            # (each request runs on its own thread), so keep them off unless behind a pool
+            conn_max_age=int(os.getenv('DB_CONN_MAX_AGE', '0')),
             conn_health_checks=True,
         )
     }
@@ -167,6 +170,88 @@ LOGIN_URL = 'login'
 # OpenAI API configuration
 OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
 
+# Concurrency and per-request deadline for fanned-out OpenAI calls
+LLM_MAX_WORKERS = int(os.getenv('LLM_MAX_WORKERS', '8'))
+LLM_CALL_TIMEOUT = float(os.getenv('LLM_CALL_TIMEOUT', '60'))
+
+# LLM backend: 'openai', or 'local' for a deterministic offline stand-in (tests, load runs)
+LLM_BACKEND = os.getenv('LLM_BACKEND', 'openai')
+LLM_LOCAL_LATENCY = float(os.getenv('LLM_LOCAL_LATENCY', '0'))
+# In-flight completions per process; further calls wait for a slot (within LLM_CALL_TIMEOUT)
+LLM_MAX_CONCURRENCY = int(os.getenv('LLM_MAX_CONCURRENCY', '8'))
+# Per HTTP attempt timeout and pooled keep-alive connections to the provider
+LLM_REQUEST_TIMEOUT = float(os.getenv('LLM_REQUEST_TIMEOUT', '30'))
+LLM_HTTP_MAX_CONNECTIONS = int(os.getenv('LLM_HTTP_MAX_CONNECTIONS', '16'))
+# Retries on 429/5xx/timeouts with full-jitter exponential backoff (seconds), honouring Retry-After
+LLM_MAX_RETRIES = int(os.getenv('LLM_MAX_RETRIES', '5'))
+LLM_BACKOFF_BASE = float(os.getenv('LLM_BACKOFF_BASE', '0.5'))
+LLM_BACKOFF_MAX = float(os.getenv('LLM_BACKOFF_MAX', '20'))
+# Token budget for the dataset description (schema, statistics, sample rows) or result table in a prompt
+LLM_PROMPT_MAX_TOKENS = int(os.getenv('LLM_PROMPT_MAX_TOKENS', '1500'))
+LLM_PROMPT_SAMPLE_ROWS = int(os.getenv('LLM_PROMPT_SAMPLE_ROWS', '3'))
+
+# LLM response cache: 'memory' (per process), 'sqlite' (shared file), 'django' (CACHES alias) or 'none'
+LLM_CACHE_BACKEND = os.getenv('LLM_CACHE_BACKEND', 'memory')
+LLM_CACHE_TTL = int(os.getenv('LLM_CACHE_TTL', str(24 * 60 * 60)))
+LLM_CACHE_MAX_ENTRIES = int(os.getenv('LLM_CACHE_MAX_ENTRIES', '2000'))
+LLM_CACHE_PATH = os.getenv('LLM_CACHE_PATH', str(BASE_DIR / 'llm_cache.sqlite3'))
+LLM_CACHE_ALIAS = os.getenv('LLM_CACHE_ALIAS', 'default')
+
+# Upload analysis runs inline by default (also under runserver/DEBUG). Set True only where a `worker`
+# process (`manage.py run_analysis_worker`) is deployed; without one, queued uploads are never analysed
+ANALYSIS_ASYNC_UPLOADS = os.getenv('ANALYSIS_ASYNC_UPLOADS', 'False').lower() == 'true'
+# Running jobs renew a heartbeat this often (seconds); run_analysis_worker requeues jobs whose
+# heartbeat is older than --stale-after, and fails them after ANALYSIS_JOB_MAX_ATTEMPTS claims
+ANALYSIS_JOB_HEARTBEAT = float(os.getenv('ANALYSIS_JOB_HEARTBEAT', '30'))
+ANALYSIS_JOB_MAX_ATTEMPTS = int(os.getenv('ANALYSIS_JOB_MAX_ATTEMPTS', '3'))
+
+# Chart rendering pool (warm matplotlib processes); 0 renders in the calling thread
+CHART_RENDER_WORKERS = int(os.getenv('CHART_RENDER_WORKERS', '2'))
+CHART_RENDER_TIMEOUT = float(os.getenv('CHART_RENDER_TIMEOUT', '20'))
+# Rendered-chart memo entries per process, keyed by dataset content hash and chart spec
+CHART_MEMO_MAX_ENTRIES = int(os.getenv('CHART_MEMO_MAX_ENTRIES', '1000'))
+# Upper bounds on plotted data: line points (LTTB), scatter points (stratified sample),
+# and pie/bar categories before the rest is folded into "Other"
+CHART_MAX_LINE_POINTS = int(os.getenv('CHART_MAX_LINE_POINTS', '2000'))
+CHART_MAX_SCATTER_POINTS = int(os.getenv('CHART_MAX_SCATTER_POINTS', '5000'))
+CHART_MAX_CATEGORIES = int(os.getenv('CHART_MAX_CATEGORIES', '10'))
+# 'png' renders charts on the server; 'data' sends the spec plus compact aggregated
+# arrays (at most CHART_DATA_MAX_POINTS per series) for the browser to draw
+CHART_DELIVERY = os.getenv('CHART_DELIVERY', 'png')
+CHART_DATA_MAX_POINTS = int(os.getenv('CHART_DATA_MAX_POINTS', '500'))
+
+# Chat history page size (newest messages first, older pages fetched by cursor)
+CHAT_PAGE_SIZE = int(os.getenv('CHAT_PAGE_SIZE', '30'))
+CHAT_PAGE_MAX_SIZE = 100
+# Rows per query when streaming a chat history export, and per bulk insert when importing one
+CHAT_TRANSFER_BATCH_SIZE = int(os.getenv('CHAT_TRANSFER_BATCH_SIZE', '500'))
+
+# Uploads up to DATASET_MAX_BYTES (and 100k rows) are parsed into memory. Larger ones, up to
+# LARGE_DATASET_MAX_BYTES, are ingested chunk-wise into a partitioned on-disk store. Off (0, rejecting
+# them) unless opted in, since those files are written to local disk
+DATASET_MAX_BYTES = int(os.getenv('DATASET_MAX_BYTES', str(10 * 1024 * 1024)))
+LARGE_DATASET_MAX_BYTES = int(os.getenv('LARGE_DATASET_MAX_BYTES', '0'))
+
+# Uploads are hashed as they stream in; identical content reuses one stored file plus its
+# profile, columnar copy, initial analysis and chart. 'user' reuses only within a user's own
+# uploads, 'none' disables reuse. 'global' shares across users; it is opt-in because it reuses
+# one account's analysis for another and reveals (by timing) that a file was uploaded before
+UPLOAD_DEDUP_SCOPE = os.getenv('UPLOAD_DEDUP_SCOPE', 'user')
+# Duplicate upload/question requests (same user, chat and payload) share one in-flight
+# computation via file locks; results are kept briefly for late retries. The directory holds
+# answers, so keep it private (not under MEDIA_ROOT or STATIC_ROOT) and local to the host
+SINGLE_FLIGHT_DIR = os.getenv('SINGLE_FLIGHT_DIR', str(BASE_DIR / 'inflight'))
+SINGLE_FLIGHT_TIMEOUT = float(os.getenv('SINGLE_FLIGHT_TIMEOUT', '120'))
+SINGLE_FLIGHT_RESULT_TTL = float(os.getenv('SINGLE_FLIGHT_RESULT_TTL', '10'))
+FILE_UPLOAD_HANDLERS = [
+    'analysis.uploads.ContentHashUploadHandler',
+    'django.core.files.uploadhandler.MemoryFileUploadHandler',
+    'django.core.files.uploadhandler.TemporaryFileUploadHandler',
+]
+
+# Parsed dataset cache (per worker process), bounded by DataFrame memory usage
+DATAFRAME_CACHE_MAX_BYTES = int(os.getenv('DATAFRAME_CACHE_MAX_BYTES', str(256 * 1024 * 1024)))
+
 # Security settings for production
 if not DEBUG:
     # HTTPS settings
@@ -16,8 +16,6 @@ Including another URLconf
 """
 from django.contrib import admin
 from django.urls import path, include
-from django.conf import settings
-from django.conf.urls.static import static
 from users import views as user_views
 
 urlpatterns = [
@@ -26,5 +24,6 @@ urlpatterns = [
     path('', include('analysis.urls')),
     path('', user_views.home, name='home'),  # Redirect to home view
 ]
-urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
+# MEDIA_ROOT (uploaded datasets, charts) is deliberately not served: charts go through the
+# authenticated analysis-chart view and datasets are never downloaded directly
 